@@ -5,8 +5,74 @@ import time
 import string
 import asyncio
 from queue import Queue
-from src.utils import sql, helpers, llm
-from src.context.member import Member
+from src.utils import sql, helpers, llm, output_cache
+from src.context.member import Member, INPUT_TYPE_STREAM
+
+DEFAULT_RESERVED_TOKENS = 1024  # tokens kept free for the response when the model has no max_tokens
+VOICE_COLUMNS = "v.id, v.api_id, v.uuid, v.display_name, v.known_from, v.creator, v.lang, v.verb"
+
+
+def load_agents_data(agent_configs):
+    """
+    Returns the data shared by agents with `agent_configs`, for `Agent.preloaded_data`:
+    {'default_agent': dict, 'voices': {str(voice_id): voice row}, 'tools': {str(tool_id): (name, config)}}
+    A workflow loads it with one query per table, instead of a few queries per member.
+    """
+    default_agent = json.loads(sql.get_scalar("SELECT value FROM settings WHERE field = 'default_agent'"))
+    configs = [{**default_agent, **agent_config} for agent_config in agent_configs]
+
+    voice_ids = {str(config.get('voice.current_id')) for config in configs} - {'None', '0'}
+    tool_ids = {str(tool['id']) for config in configs for tool in json.loads(config.get('tools.data', '[]'))}
+
+    voices = {}
+    if voice_ids:
+        voices = {str(row[0]): row for row in sql.get_results(f"""
+            SELECT {VOICE_COLUMNS}
+            FROM voices v
+            WHERE v.id IN ({','.join(['?'] * len(voice_ids))})""", list(voice_ids))}
+    tools = {}
+    if tool_ids:
+        tools = {str(tool_id): (name, config) for tool_id, name, config in sql.get_results(f"""
+            SELECT id, name, config
+            FROM tools
+            WHERE id IN ({','.join(['?'] * len(tool_ids))})
+            ORDER BY id""", list(tool_ids))}
+
+    return {'default_agent': default_agent, 'voices': voices, 'tools': tools}
+
+
+class ToolCallCollector:
+    """Collects the tool calls of a streamed response, where the arguments of each call arrive in parts"""
+    def __init__(self):
+        self.tools = {}  # {tool_name: args json}
+        self.current_tool_name = None
+        self.current_args = ''
+
+    def add(self, tool_calls):
+        tool_name = tool_calls[0].function.name
+        if tool_name:
+            if self.current_tool_name is not None:
+                self.tools[self.current_tool_name] = self.current_args
+            self.current_tool_name = tool_name
+            self.current_args = ''
+        else:
+            self.current_args += tool_calls[0].function.arguments
+
+    def get_tools(self):
+        if self.current_tool_name is not None:
+            self.tools[self.current_tool_name] = self.current_args
+        return self.tools
+
+
+async def iterate_in_executor(iterator):
+    """Yields the items of a blocking `iterator`, each `next` runs in the loop's default executor"""
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(None, next, iterator, done)
+        if item is done:
+            return
+        yield item
 
 
 class Agent(Member):
@@ -24,6 +90,8 @@ class Agent(Member):
 
         self.tools_config = {}
         self.tools = {}
+        self.preloaded_data = None  # set by `Workflow.load_members` before `load_agent`, see `load_agents_data`
+        self.fingerprint = None  # what the agent was loaded from, `Workflow.load_members` reuses it while unchanged
 
         self.intermediate_task_responses = Queue()
         self.speech_lock = asyncio.Lock()
@@ -48,6 +116,12 @@ class Agent(Member):
         if self.bg_task:
             self.bg_task.cancel()
 
+    def unload(self):
+        if self.bg_task:
+            self.bg_task.cancel()
+            self.bg_task = None
+        self.tools = {}
+
     # async def __intermediate_response_thread(self):
     #     while True:
     #         await asyncio.sleep(0.03)
@@ -63,33 +137,38 @@ class Agent(Member):
 
     def load_agent(self):
         logging.debug(f'LOAD AGENT {self.id}')
-        if self.member_id:
-            agent_data = sql.get_results("""
-                SELECT
-                    cm.`agent_config`,
-                    s.`value` AS `default_agent`
-                FROM contexts_members cm
-                LEFT JOIN settings s 
-                    ON s.field = 'default_agent'
-                WHERE cm.id = ? """, (self.member_id,))[0]
-        elif self.id > 0:
-            agent_data = sql.get_results("""
-                SELECT
-                    a.`config`,
-                    s.`value` AS `default_agent`
-                FROM agents a
-                LEFT JOIN settings s ON s.field = 'default_agent'
-                WHERE a.id = ? """, (self.id,))[0]
+        preloaded, self.preloaded_data = self.preloaded_data, None
+        if preloaded is not None:
+            agent_config = preloaded['agent_config']
+            default_agent = preloaded['default_agent']
         else:
-            agent_data = sql.get_results("""
-                SELECT
-                    '{}',
-                    s.`value` AS `default_agent`
-                FROM settings s
-                WHERE s.field = 'default_agent' """)[0]
-
-        agent_config = json.loads(agent_data[0])
-        default_agent = json.loads(agent_data[1])
+            if self.member_id:
+                agent_data = sql.get_results("""
+                    SELECT
+                        cm.`agent_config`,
+                        s.`value` AS `default_agent`
+                    FROM contexts_members cm
+                    LEFT JOIN settings s 
+                        ON s.field = 'default_agent'
+                    WHERE cm.id = ? """, (self.member_id,))[0]
+            elif self.id > 0:
+                agent_data = sql.get_results("""
+                    SELECT
+                        a.`config`,
+                        s.`value` AS `default_agent`
+                    FROM agents a
+                    LEFT JOIN settings s ON s.field = 'default_agent'
+                    WHERE a.id = ? """, (self.id,))[0]
+            else:
+                agent_data = sql.get_results("""
+                    SELECT
+                        '{}',
+                        s.`value` AS `default_agent`
+                    FROM settings s
+                    WHERE s.field = 'default_agent' """)[0]
+
+            agent_config = json.loads(agent_data[0])
+            default_agent = json.loads(agent_data[1])
         self.config = {**default_agent, **agent_config}
         self.name = agent_config.get('info.name', 'Assistant')
 
@@ -99,41 +178,41 @@ class Agent(Member):
 
         voice_id = self.config.get('voice.current_id', None)
         if voice_id is not None and str(voice_id) != '0':  # todo dirty
-            self.voice_data = sql.get_results("""
-                SELECT
-                    v.id,
-                    v.api_id,
-                    v.uuid,
-                    v.display_name,
-                    v.known_from,
-                    v.creator,
-                    v.lang,
-                    v.verb
-                FROM voices v
-                WHERE v.id = ? """, (voice_id,))[0]
+            if preloaded is not None:
+                self.voice_data = preloaded['voices'].get(str(voice_id))
+            else:
+                self.voice_data = sql.get_results(f"""
+                    SELECT {VOICE_COLUMNS}
+                    FROM voices v
+                    WHERE v.id = ? """, (voice_id,))[0]
         else:
             self.voice_data = None
 
-        self.load_tools()
+        self.load_tools(preloaded['tools'] if preloaded is not None else None)
 
         # if self.speaker is not None: self.speaker.kill()
         # self.speaker = None  # speech.Stream_Speak(self)  todo
 
-    def load_tools(self):
+    def load_tools(self, preloaded_tools=None):
+        """`preloaded_tools` is {str(tool_id): (name, config)} from `load_agents_data`"""
         tools_in_config = json.loads(self.config.get('tools.data', '[]'))
         agent_tools_ids = [tool['id'] for tool in tools_in_config]
         if len(agent_tools_ids) == 0:
             return []
 
-        self.tools_config = sql.get_results(f"""
-            SELECT
-                name,
-                config
-            FROM tools
-            WHERE 
-                -- json_extract(config, '$.method') = ? AND
-                id IN ({','.join(['?'] * len(agent_tools_ids))})
-        """, agent_tools_ids)
+        if preloaded_tools is not None:
+            self.tools_config = [preloaded_tools[str(tool_id)] for tool_id in agent_tools_ids
+                                 if str(tool_id) in preloaded_tools]
+        else:
+            self.tools_config = sql.get_results(f"""
+                SELECT
+                    name,
+                    config
+                FROM tools
+                WHERE 
+                    -- json_extract(config, '$.method') = ? AND
+                    id IN ({','.join(['?'] * len(agent_tools_ids))})
+            """, agent_tools_ids)
 
         for tool_name, tool_config in self.tools_config:
             tool_config = json.loads(tool_config)
@@ -241,12 +320,12 @@ class Agent(Member):
 
     async def run_member(self):
         """The entry response method for the member."""
-        for key, chunk in self.receive(stream=True):
+        async for key, chunk in self.get_response_astream():
             if self.workflow.stop_requested:
-                self.workflow.stop_requested = False
                 break
             # if key == 'assistant':
             self.main.new_sentence_signal.emit(key, self.m_id, chunk)
+            self.add_partial_output(chunk)
 
     def receive(self, stream=False):
         return self.get_response_stream() if stream else self.get_response()
@@ -257,52 +336,122 @@ class Agent(Member):
             response += chunk or ''
         return response
 
-    def get_response_stream(self, extra_prompt='', msgs_in_system=False):
-        messages = self.workflow.message_history.get(llm_format=True, calling_member_id=self.member_id)
-        use_msgs_in_system = messages if msgs_in_system else None
-        system_msg = self.system_message(msgs_in_system=use_msgs_in_system,
-                                         response_instruction=extra_prompt)
+    def get_stream_kwargs(self, extra_prompt='', msgs_in_system=False):
+        """Returns the kwargs of `stream` for the next response"""
         model_name = self.config.get('chat.model', 'gpt-3.5-turbo')
-        model = (model_name, self.workflow.main.system.models.get_llm_parameters(model_name))
+        models = self.workflow.main.system.models
+        model = (model_name, models.get_llm_parameters(model_name))
+
+        # The history fills what's left of the context window after the system message and the completion
+        system_msg = self.system_message(response_instruction=extra_prompt)
+        messages = self.workflow.message_history.get(
+            llm_format=True,
+            calling_member_id=self.member_id,
+            msg_limit=self.config.get('chat.max_messages', 10),
+            context_window=models.get_context_window(model_name),
+            reserved_tokens=int(model[1].get('max_tokens') or DEFAULT_RESERVED_TOKENS),
+            system_msg=system_msg,
+            model_name=model_name,
+            summarize=self.workflow.main.system.config.dict.get('system.summarize_long_chats', False),
+        )
+        # Stream inputs that are still responding aren't saved yet, so what they've written so far is added
+        for input_id, input_type in self.input_types.items():
+            input_member = self.workflow.members.get(input_id)
+            if input_type == INPUT_TYPE_STREAM and input_member is not None and input_member.partial_output:
+                messages.append({'role': 'user', 'content': input_member.partial_output})
 
-        kwargs = dict(messages=messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
-        stream = self.stream(**kwargs)
+        if msgs_in_system:
+            system_msg = self.system_message(msgs_in_system=messages,
+                                             response_instruction=extra_prompt)
 
-        # response = ''
-        role_responses = {}
+        return dict(messages=messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
+
+    def get_response_stream(self, extra_prompt='', msgs_in_system=False):
+        stream_kwargs = self.get_stream_kwargs(extra_prompt, msgs_in_system)
+        cache_key, cached_responses = self.get_cached_responses(stream_kwargs)
+        if cached_responses is not None:
+            yield from ((key, response) for key, response in cached_responses.items() if key != 'tools')
+            self.save_responses(cached_responses, from_cache=True)
+            return
+
+        stream = self.stream(**stream_kwargs)
 
+        role_responses = {}
         for key, chunk in stream:
-            if key not in role_responses:
-                role_responses[key] = ''
             if key == 'tools':
                 role_responses['tools'] = chunk
             else:
                 chunk = chunk or ''
-                role_responses[key] += chunk
+                role_responses[key] = role_responses.get(key, '') + chunk
                 yield key, chunk
-            # if key == 'assistant':
-            #     response += chunk or ''
-            #     yield key, chunk
 
-            # elif key == 'tools':
-            #     all_tools = chunk
-            #     for tool_name, tool_args in all_tools.items():
-            #         tool_name = tool_name.replace('_', ' ').capitalize()
-            #         self.workflow.save_message('tool', tool_name, self.member_id, self.logging_obj)
-            # else:
+        if cache_key is not None:
+            output_cache.put(cache_key, role_responses)
+        self.save_responses(role_responses)
+
+    async def get_response_astream(self, extra_prompt='', msgs_in_system=False):
+        """`get_response_stream` without blocking the event loop, so members can respond at the same time"""
+        stream_kwargs = self.get_stream_kwargs(extra_prompt, msgs_in_system)
+        cache_key, cached_responses = self.get_cached_responses(stream_kwargs)
+        if cached_responses is not None:
+            for key, response in cached_responses.items():
+                if key != 'tools':
+                    yield key, response
+            self.save_responses(cached_responses, from_cache=True)
+            return
+
+        stream = self.astream(**stream_kwargs)
 
+        role_responses = {}
+        async for key, chunk in stream:
+            if key == 'tools':
+                role_responses['tools'] = chunk
+            else:
+                chunk = chunk or ''
+                role_responses[key] = role_responses.get(key, '') + chunk
+                yield key, chunk
+
+        if cache_key is not None:
+            output_cache.put(cache_key, role_responses)
+        self.save_responses(role_responses)
+
+    def get_cached_responses(self, stream_kwargs):
+        """
+        Returns (cache key, cached responses or None) for the request `stream` would send with `stream_kwargs`.
+        The key is None when the member doesn't cache its responses, or its model isn't deterministic.
+        """
+        model = stream_kwargs['model']
+        if not self.config.get('chat.cache_responses', False) or type(self).stream is not Agent.stream:
+            return None, None
+        if not output_cache.is_deterministic(model[1]):
+            return None, None
+
+        messages = stream_kwargs['messages'] if not stream_kwargs['msgs_in_system'] else []
+        request = llm.get_chat_kwargs(messages, stream_kwargs['system_msg'], model_obj=model,
+                                      tools=self.get_function_call_tools())
+        cache_key = output_cache.get_key(request)
+        cached_responses = output_cache.get(cache_key)
+        if cached_responses is not None:
+            self.logging_obj = json.dumps({
+                'model': model[0],
+                'cost': 0.0,
+                'cached': True,
+                'system': stream_kwargs['system_msg'],
+                'messages': messages,
+            })
+        return cache_key, cached_responses
+
+    def save_responses(self, role_responses, from_cache=False):
+        """Saves the full response of each role, and a message for each tool called"""
         for key, response in role_responses.items():
             if key == 'tools':
                 all_tools = response
                 for tool_name, tool_args in all_tools.items():
                     tool_name = tool_name.replace('_', ' ').capitalize()
-                    self.workflow.save_message('tool', tool_name, self.member_id, self.logging_obj)
+                    self.workflow.save_message('tool', tool_name, self.member_id, self.logging_obj, cached=from_cache)
             else:
                 if response != '':
-                    self.workflow.save_message(key, response, self.member_id, self.logging_obj)
-        #
-        # if response != '':
-        #     self.workflow.save_message('assistant', response, self.member_id, self.logging_obj)
+                    self.workflow.save_message(key, response, self.member_id, self.logging_obj, cached=from_cache)
 
     def stream(self, messages, msgs_in_system=False, system_msg='', model=None):
         tools = self.get_function_call_tools()
@@ -312,37 +461,52 @@ class Agent(Member):
                                        tools=tools)
         self.logging_obj = stream.logging_obj
 
-        collected_tools = {}
-        current_tool_name = None
-        current_args = ''
-
+        tool_calls = ToolCallCollector()
         for resp in stream:
             delta = resp.choices[0].get('delta', {})
             if not delta:
                 continue
-            tool_calls = delta.get('tool_calls', None)
-            content = delta.get('content', '')
-            if tool_calls:
-                tool_name = tool_calls[0].function.name
-                if tool_name:
-                    if current_tool_name is not None:
-                        collected_tools[current_tool_name] = current_args
-                    current_tool_name = tool_name
-                    current_args = ''
-                else:
-                    current_args += tool_calls[0].function.arguments
-
+            if delta.get('tool_calls', None):
+                tool_calls.add(delta['tool_calls'])
             else:
-                yield 'assistant', content or ''
+                yield 'assistant', delta.get('content', '') or ''
 
-        if current_tool_name is not None:
-            collected_tools[current_tool_name] = current_args
-
-        if len(collected_tools) > 0:
-            yield 'tools', collected_tools
+        if tool_calls.get_tools():
+            yield 'tools', tool_calls.get_tools()
         # else:
         #     raise NotImplementedError('No message or tool calls were returned from the model')
 
+    async def astream(self, messages, msgs_in_system=False, system_msg='', model=None):
+        """
+        Async `stream` on `litellm.acompletion`. Plugin agents that override `stream` with their own generator
+        have it run in an executor instead.
+        """
+        if type(self).stream is not Agent.stream:
+            sync_stream = self.stream(messages, msgs_in_system=msgs_in_system, system_msg=system_msg, model=model)
+            async for key, chunk in iterate_in_executor(sync_stream):
+                yield key, chunk
+            return
+
+        tools = self.get_function_call_tools()
+        stream = await llm.get_chat_response_async(messages if not msgs_in_system else [],
+                                                   system_msg,
+                                                   model_obj=model,
+                                                   tools=tools)
+        self.logging_obj = stream.logging_obj
+
+        tool_calls = ToolCallCollector()
+        async for resp in stream:
+            delta = resp.choices[0].get('delta', {})
+            if not delta:
+                continue
+            if delta.get('tool_calls', None):
+                tool_calls.add(delta['tool_calls'])
+            else:
+                yield 'assistant', delta.get('content', '') or ''
+
+        if tool_calls.get_tools():
+            yield 'tools', tool_calls.get_tools()
+
     # def get_agent_tools(self):
     #     agent_tools = json.loads(self.config.get('tools.data', '[]'))
     #     agent_tools_ids = [tool['id'] for tool in agent_tools]
@@ -0,0 +1,233 @@
+import logging
+import os
+import threading
+import time
+
+from src.utils import sql
+
+# Tables moved to the archive with a context, in the order rows are restored
+ARCHIVED_TABLES = ('contexts', 'contexts_members', 'contexts_members_inputs', 'contexts_messages')
+
+ARCHIVE_BATCH_SIZE = 20  # contexts looked up per query by the background archiver
+ARCHIVE_PAUSE = 0.2  # seconds between archived contexts, so the UI thread gets the db in between
+
+_archive_thread = None
+
+
+def get_archive_path():
+    return os.path.join(os.path.dirname(sql.get_db_path()), 'archive.db')
+
+
+def attach():
+    """Attaches archive.db to the calling thread's connection as `archive`, creating or updating its tables"""
+    attached = [row[1] for row in sql.get_results("PRAGMA database_list")]
+    if 'archive' in attached:
+        return
+
+    sql.execute("ATTACH DATABASE ? AS archive", (get_archive_path(),))
+    sql.execute("PRAGMA archive.journal_mode = WAL")
+
+    with sql.transaction() as tx:
+        for table in ARCHIVED_TABLES:
+            # Generated columns aren't stored, they're recomputed when the rows are restored
+            columns = [(name, col_type) for _, name, col_type, _, _, _, hidden in
+                       sql.get_results(f'PRAGMA main.table_xinfo("{table}")') if hidden == 0]
+            archive_columns = [row[1] for row in sql.get_results(f'PRAGMA archive.table_xinfo("{table}")')]
+            if not archive_columns:
+                column_defs = ', '.join(f'"{name}" {col_type}' for name, col_type in columns)
+                tx.execute(f'CREATE TABLE archive."{table}" ({column_defs}, PRIMARY KEY("id"))')
+            else:
+                for name, col_type in columns:
+                    if name not in archive_columns:
+                        tx.execute(f'ALTER TABLE archive."{table}" ADD COLUMN "{name}" {col_type}')
+
+        tx.execute("""
+            CREATE INDEX IF NOT EXISTS archive."contexts_parent_indx" ON "contexts" ("parent_id")""")
+        tx.execute("""
+            CREATE INDEX IF NOT EXISTS archive."contexts_members_context_indx" ON "contexts_members" ("context_id")""")
+        tx.execute("""
+            CREATE INDEX IF NOT EXISTS archive."contexts_members_inputs_member_indx" ON "contexts_members_inputs" ("member_id")""")
+        tx.execute("""
+            CREATE INDEX IF NOT EXISTS archive."contexts_messages_context_indx" ON "contexts_messages" ("context_id", "id")""")
+
+        # One row per archived root context, for listing them without reading the tables above
+        tx.execute("""
+            CREATE TABLE IF NOT EXISTS archive."archived_contexts" (
+                "context_id"	INTEGER NOT NULL,
+                "summary"	TEXT NOT NULL DEFAULT '',
+                "display_name"	TEXT,
+                "avatar_paths"	TEXT,
+                "folder_id"	INTEGER,
+                "last_message_unix"	INTEGER,
+                "archived_unix"	INTEGER NOT NULL,
+                PRIMARY KEY("context_id")
+            )""")
+
+
+def find_archivable(cutoff_unix, exclude_ids=(), limit=ARCHIVE_BATCH_SIZE):
+    """Returns ids of root contexts with messages, where no message in any branch is newer than `cutoff_unix`"""
+    exclude_ids = [context_id for context_id in exclude_ids if context_id is not None]
+    exclude_placeholders = ', '.join('?' for _ in exclude_ids)
+    return sql.get_results(f"""
+        WITH RECURSIVE tree(root_id, id) AS (
+            SELECT cs.context_id, cs.context_id
+            FROM context_summary cs
+            WHERE cs.last_message_id > 0
+                AND cs.last_message_unix < ?
+                AND cs.context_id NOT IN ({exclude_placeholders})
+            UNION ALL
+            SELECT t.root_id, c.id
+            FROM tree t
+            JOIN contexts c ON c.parent_id = t.id
+        )
+        SELECT root_id
+        FROM tree t
+        GROUP BY root_id
+        HAVING MAX(COALESCE((
+            SELECT unix FROM contexts_messages WHERE context_id = t.id ORDER BY id DESC LIMIT 1
+        ), 0)) < ?
+        ORDER BY root_id
+        LIMIT ?""", (cutoff_unix, *exclude_ids, cutoff_unix, limit), return_type='list')
+
+
+def archive_context(context_id, cutoff_unix=None, get_in_use_ids=None):
+    """
+    Moves a root context and all its branches, members and messages into the archive, returns whether it was moved.
+    With `cutoff_unix` or `get_in_use_ids`, the context is skipped if a message of its tree is newer than the cutoff,
+    or it's in use. They're checked in the same transaction as the move, so nothing written to it can be lost.
+    """
+    attach()
+    with sql.transaction() as tx:
+        if get_in_use_ids is not None and context_id in set(get_in_use_ids()):
+            return False
+        tree_ids = _tree_ids('main', context_id)
+        if not tree_ids:
+            return False
+        if cutoff_unix is not None and _last_message_unix(tree_ids) >= cutoff_unix:
+            return False
+
+        _copy_tree(tx, 'main', 'archive', tree_ids)
+        tx.execute("""
+            INSERT OR REPLACE INTO archive.archived_contexts
+                (context_id, summary, display_name, avatar_paths, folder_id, last_message_unix, archived_unix)
+            SELECT
+                c.id,
+                c.summary,
+                cs.display_name,
+                cs.avatar_paths,
+                c.folder_id,
+                cs.last_message_unix,
+                ?
+            FROM main.contexts c
+            LEFT JOIN main.context_summary cs
+                ON cs.context_id = c.id
+            WHERE c.id = ?""", (int(time.time()), context_id))
+        _delete_tree(tx, 'main', tree_ids)
+    return True
+
+
+def restore_context(context_id):
+    """Moves an archived root context back into the main db, with its original ids"""
+    attach()
+    tree_ids = _tree_ids('archive', context_id)
+    if not tree_ids:
+        return
+
+    with sql.transaction() as tx:
+        _copy_tree(tx, 'archive', 'main', tree_ids)
+        _delete_tree(tx, 'archive', tree_ids)
+        tx.execute("DELETE FROM archive.archived_contexts WHERE context_id = ?", (context_id,))
+
+
+def clear_archive(tx):
+    """Deletes every archived context in the transaction `tx`, `attach` must have been called first"""
+    for table in reversed(ARCHIVED_TABLES):
+        tx.execute(f'DELETE FROM archive."{table}"')
+    tx.execute("DELETE FROM archive.archived_contexts")
+
+
+def start_background_archive(days, get_in_use_ids=None):
+    """
+    Archives contexts untouched for `days` days in a background thread, one context per transaction.
+    `get_in_use_ids` returns ids of contexts that must not be archived, it's checked again for each context.
+    """
+    global _archive_thread
+    if not days or days <= 0:
+        return
+    if _archive_thread is not None and _archive_thread.is_alive():
+        return
+
+    _archive_thread = threading.Thread(target=_archive_loop, args=(days, get_in_use_ids), name='archiver', daemon=True)
+    _archive_thread.start()
+
+
+def _archive_loop(days, get_in_use_ids):
+    cutoff_unix = int(time.time()) - days * 86400
+    archived_ids = set()
+    skipped_ids = set()  # in use or written to since they were found
+    try:
+        while True:
+            in_use_ids = set(get_in_use_ids() if get_in_use_ids else ())
+            context_ids = find_archivable(cutoff_unix, exclude_ids=in_use_ids | archived_ids | skipped_ids)
+            if not context_ids:
+                break
+            for context_id in context_ids:
+                if archive_context(context_id, cutoff_unix, get_in_use_ids):
+                    archived_ids.add(context_id)
+                else:
+                    skipped_ids.add(context_id)
+                time.sleep(ARCHIVE_PAUSE)
+    except Exception as e:
+        logging.error(f'Archiving failed: {e}')
+
+    if archived_ids:
+        logging.debug(f'Archived {len(archived_ids)} contexts')
+
+
+def _tree_ids(schema, context_id):
+    return sql.get_results(f"""
+        WITH RECURSIVE tree(id) AS (
+            SELECT id FROM {schema}.contexts WHERE id = ?
+            UNION ALL
+            SELECT c.id FROM {schema}.contexts c JOIN tree t ON c.parent_id = t.id
+        )
+        SELECT id FROM tree""", (context_id,), return_type='list')
+
+
+def _last_message_unix(tree_ids):
+    placeholders = ', '.join('?' for _ in tree_ids)
+    return sql.get_scalar(f"""
+        SELECT COALESCE(MAX(unix), 0)
+        FROM main.contexts_messages
+        WHERE context_id IN ({placeholders})""", tree_ids)
+
+
+def _tree_conditions(tree_ids):
+    placeholders = ', '.join('?' for _ in tree_ids)
+    return {
+        'contexts': f'id IN ({placeholders})',
+        'contexts_members': f'context_id IN ({placeholders})',
+        'contexts_members_inputs': f'member_id IN (SELECT id FROM {{schema}}.contexts_members WHERE context_id IN ({placeholders}))',
+        'contexts_messages': f'context_id IN ({placeholders})',
+    }
+
+
+def _copy_tree(tx, from_schema, to_schema, tree_ids):
+    conditions = _tree_conditions(tree_ids)
+    for table in ARCHIVED_TABLES:
+        from_columns = {row[1] for row in sql.get_results(f'PRAGMA {from_schema}.table_xinfo("{table}")') if row[6] == 0}
+        to_columns = [row[1] for row in sql.get_results(f'PRAGMA {to_schema}.table_xinfo("{table}")') if row[6] == 0]
+        column_list = ', '.join(f'"{column}"' for column in to_columns if column in from_columns)
+        tx.execute(f"""
+            INSERT OR REPLACE INTO {to_schema}."{table}" ({column_list})
+            SELECT {column_list}
+            FROM {from_schema}."{table}"
+            WHERE {conditions[table].format(schema=from_schema)}""", tree_ids)
+
+
+def _delete_tree(tx, schema, tree_ids):
+    conditions = _tree_conditions(tree_ids)
+    for table in reversed(ARCHIVED_TABLES):
+        tx.execute(f"""
+            DELETE FROM {schema}."{table}"
+            WHERE {conditions[table].format(schema=schema)}""", tree_ids)
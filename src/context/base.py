@@ -2,14 +2,24 @@ import asyncio
 import importlib
 import inspect
 import json
+import threading
+from collections import OrderedDict
 from src.utils import sql, plugin
-from src.context.member import Member
+from src.context import runs
+from src.context.member import Member, INPUT_TYPE_STREAM, count_sentences
 from src.context.messages import MessageHistory
-from src.agent.base import Agent
+from src.agent.base import Agent, load_agents_data
 
 loop = asyncio.new_event_loop()
 asyncio.set_event_loop(loop)
 
+MAX_PARALLEL_MEMBERS = 4  # members of a workflow responding at the same time
+STREAM_INPUT_SENTENCES = 0  # default sentences a member waits for from a stream input before it starts, 0 for all
+MEMBER_TIMEOUT = 600  # seconds a member has to respond before the workflow is stopped with an error
+WORKFLOW_CACHE_SIZE = 8  # recently opened workflows kept with their agents, so going back to a chat doesn't rebuild them
+_workflow_cache = OrderedDict()  # {context_id: Workflow}, least recently used first
+_workflow_cache_lock = threading.Lock()  # the archiver reads the cached ids from its own thread
+
 
 # Helper function to load behavior module dynamically todo - move to utils
 def load_behaviour_module(group_key):
@@ -21,6 +31,33 @@ def load_behaviour_module(group_key):
         return None
 
 
+def get_run_order(members):
+    """
+    Returns the members of {member_id: member} ordered so each comes after its inputs, otherwise in their given order.
+    Raises an exception if the inputs of some members form a cycle, as they would wait on each other forever.
+    """
+    pending_inputs = {m_id: {i_id for i_id in member.inputs if i_id in members} for m_id, member in members.items()}
+    dependents = {}
+    for m_id, input_ids in pending_inputs.items():
+        for input_id in input_ids:
+            dependents.setdefault(input_id, []).append(m_id)
+
+    order = []
+    ready = [m_id for m_id, input_ids in pending_inputs.items() if not input_ids]
+    while ready:
+        m_id = ready.pop(0)
+        order.append(m_id)
+        for dependent_id in dependents.get(m_id, []):
+            pending_inputs[dependent_id].discard(m_id)
+            if not pending_inputs[dependent_id]:
+                ready.append(dependent_id)
+
+    if len(order) < len(members):
+        cycle_names = [getattr(members[m_id], 'name', '') or str(m_id) for m_id in members if m_id not in order]
+        raise Exception(f"Circular member inputs: {', '.join(cycle_names)}")
+    return [members[m_id] for m_id in order]
+
+
 def get_common_group_key(members):
     """Get all distinct group_keys and if there's only one, return it, otherwise return empty key"""
     group_keys = set(getattr(member, 'group_key', '') for member in members.values())
@@ -29,6 +66,52 @@ def get_common_group_key(members):
     return ''
 
 
+def get_workflow(main, context_id=None):
+    """
+    Returns the workflow of `context_id`, reloaded from the cache if it was opened recently, otherwise a new one.
+    With no `context_id` it's the workflow `Workflow` picks, e.g. the latest chat.
+    """
+    workflow = _workflow_cache.get(context_id) if context_id is not None else None
+    if workflow is not None and workflow.main is main:
+        if workflow.responding:
+            # Its members are still responding in another thread, it's reloaded by `finish_response`
+            workflow.reload_pending = True
+        else:
+            workflow.load()  # agents whose config is unchanged are kept
+    else:
+        workflow = Workflow(main=main, context_id=context_id)
+
+    evicted = []
+    with _workflow_cache_lock:
+        _workflow_cache[workflow.id] = workflow
+        _workflow_cache.move_to_end(workflow.id)
+        while len(_workflow_cache) > WORKFLOW_CACHE_SIZE:
+            # A workflow that's still responding is kept until it's finished
+            evict_id = next((c_id for c_id, w in _workflow_cache.items() if not w.responding and w is not workflow), None)
+            if evict_id is None:
+                break
+            evicted.append(_workflow_cache.pop(evict_id))
+    for evicted_workflow in evicted:
+        evicted_workflow.unload()
+    return workflow
+
+
+def get_cached_workflow_ids():
+    """Returns the context ids of the cached workflows, they're in use and mustn't be archived"""
+    with _workflow_cache_lock:
+        return set(_workflow_cache)
+
+
+def clear_workflow_cache(context_ids=None):
+    """Drops the cached workflows of `context_ids`, or all of them, e.g. after their contexts are deleted"""
+    with _workflow_cache_lock:
+        context_ids = list(_workflow_cache if context_ids is None else context_ids)
+        workflows = [_workflow_cache.pop(context_id, None) for context_id in context_ids]
+    for workflow in workflows:
+        if workflow is not None:
+            workflow.unload()
+
+
 class Workflow(Member):
     def __init__(self, main, context_id=None, agent_id=None, inputs=None):
         super().__init__(main, workflow=None, m_id=0, inputs=inputs)
@@ -37,7 +120,11 @@ class Workflow(Member):
 
         self.loop = asyncio.get_event_loop()
         self.responding = False
+        self.reload_pending = False  # `get_workflow` reopened it while responding
         self.stop_requested = False
+        # Set for a rerun, members whose inputs haven't changed replay what they saved, except `rerun_member_ids`
+        self.reuse_runs = False
+        self.rerun_member_ids = set()
 
         self.id = context_id
         self.chat_name = ''
@@ -89,52 +176,96 @@ class Workflow(Member):
         self.message_history.load()
         self.chat_title = sql.get_scalar("SELECT summary FROM contexts WHERE id = ?", (self.id,))
 
+    def finish_response(self):
+        """Called on the UI thread when a response finishes or fails, does a reload deferred while it was responding"""
+        self.responding = False
+        if self.reload_pending:
+            self.reload_pending = False
+            self.load()
+
     def load_members(self):
         context_members = sql.get_results("""
             SELECT 
                 cm.id AS member_id,
                 cm.agent_id,
                 cm.agent_config,
-                cm.del
+                cm.del,
+                cm.info_name,
+                cm.info_use_plugin
             FROM contexts_members cm
             WHERE cm.context_id = ?
             ORDER BY 
                 cm.loc_x, cm.loc_y""",
             params=(self.id,))
 
+        loaded_members = self.members
         self.members = {}
-        self.member_configs = {}
+        self.member_configs = {member_id: json.loads(agent_config) for member_id, _, agent_config, *_ in context_members}
+
+        # Load participant inputs
+        inputs = {}
+        input_types = {}
+        for member_id, input_member_id, input_type in sql.get_results("""
+            SELECT
+                cmi.member_id,
+                cmi.input_member_id,
+                cmi.type
+            FROM contexts_members_inputs cmi
+            JOIN contexts_members cm
+                ON cm.id = cmi.member_id
+            WHERE cm.context_id = ?""", params=(self.id,)):
+            inputs.setdefault(member_id, []).append(input_member_id)
+            input_types.setdefault(member_id, {})[input_member_id] = input_type
+
+        agents_data = load_agents_data([self.member_configs[member_id]
+                                        for member_id, _, _, deleted, *_ in context_members if deleted != 1])
+        agents_data_json = json.dumps(agents_data, sort_keys=True)
 
         # unique_members = set()
-        for member_id, agent_id, agent_config, deleted in context_members:
-            member_config = json.loads(agent_config)
-            self.member_configs[member_id] = member_config
+        for member_id, agent_id, agent_config, deleted, _, use_plugin in context_members:
+            member_config = self.member_configs[member_id]
             if deleted == 1:
                 continue
 
-            # Load participant inputs
-            member_inputs = sql.get_results("""
-                SELECT 
-                    input_member_id
-                FROM contexts_members_inputs
-                WHERE member_id = ?""", params=(member_id,), return_type='list')
+            # Keep the loaded agent if nothing it was loaded from has changed
+            member_inputs = inputs.get(member_id, [])
+            member_input_types = input_types.get(member_id, {})
+            fingerprint = (agent_id, use_plugin, tuple(member_input_types.items()), agent_config, agents_data_json)
+            agent = loaded_members.pop(member_id, None)
+            if agent is not None and agent.fingerprint == fingerprint:
+                agent.last_output = ''
+                self.members[member_id] = agent
+                continue
+            if agent is not None:
+                agent.unload()
 
             # Instantiate the agent
-            use_plugin = member_config.get('info.use_plugin', None)
             kwargs = dict(main=self.main, agent_id=agent_id, member_id=member_id, workflow=self, wake=True, inputs=member_inputs)
             agent = plugin.get_plugin_agent_class(use_plugin, kwargs) or Agent(**kwargs)
+            agent.input_types = member_input_types
+            agent.preloaded_data = {**agents_data, 'agent_config': member_config}
             agent.load_agent()  # this can't be in the init to make it overridable
+            agent.fingerprint = fingerprint
             # member = Member(self, member_id, agent, member_inputs)
             self.members[member_id] = agent  # member
             # unique_members.add(member_config.get('general.name', 'Assistant'))
 
         active_members = {m for m in context_members if not m[3] == 1}
         if len(active_members) == 1:
-            self.chat_name = json.loads(active_members.pop()[2]).get('info.name', 'Assistant')
+            member_name = active_members.pop()[4]
+            self.chat_name = member_name if member_name is not None else 'Assistant'
         else:
             self.chat_name = f'{len(active_members)} members'
         self.update_behaviour()
 
+        for agent in loaded_members.values():  # removed members
+            agent.unload()
+
+    def unload(self):
+        for member in self.members.values():
+            member.unload()
+        self.members = {}
+
     def update_behaviour(self):
         """Update the behaviour of the context based on the common key"""
         common_group_key = get_common_group_key(self.members)
@@ -151,8 +282,8 @@ class Workflow(Member):
         """The entry response method for the member."""
         self.behaviour.start()
 
-    def save_message(self, role, content, member_id=None, log_obj=None):
-        """Saves a message to the database and returns the message_id"""
+    def save_message(self, role, content, member_id=None, log_obj=None, cached=False):
+        """Saves a message to the database and returns the message_id, `cached` if the response was from the output cache"""
         if role == 'output':
             content = 'The code executed without any output' if content.strip() == '' else content
 
@@ -164,70 +295,156 @@ class Workflow(Member):
         if member is not None:  # and role == 'assistant':
             member.last_output = content
 
-        return self.message_history.add(role, content, member_id=member_id, log_obj=log_obj)
+        new_msg = self.message_history.add(role, content, member_id=member_id, log_obj=log_obj, cached=cached)
+        if member is not None and member.run_messages is not None:
+            member.run_messages.append(new_msg)
+        return new_msg
 
     def deactivate_all_branches_with_msg(self, msg_id):
-        print("CALLED deactivate_all_branches_with_msg: ", msg_id)
-        sql.execute("""
-            UPDATE contexts
-            SET active = 0
-            WHERE branch_msg_id = (
-                SELECT branch_msg_id
-                FROM contexts
-                WHERE id = (
-                    SELECT context_id
-                    FROM contexts_messages
-                    WHERE id = ?
-                )
-            );""", (msg_id,))
+        """Deactivates the branch of `msg_id` and its siblings"""
+        branch_tree = self.message_history.branch_tree
+        context_id = branch_tree.get_context_of_msg(msg_id)
+        sibling_ids = branch_tree.get_sibling_ids(context_id)
+        if not sibling_ids:
+            return
+        for sibling_id in sibling_ids:
+            branch_tree.set_active(sibling_id, False)
+        sql.execute("UPDATE contexts SET active = 0 WHERE branch_msg_id = ?",
+                    (branch_tree.branch_msg_ids[context_id],))
 
     def activate_branch_with_msg(self, msg_id):
-        print("CALLED activate_branch_with_msg: ", msg_id)
-        sql.execute("""
-            UPDATE contexts
-            SET active = 1
-            WHERE id = (
-                SELECT context_id
-                FROM contexts_messages
-                WHERE id = ?
-            );""", (msg_id,))
+        branch_tree = self.message_history.branch_tree
+        context_id = branch_tree.get_context_of_msg(msg_id)
+        if context_id is None:
+            return
+        branch_tree.set_active(context_id, True)
+        sql.execute("UPDATE contexts SET active = 1 WHERE id = ?", (context_id,))
+
+    def new_branch(self, branch_msg_id):
+        """Starts a new branch from `branch_msg_id` and makes it the leaf, the next saved message goes into it"""
+        branch_tree = self.message_history.branch_tree
+        parent_id = branch_tree.get_context_of_msg(branch_msg_id)
+        context_id = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)", (parent_id, branch_msg_id))
+        branch_tree.add_context(context_id, parent_id, branch_msg_id)
+        self.leaf_id = context_id
 
 
 class WorkflowBehaviour:
-    # Execute in order of loc_x, and when all inputs are finished
-    
+    # Execute each member when all its inputs are finished, members that don't depend on each other in parallel
+
     def __init__(self, workflow):
         self.workflow = workflow
+        self.turn_key = None  # the message the members respond to, see `runs.get_inputs_hash`
 
     def start(self):
-        for member in self.workflow.members.values():
-            member.response_task = self.workflow.loop.create_task(self.run_member(member))
+        run_order = get_run_order(self.workflow.members)  # raises before anything runs if the inputs have a cycle
+        self.workflow.stop_requested = False
+        messages = self.workflow.message_history.messages
+        self.turn_key = (messages[-2].id if len(messages) > 1 else None,
+                         messages[-1].role if messages else None,
+                         messages[-1].content if messages else None)
+        semaphore = asyncio.Semaphore(MAX_PARALLEL_MEMBERS)
+        for member in run_order:
+            member.partial_output = None
+            member.output_event = asyncio.Event()
+            member.run_messages = None
+            member.response_task = self.workflow.loop.create_task(self.run_member(member, semaphore))
 
         self.workflow.responding = True
+        tasks = [m.response_task for m in run_order]
         try:
-            t = asyncio.gather(*[m.response_task for m in self.workflow.members.values()])
-            self.workflow.loop.run_until_complete(t)
+            self.workflow.loop.run_until_complete(asyncio.gather(*tasks))
         except asyncio.CancelledError:
             pass  # task was cancelled, so we ignore the exception
         except Exception as e:
             # self.main.finished_signal.emit()
+            # Cancel the other members, plugin agents streaming in an executor stop at their next chunk
+            self.workflow.stop_requested = True
+            for task in tasks:
+                task.cancel()
+            self.workflow.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
             raise e
+        finally:
+            self.workflow.reuse_runs = False
+            self.workflow.rerun_member_ids = set()
 
     def stop(self):
         self.workflow.stop_requested = True
         for member in self.workflow.members.values():
             if member.response_task is not None:
-                member.response_task.cancel()
+                # The loop runs in the responding thread
+                self.workflow.loop.call_soon_threadsafe(member.response_task.cancel)
 
-    async def run_member(self, member):
+    async def run_member(self, member, semaphore):
         try:
-            # todo - throw exception for circular references
             if member.inputs:
-                await asyncio.gather(*[self.workflow.members[m_id].response_task
+                await asyncio.gather(*[self.wait_for_input(member, self.workflow.members[m_id])
                                        for m_id in member.inputs
                                        if m_id in self.workflow.members])
 
-            await member.run_member()
+            async with semaphore:
+                if self.workflow.stop_requested:
+                    return
+                try:
+                    await self.respond(member)
+                finally:
+                    member.partial_output = None
+                    member.output_event.set()  # wakes the members waiting on its first sentences
         except asyncio.CancelledError:
             pass  # task was cancelled, so we ignore the exception
 
+    async def respond(self, member):
+        """
+        Runs the member and records what it saved for its inputs. On a rerun, a member whose inputs are the same as
+        in a recorded run saves the same messages again instead, only the members after a change run again.
+        A stream input that's still responding is writing new output, so the member runs, and its run is recorded
+        with the input's full output once that has finished.
+        """
+        streaming_inputs = [input_member for input_member in map(self.workflow.members.get, member.inputs)
+                            if input_member is not None and input_member.partial_output is not None]
+
+        member.run_messages = []
+        if self.workflow.reuse_runs and member.m_id not in self.workflow.rerun_member_ids and not streaming_inputs:
+            run_messages = runs.get_run_messages(member.m_id, self.get_inputs_hash(member))
+            if run_messages is not None:
+                for role, content, log in run_messages:
+                    if member.main is not None:
+                        member.main.new_sentence_signal.emit(role, member.m_id, content)
+                    self.workflow.save_message(role, content, member.m_id, log or None)
+                return
+
+        member.partial_output = ''
+        try:
+            await asyncio.wait_for(member.run_member(), timeout=MEMBER_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise Exception(f"{getattr(member, 'name', '') or 'Member'} did not respond within {MEMBER_TIMEOUT} seconds")
+        if streaming_inputs:
+            await asyncio.wait([input_member.response_task for input_member in streaming_inputs])
+        if not self.workflow.stop_requested:  # a stopped member saved only part of its response, or nothing
+            runs.save_run(member.m_id, self.get_inputs_hash(member), [msg.id for msg in member.run_messages])
+
+    def get_inputs_hash(self, member):
+        """Returns the hash of the turn and what the member's finished inputs saved in this run"""
+        input_outputs = {}
+        for input_id in member.inputs:
+            input_member = self.workflow.members.get(input_id)
+            if input_member is not None:
+                input_outputs[input_id] = '\n'.join(msg.content for msg in input_member.run_messages or [])
+        return runs.get_inputs_hash(self.turn_key, input_outputs)
+
+    async def wait_for_input(self, member, input_member):
+        """
+        Waits until `input_member` has finished, or for a stream input, until it has written the first
+        `group.stream_input_sentences` sentences. The member then starts with what the input has written so far,
+        and doesn't see the rest, so by default (0) it waits for the full output.
+        """
+        member_config = self.workflow.member_configs.get(member.m_id, {})
+        num_sentences = member_config.get('group.stream_input_sentences', STREAM_INPUT_SENTENCES)
+        if member.input_types.get(input_member.m_id) == INPUT_TYPE_STREAM and num_sentences > 0:
+            while not input_member.response_task.done() \
+                    and count_sentences(input_member.partial_output or '') < num_sentences:
+                input_member.output_event.clear()
+                await input_member.output_event.wait()
+            if not input_member.response_task.done():
+                return
+        await input_member.response_task  # skips the member if the input was cancelled
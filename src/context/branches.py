@@ -0,0 +1,124 @@
+from src.utils import sql
+
+
+class BranchTree:
+    """
+    In-memory index of the contexts of a conversation, and the messages they branch from.
+    Loaded with one query, then kept in step with the db by the methods that change it.
+    """
+    def __init__(self, root_id=None):
+        self.root_id = root_id
+        self.clear()
+
+    def clear(self):
+        self.parents = {}  # {context_id: parent_id}
+        self.branch_msg_ids = {}  # {context_id: msg id in the parent it branches from}
+        self.active = {}  # {context_id: bool}
+        self.children = {}  # {context_id: [child context ids, ascending]}
+        self.first_msg_ids = {}  # {context_id: first msg id}, only contexts with messages
+        self.msg_contexts = {}  # {first msg id: context_id}
+        self.siblings = {}  # {branch_msg_id: [context ids branching from it, ascending]}
+
+    def load(self, root_id=None):
+        if root_id is not None:
+            self.root_id = root_id
+        self.clear()
+
+        rows = sql.get_results("""
+            WITH RECURSIVE context_tree(id, parent_id, branch_msg_id, active) AS (
+                SELECT id, parent_id, branch_msg_id, active
+                FROM contexts
+                WHERE id = ?
+                UNION ALL
+                SELECT c.id, c.parent_id, c.branch_msg_id, c.active
+                FROM contexts c
+                JOIN context_tree ct ON c.parent_id = ct.id
+            )
+            SELECT
+                ct.id,
+                ct.parent_id,
+                ct.branch_msg_id,
+                ct.active,
+                (SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = ct.id) AS first_msg_id
+            FROM context_tree ct
+            ORDER BY ct.id""", (self.root_id,))
+        for context_id, parent_id, branch_msg_id, active, first_msg_id in rows:
+            self.add_context(context_id, parent_id if context_id != self.root_id else None, branch_msg_id, active)
+            if first_msg_id is not None:
+                self.add_message(context_id, first_msg_id)
+
+    def add_context(self, context_id, parent_id, branch_msg_id, active=True):
+        """Adds a context with a higher id than any in the tree"""
+        self.parents[context_id] = parent_id
+        self.branch_msg_ids[context_id] = branch_msg_id
+        self.active[context_id] = bool(active)
+        self.children[context_id] = []
+        if parent_id is not None:
+            self.children[parent_id].append(context_id)
+        if branch_msg_id is not None:
+            self.siblings.setdefault(branch_msg_id, []).append(context_id)
+
+    def add_message(self, context_id, msg_id):
+        """Records `msg_id` as the first message of `context_id`, if it has none yet"""
+        if context_id not in self.parents or context_id in self.first_msg_ids:
+            return
+        self.first_msg_ids[context_id] = msg_id
+        self.msg_contexts[msg_id] = context_id
+
+    def set_active(self, context_id, active):
+        if context_id in self.active:
+            self.active[context_id] = bool(active)
+
+    def get_leaf_id(self):
+        """Follows the newest active child from the root, like `MessageHistory` shows the conversation"""
+        context_id = self.root_id
+        while True:
+            child_id = next((c_id for c_id in reversed(self.children.get(context_id, [])) if self.active[c_id]), None)
+            if child_id is None:
+                return context_id
+            context_id = child_id
+
+    def get_path(self, context_id):
+        """Returns [(context_id, msg id its messages end before)] from `context_id` up to the root"""
+        path = []
+        end_msg_id = None
+        while context_id is not None:
+            path.append((context_id, end_msg_id))
+            end_msg_id = self.branch_msg_ids.get(context_id)
+            context_id = self.parents.get(context_id)
+        return path
+
+    def get_context_of_msg(self, msg_id):
+        context_id = self.msg_contexts.get(msg_id)
+        if context_id is None:
+            context_id = sql.get_scalar("SELECT context_id FROM contexts_messages WHERE id = ?", (msg_id,))
+        return context_id
+
+    def get_sibling_ids(self, context_id):
+        """Returns the ids of the contexts branching from the same message as `context_id`, including itself"""
+        branch_msg_id = self.branch_msg_ids.get(context_id)
+        if branch_msg_id is None:
+            return []
+        return self.siblings[branch_msg_id]
+
+    def get_branch_entry(self, msg_id):
+        """
+        Returns {branch_msg_id: [first msg ids of the branches]} if `msg_id` has branches or is the first message
+        of a branch, otherwise an empty dict.
+        """
+        # A message that starts a branch and has been branched from itself belongs to its own branch point first
+        branch_msg_id = self.branch_msg_ids.get(self.msg_contexts.get(msg_id))
+        if branch_msg_id is None:
+            if msg_id not in self.siblings:
+                return {}
+            branch_msg_id = msg_id
+        first_msg_ids = self.get_branch_first_msg_ids(branch_msg_id)
+        return {branch_msg_id: first_msg_ids} if first_msg_ids else {}
+
+    def get_branches(self):
+        """Returns {branch_msg_id: [first msg ids of the branches]} of the whole tree"""
+        branches = {branch_msg_id: self.get_branch_first_msg_ids(branch_msg_id) for branch_msg_id in self.siblings}
+        return {branch_msg_id: first_msg_ids for branch_msg_id, first_msg_ids in branches.items() if first_msg_ids}
+
+    def get_branch_first_msg_ids(self, branch_msg_id):
+        return [self.first_msg_ids[c_id] for c_id in self.siblings.get(branch_msg_id, []) if c_id in self.first_msg_ids]
@@ -1,5 +1,18 @@
+import re
 from abc import abstractmethod
 
+# contexts_members_inputs.type
+INPUT_TYPE_MESSAGE = 0
+INPUT_TYPE_CONTEXT = 1
+INPUT_TYPE_STREAM = 2  # the member starts once the input has written its first sentences, not when it's finished
+
+SENTENCE_END = re.compile(r'[.!?\n]+\s')
+
+
+def count_sentences(text):
+    """Counts the finished sentences of a response in progress"""
+    return len(SENTENCE_END.findall(text))
+
 
 class Member:
     def __init__(self, main, workflow, m_id, inputs):
@@ -8,10 +21,25 @@ class Member:
         self.m_id = m_id
         # self.agent = agent
         self.inputs = inputs if inputs else []
+        self.input_types = {}  # {input member id: INPUT_TYPE_*}
         self.response_task = None
         self.last_output = ''
+        self.partial_output = None  # what the member has written so far while it responds, otherwise None
+        self.output_event = None  # set by `WorkflowBehaviour` when `partial_output` grows, or the member finishes
+        self.run_messages = None  # [Message] the member saved in the current run
 
     @abstractmethod
     def run_member(self):
         """The entry response method for the member."""
         pass
+
+    def add_partial_output(self, chunk):
+        if self.partial_output is None:
+            return
+        self.partial_output += chunk
+        if self.output_event is not None:
+            self.output_event.set()
+
+    def unload(self):
+        """Releases what the member holds, called once it's replaced or its workflow is dropped"""
+        pass
@@ -1,162 +1,218 @@
 import json
 import logging
+import sys
 import threading
+from bisect import bisect_left
+from functools import lru_cache
 
 import litellm
 import tiktoken
+from src.context import summaries
+from src.context.branches import BranchTree
 from src.utils import sql
 
+DEFAULT_TOKENIZER_MODEL = 'gpt-3.5-turbo'
+FALLBACK_ENCODING = 'cl100k_base'  # for models tiktoken doesn't know, e.g. non-openai models
+MESSAGE_TOKEN_OVERHEAD = 4  # tokens the chat format adds around each message
+MESSAGE_PAGE_SIZE = 100  # messages loaded when a chat is opened, and per page when scrolling back
+MAX_LOADED_MESSAGES = 1000  # older pages past this are evicted once the newest messages are in view again
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name=DEFAULT_TOKENIZER_MODEL):
+    """Returns the tiktoken encoding of `model_name`, each encoding is only built once"""
+    model_name = (model_name or DEFAULT_TOKENIZER_MODEL).split('/')[-1]  # strip a litellm provider prefix
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+@lru_cache(maxsize=64)
+def parse_preloaded_msgs(preload_data):
+    """Returns ((role, content), ...) of a member's `chat.preload.data`"""
+    return tuple((msg['role'], msg['content']) for msg in json.loads(preload_data))
+
+
+_member_ids = {}  # shared member id objects, a history of one chat repeats the same few ids
+
+# Counted but not yet saved, {msg_id: (token_count, encoding_name)}, written together by `save_token_counts`
+_unsaved_token_counts = {}
+_unsaved_token_counts_lock = threading.Lock()
+
+
+def save_token_counts():
+    """Queues one write of every token count counted since the last call, to be reused on the next load"""
+    with _unsaved_token_counts_lock:
+        if not _unsaved_token_counts:
+            return
+        rows = [(count, encoding_name, msg_id) for msg_id, (count, encoding_name) in _unsaved_token_counts.items()]
+        _unsaved_token_counts.clear()
+    sql.execute_many_deferred("UPDATE contexts_messages SET token_count = ?, tokenizer = ? WHERE id = ?", rows)
+
 
 class Message:
-    def __init__(self, msg_id, role, content, member_id=None, embedding_id=None):
+    # Loaded for every message of a chat, so without a per-instance __dict__
+    __slots__ = ('id', 'role', 'content', 'member_id', 'embedding_id', 'tokenizer', '_token_count', '_other_token_counts',
+                 'cached')
+
+    def __init__(self, msg_id, role, content, member_id=None, embedding_id=None, token_count=None, tokenizer=None,
+                 cached=False):
         self.id = msg_id
-        self.role = role
+        self.role = sys.intern(role) if role else role
         self.content = content
-        self.member_id = member_id
-        self.token_count = len(tiktoken.encoding_for_model("gpt-3.5-turbo").encode(content))
+        self.member_id = _member_ids.setdefault(member_id, member_id)
         # self.unix_time = unix_time or int(time.time())
         self.embedding_id = embedding_id
         # if self.embedding_id and isinstance(self.embedding, str):
         #     self.embedding = embeddings.string_embeddings_to_array(self.embedding)
-        self.embedding_data = None
         # if self.embedding_id is None:
         #     if role == 'user' or role == 'assistant' or role == 'request' or role == 'result':
         #         self.embedding_id, self.embedding_data = embeddings.get_embedding(content)
 
+        # Counted on first use. The db stores the count of the encoding that was counted last,
+        # counts of other encodings are only kept in memory, {encoding_name: token_count}
+        self.tokenizer = tokenizer if token_count is not None else None
+        self._token_count = token_count if tokenizer else None
+        self._other_token_counts = None
+        self.cached = bool(cached)  # the response was from the output cache, the model wasn't called
+
+    @property
+    def token_count(self):
+        return self.get_token_count()
+
+    def get_token_count(self, model_name=DEFAULT_TOKENIZER_MODEL):
+        encoding = get_encoding(model_name)
+        if encoding.name == self.tokenizer and self._token_count is not None:
+            return self._token_count
+        if self._other_token_counts and encoding.name in self._other_token_counts:
+            return self._other_token_counts[encoding.name]
+
+        count = len(encoding.encode(self.content))
+        if self._token_count is not None:
+            if self._other_token_counts is None:
+                self._other_token_counts = {}
+            self._other_token_counts[self.tokenizer] = self._token_count
+        self.tokenizer = encoding.name
+        self._token_count = count
+        if self.id:
+            # Cache it for the next load, saved with the others counted by the same `get` or `load`
+            with _unsaved_token_counts_lock:
+                _unsaved_token_counts[self.id] = (count, encoding.name)
+        return count
+
 
 class MessageHistory:
     def __init__(self, workflow):
-        self.thread_lock = threading.Lock()
+        self.thread_lock = threading.RLock()  # reentrant, as `get` loads older pages under it
         # self.msg_id_thread_lock = threading.Lock()
         self.workflow = workflow
-        self.branches = {}  # {branch_msg_id: [child_msg_ids]}
+        self.branch_tree = BranchTree()
         self.messages = []  # [Message(m['id'], m['role'], m['content']) for m in (messages or [])]
+        self.loaded_leaf_id = None  # leaf that `messages` were loaded for
+        self.has_older = False  # whether older messages of the branch exist than are loaded
+        self.token_prefix_sums = {}  # {(encoding_name, incl_roles): running token totals of `messages`}
+        self.member_views = {}  # {(calling_member_id, user_members, llm_format): {msg_id: formatted msg}}
 
-        self.msg_id_buffer = []
         # self.load()
 
-    def load(self):
-        self.workflow.leaf_id = sql.get_scalar("""
-            WITH RECURSIVE leaf_contexts AS (
-                SELECT 
-                    c1.id, 
-                    c1.parent_id, 
-                    c1.active 
-                FROM contexts c1 
-                WHERE c1.id = ?
-                UNION ALL
-                SELECT 
-                    c2.id, 
-                    c2.parent_id, 
-                    c2.active 
-                FROM contexts c2 
-                JOIN leaf_contexts lc ON lc.id = c2.parent_id 
-                WHERE 
-                    c2.id = (
-                        SELECT MAX(c3.id) FROM contexts c3 WHERE c3.parent_id = lc.id AND c3.active = 1
-                    )
-            )
-            SELECT id
-            FROM leaf_contexts 
-            ORDER BY id DESC 
-            LIMIT 1;""", (self.workflow.id,))
+    @property
+    def branches(self):
+        """{branch_msg_id: [first msg ids of the branches]}"""
+        return self.branch_tree.get_branches()
 
+    def load(self, reload_tree=True):
+        """Loads the messages of the active branch, `reload_tree=False` uses the branch tree already in memory"""
+        if reload_tree or self.branch_tree.root_id != self.workflow.id:
+            self.branch_tree.load(self.workflow.id)
+        self.workflow.leaf_id = self.branch_tree.get_leaf_id()
         # logging.debug(f"LEAF ID SET TO {self.workflow.leaf_id} BY message_history.load")
-        self.load_branches()
         self.load_messages()
-        self.load_msg_id_buffer()
-
-    def load_branches(self):
-        root_id = self.workflow.id
-        result = sql.get_results("""
-            WITH RECURSIVE context_chain(id, parent_id, branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id
-              FROM contexts
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id
-              FROM contexts c
-              JOIN context_chain cc ON c.parent_id = cc.id
-            )
-            SELECT
-                cc.branch_msg_id,
-                group_concat((SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = cc.id)) AS context_set
-            FROM context_chain cc
-            WHERE cc.branch_msg_id IS NOT null
-            GROUP BY cc.branch_msg_id;
-        """, (root_id,), return_type='dict')
-        self.branches = {int(k): [int(i) for i in v.split(',')] for k, v in result.items() if v}
-
-    # active_leaf_id = '''
-    # '''
-
-    # backwards_loader_w_leaf = '''
-    # WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
-    #   SELECT id, parent_id, branch_msg_id,
-    #          null
-    #   FROM contexts
-    #   WHERE id = ?
-    #   UNION ALL
-    #   SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
-    #   FROM context_path cp
-    #   JOIN contexts c ON cp.parent_id = c.id
-    # )
-    # SELECT m.id, m.role, m.msg, m.agent_id, m.context_id, m.embedding_id
-    # FROM contexts_messages m
-    # JOIN context_path cp ON m.context_id = cp.context_id
-    # WHERE (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
-    # ORDER BY m.id
-    # '''
+        save_token_counts()
 
     def load_messages(self, refresh=False):
-        last_msg_id = self.messages[-1].id if len(self.messages) > 0 and refresh else 0
-
-        msg_log = sql.get_results("""
-            WITH RECURSIVE context_path(context_id, parent_id, branch_msg_id, prev_branch_msg_id) AS (
-              SELECT id, parent_id, branch_msg_id, 
-                     null
-              FROM contexts 
-              WHERE id = ?
-              UNION ALL
-              SELECT c.id, c.parent_id, c.branch_msg_id, cp.branch_msg_id
-              FROM context_path cp
-              JOIN contexts c ON cp.parent_id = c.id
-            )
-            SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id
+        """Loads the newest page of messages of the leaf's branch, or with `refresh` the messages after the last loaded"""
+        if self.workflow.leaf_id not in self.branch_tree.parents:
+            self.branch_tree.load(self.workflow.id)
+
+        if refresh and self.messages:
+            new_messages = self.fetch_newer(self.messages[-1].id)
+            self.messages.extend(new_messages)
+            return
+
+        page, self.has_older = self.fetch_older(None, MESSAGE_PAGE_SIZE)
+        self.messages = page
+        self.loaded_leaf_id = self.workflow.leaf_id
+        self.token_prefix_sums.clear()
+        self.member_views.clear()
+
+    def load_older(self, limit=MESSAGE_PAGE_SIZE):
+        """Loads the page of messages before the oldest loaded one, returns the loaded messages, oldest first"""
+        with self.thread_lock:
+            if not self.has_older:
+                return []
+            before_id = self.messages[0].id if self.messages else None
+            page, self.has_older = self.fetch_older(before_id, limit)
+            self.messages[:0] = page
+            self.token_prefix_sums.clear()  # the cached totals are by position
+            return page
+
+    def evict_older(self, keep=MAX_LOADED_MESSAGES):
+        """Drops all but the newest `keep` loaded messages, they're loaded again with `load_older` if needed"""
+        with self.thread_lock:
+            if len(self.messages) <= keep:
+                return
+            del self.messages[:len(self.messages) - keep]
+            self.has_older = True
+            self.token_prefix_sums.clear()
+            self.member_views.clear()
+
+    def fetch_older(self, before_id, limit):
+        """
+        Returns ([up to `limit` messages of the leaf's branch before `before_id`, oldest first], whether there are more).
+        The messages of a context on the path are all newer than those of its parent, so the path is read from the leaf
+        up, with a keyset query per context until the page is full.
+        """
+        rows = []
+        for context_id, end_msg_id in self.branch_tree.get_path(self.workflow.leaf_id):
+            upper_ids = [msg_id for msg_id in (end_msg_id, before_id) if msg_id is not None]
+            rows.extend(sql.get_results("""
+                SELECT id, role, msg, member_id, embedding_id, token_count, tokenizer, cached
+                FROM contexts_messages
+                WHERE context_id = ?
+                    AND id < ?
+                ORDER BY id DESC
+                LIMIT ?""", (context_id, min(upper_ids) if upper_ids else sys.maxsize, limit + 1 - len(rows))))
+            if len(rows) > limit:
+                break
+
+        has_older = len(rows) > limit
+        return [Message(*row) for row in reversed(rows[:limit])], has_older
+
+    def fetch_newer(self, after_id):
+        """Returns the messages of the leaf's branch after `after_id`, oldest first"""
+        # Each context on the path from the leaf shows its messages up to where its child branches off
+        context_path = self.branch_tree.get_path(self.workflow.leaf_id)
+        path_conditions = ' OR '.join(
+            '(m.context_id = ? AND m.id < ?)' if end_msg_id is not None else '(m.context_id = ?)'
+            for _, end_msg_id in context_path
+        )
+        path_params = [param for context_id, end_msg_id in context_path
+                       for param in ((context_id, end_msg_id) if end_msg_id is not None else (context_id,))]
+
+        msg_log = sql.get_results(f"""
+            SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id, m.token_count, m.tokenizer, m.cached
             FROM contexts_messages m
-            JOIN context_path cp ON m.context_id = cp.context_id
             WHERE m.id > ?
-                AND (cp.prev_branch_msg_id IS NULL OR m.id < cp.prev_branch_msg_id)
-            ORDER BY m.id;""", (self.workflow.leaf_id, last_msg_id,))
-
-        # print(f"FETCHED {len(msg_log)} MESSAGES", )
-        if refresh:
-            self.messages.extend([Message(msg_id, role, content, member_id, embedding_id)
-                                  for msg_id, role, content, member_id, embedding_id in msg_log])
-        else:
-            self.messages = [Message(msg_id, role, content, member_id, embedding_id)
-                             for msg_id, role, content, member_id, embedding_id in msg_log]
-
-    def load_msg_id_buffer(self):
-        # with self.msg_id_thread_lock:
-        self.msg_id_buffer = []
-        last_msg_id = sql.get_scalar("SELECT seq FROM sqlite_sequence WHERE name = 'contexts_messages'")
-        last_msg_id = last_msg_id if last_msg_id is not None else 0
-        for msg_id in range(last_msg_id + 1, last_msg_id + 100):
-            self.msg_id_buffer.append(msg_id)
-
-    def get_next_msg_id(self):
-        # with self.msg_id_thread_lock:
-        last_id = self.msg_id_buffer[-1]
-        self.msg_id_buffer.append(last_id + 1)
-        return self.msg_id_buffer.pop(0)
-
-    def add(self, role, content, embedding_id=None, member_id=None, log_obj=None):
-        print("CALLED message_history.add")
+                AND ({path_conditions})
+            ORDER BY m.id;""", (after_id, *path_params))
+        return [Message(*row) for row in msg_log]
+
+    def add(self, role, content, embedding_id=None, member_id=None, log_obj=None, cached=False):
         with self.thread_lock:
             # max_id = sql.get_scalar("SELECT COALESCE(MAX(id), 0) FROM contexts_messages")
-            next_id = self.get_next_msg_id()
-            new_msg = Message(next_id, role, content, embedding_id=embedding_id, member_id=member_id)
+            next_id = sql.reserve_rowid('contexts_messages')
+            new_msg = Message(next_id, role, content, embedding_id=embedding_id, member_id=member_id, cached=cached)
 
             if self.workflow is None:
                 raise Exception("No context ID set")
@@ -181,10 +237,16 @@ class MessageHistory:
                 else:
                     raise Exception("log_obj must be a string or litellm.utils.Logging object")
 
-            sql.execute \
-                ("INSERT INTO contexts_messages (context_id, member_id, role, msg, embedding_id, log) VALUES (?, ?, ?, ?, ?, ?)",
-                        (self.workflow.leaf_id, member_id, role, content, new_msg.embedding_id, json_str))
-            self.load_messages()
+            sql.execute_deferred(
+                "INSERT INTO contexts_messages (id, context_id, member_id, role, msg, embedding_id, log, cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (next_id, self.workflow.leaf_id, member_id, role, content, new_msg.embedding_id, json_str, int(cached)),
+                on_error=lambda e: self.on_save_failed(new_msg, e))
+            self.branch_tree.add_message(self.workflow.leaf_id, next_id)
+            if self.loaded_leaf_id != self.workflow.leaf_id:
+                # A new branch was started, the messages before it have changed
+                self.load_messages()
+            else:
+                self.messages.append(new_msg)
 
             return new_msg
 
@@ -216,91 +278,215 @@ class MessageHistory:
             calling_member_id=0,
             msg_limit=8,
             pad_consecutive=True,
-            from_msg_id=0):
-
+            from_msg_id=0,
+            context_window=None,
+            reserved_tokens=0,
+            system_msg='',
+            model_name=DEFAULT_TOKENIZER_MODEL,
+            summarize=False):
+        """
+        Returns the last `msg_limit` messages as dicts.
+        If `context_window` is given, as many of the newest messages as fit in it are returned instead (up to `msg_limit`,
+        None for no limit), after `reserved_tokens` for the completion, the `system_msg` and any preloaded messages.
+        With `summarize` and `llm_format`, the cached summary of the messages left out is put before them.
+        """
+        # The cached views and token sums are shared with members streaming from executor threads
+        with self.thread_lock:
+            # assistant_member = calling_member_id
+            all_member_configs = self.workflow.member_configs
+            member_config = all_member_configs.get(calling_member_id, {})
+
+            set_members_as_user = member_config.get('group.show_members_as_user_role', True)
+            calling_member = self.workflow.members.get(calling_member_id, None)
+            input_members = calling_member.inputs if calling_member else []
+            user_members = [] if not set_members_as_user else input_members
+
+            if len(user_members) == 0:
+                # set merge members = all members except calling member, use configs to remember deleted members
+                user_members = [m_id for m_id in self.workflow.member_configs if m_id != calling_member_id]
+
+            if llm_format:
+                incl_roles = ('user', 'assistant', 'output', 'code')
+
+            preloaded_msgs = parse_preloaded_msgs(member_config.get('chat.preload.data', '[]')) if llm_format else ()
+            if context_window is not None:
+                encoding = get_encoding(model_name)
+                budget = context_window - reserved_tokens
+                if system_msg:
+                    budget -= len(encoding.encode(system_msg)) + MESSAGE_TOKEN_OVERHEAD
+                budget -= sum(len(encoding.encode(content)) + MESSAGE_TOKEN_OVERHEAD for _, content in preloaded_msgs)
+                if summarize and llm_format:
+                    budget -= summaries.SUMMARY_MAX_TOKENS
+                messages = self.select_within_budget(budget, incl_roles, model_name, msg_limit, from_msg_id)
+            else:
+                messages = [msg for msg in self.messages if msg.id >= from_msg_id and msg.role in incl_roles]
+                while len(messages) < msg_limit and self.has_older and self.messages[0].id > from_msg_id:
+                    older_messages = self.load_older()
+                    messages[:0] = [msg for msg in older_messages if msg.id >= from_msg_id and msg.role in incl_roles]
+
+            # Messages are formatted once per member view, and reused until the branch is reloaded
+            view = self.member_views.setdefault((calling_member_id, tuple(user_members), llm_format), {})
+            formatted_msgs = []  # [(msg_id, formatted msg)]
+            for msg in messages:
+                if msg.id not in view:
+                    view[msg.id] = self.format_message(msg, user_members, llm_format)
+                if view[msg.id] is not None:
+                    formatted_msgs.append((msg.id, view[msg.id]))
+
+            # merge_multiple_members = member_configs.get(calling_member_id, {}).get('group.merge_multiple_members', True)
+
+            if llm_format:
+                formatted_msgs[:0] = [(None, {'role': role, 'content': content}) for role, content in preloaded_msgs]
+
+            # # Apply padding between consecutive messages of same role
+            # pre_formatted_msgs = add_padding_to_consecutive_messages(pre_formatted_msgs)
+
+            if context_window is None and len(formatted_msgs) > msg_limit:
+                formatted_msgs = formatted_msgs[-msg_limit:]
+
+            if llm_format and summarize:
+                first_index, first_msg_id = next(((i, msg_id) for i, (msg_id, _) in enumerate(formatted_msgs)
+                                                  if msg_id is not None), (None, None))
+                gap_budget = None
+                if context_window is not None:
+                    kept_tokens = sum(msg.get_token_count(model_name) + MESSAGE_TOKEN_OVERHEAD for msg in messages)
+                    gap_budget = budget - kept_tokens
+                summary_msg, gap_msgs = self.get_summary_msg(first_msg_id, incl_roles, gap_budget, model_name)
+                if summary_msg:
+                    # The messages between the end of the summary and the kept ones, so none are left out
+                    for msg in gap_msgs:
+                        if msg.id not in view:
+                            view[msg.id] = self.format_message(msg, user_members, llm_format)
+                    formatted_msgs[first_index:first_index] = [(msg.id, view[msg.id]) for msg in gap_msgs
+                                                               if view[msg.id] is not None]
+                    formatted_msgs.insert(0, (None, summary_msg))
+
+            if llm_format:
+                # if first item is assistant, remove it (to avoid errors with some llms like claude)
+                if formatted_msgs and formatted_msgs[0][1]['role'] != 'user':
+                    formatted_msgs.pop(0)
+
+            save_token_counts()
+
+            # Copies, so callers can't change the cached view
+            return [dict(msg) for _, msg in formatted_msgs]
+
+    def on_save_failed(self, msg, error):
+        """Called from the sql writer thread when the insert of `msg` failed, so it isn't shown or sent as saved"""
+        with self.thread_lock:
+            if msg in self.messages:
+                self.messages.remove(msg)
+                self.token_prefix_sums.clear()
+                self.member_views.clear()
+
+        main = getattr(self.workflow, 'main', None)
+        if main is not None:
+            main.message_save_failed.emit(str(error))
+
+    @staticmethod
+    def format_message(msg, user_members, llm_format):
+        """Returns the dict of `msg` as seen by a member, or None if it isn't sent to the llm"""
         assistant_msg_prefix = ''  # self.agent.config.get('context.prefix_all_assistant_msgs')  todo
         # if assistant_msg_prefix is None:
         #     assistant_msg_prefix = ''
 
-        # assistant_member = calling_member_id
-        all_member_configs = self.workflow.member_configs
-        member_config = all_member_configs.get(calling_member_id, {})
-
-        set_members_as_user = member_config.get('group.show_members_as_user_role', True)
-        calling_member = self.workflow.members.get(calling_member_id, None)
-        input_members = calling_member.inputs if calling_member else []
-        user_members = [] if not set_members_as_user else input_members
-
-        if len(user_members) == 0:
-            # set merge members = all members except calling member, use configs to remember deleted members
-            user_members = [m_id for m_id in self.workflow.member_configs if m_id != calling_member_id]
-
-        if llm_format:
-            incl_roles = ('user', 'assistant', 'output', 'code')
-
-        pre_formatted_msgs = [
-            {
+        role = msg.role if msg.role not in ('user', 'assistant') \
+            else 'user' if (msg.member_id in user_members or msg.role == 'user') \
+            else 'assistant'
+        if not llm_format:
+            return {
                 'id': msg.id,
-                'role': msg.role if msg.role not in ('user', 'assistant')
-                    else 'user' if (msg.member_id in user_members or msg.role == 'user')
-                        else 'assistant',
+                'role': role,
                 'member_id': msg.member_id,
-                'content': f"{assistant_msg_prefix}{msg.content}" if msg.role == 'assistant' and llm_format else msg.content,
-                'embedding_id': msg.embedding_id
-            } for msg in self.messages if msg.id >= from_msg_id and msg.role in incl_roles
-        ]
-
-        # merge_multiple_members = member_configs.get(calling_member_id, {}).get('group.merge_multiple_members', True)
-
-        if llm_format:
-            llm_format_msgs = []
-
-            preloaded_msgs = json.loads(member_config.get('chat.preload.data', '[]'))
-            llm_format_msgs.extend({
-                'role': msg['role'],
-                'content': msg['content'],
-            } for msg in preloaded_msgs)
-
-            # last_ass_msg = None
-            for msg in pre_formatted_msgs:
-                if msg['role'] == 'user':
-                    llm_format_msgs.append(msg)
-                elif msg['role'] == 'assistant':
-                    llm_format_msgs.append(msg)
-                    # last_ass_msg = llm_format_msgs[-1]
-                elif msg['role'] == 'output':
-                    msg['role'] = 'function'
-                    msg['name'] = 'execute'
-                    llm_format_msgs.append(msg)
-                elif msg['role'] == 'code':
-                    msg['role'] = 'function'
-                    msg['name'] = 'execute'
-
-            pre_formatted_msgs = llm_format_msgs
-
-        # # Apply padding between consecutive messages of same role
-        # pre_formatted_msgs = add_padding_to_consecutive_messages(pre_formatted_msgs)
-
-        if len(pre_formatted_msgs) > msg_limit:
-            pre_formatted_msgs = pre_formatted_msgs[-msg_limit:]
-
-        if llm_format:
-
-            # if first item is assistant, remove it (to avoid errors with some llms like claude)
-            first_msg = next(iter(pre_formatted_msgs))
-            if first_msg:
-                if first_msg.get('role', '') != 'user':
-                    pre_formatted_msgs.pop(0)
-
-            for msg in pre_formatted_msgs:
-                accepted_keys = ('role', 'content', 'name')
-                # pop each key if key not in list
-                msg_keys = list(msg.keys())  # todo - optimise
-                for key in msg_keys:
-                    if key not in accepted_keys:
-                        msg.pop(key)
-
-        return pre_formatted_msgs
+                'content': msg.content,
+                'embedding_id': msg.embedding_id,
+            }
+
+        if role == 'user':
+            return {'role': role, 'content': msg.content}
+        elif role == 'assistant':
+            return {'role': role, 'content': f"{assistant_msg_prefix}{msg.content}" if msg.role == 'assistant' else msg.content}
+        elif role == 'output':
+            return {'role': 'function', 'content': msg.content, 'name': 'execute'}
+        return None  # code is sent by the output that follows it
+
+    def get_summary_msg(self, first_msg_id, incl_roles, gap_budget=None, model_name=DEFAULT_TOKENIZER_MODEL):
+        """
+        Returns (a message with the summary of the messages before `first_msg_id`, the messages of `incl_roles` after
+        the end of the summary and before `first_msg_id`), or (None, []) if none were left out or there's no summary.
+        The messages in between are returned to be kept if their tokens fit in `gap_budget` (None for no limit),
+        otherwise the summary says how many are left out.
+        """
+        if first_msg_id is None or not (self.has_older or (self.messages and self.messages[0].id < first_msg_id)):
+            return None, []
+        summary, up_to_msg_id = summaries.get_summary(self.branch_tree.get_path(self.workflow.leaf_id), first_msg_id)
+        if not summary:
+            return None, []
+
+        while self.has_older and self.messages[0].id > up_to_msg_id:
+            if not self.load_older():
+                break
+        gap_msgs = [msg for msg in self.messages if up_to_msg_id < msg.id < first_msg_id and msg.role in incl_roles]
+
+        content = f'Summary of the earlier conversation:\n{summary}'
+        if gap_budget is not None:
+            gap_tokens = sum(msg.get_token_count(model_name) + MESSAGE_TOKEN_OVERHEAD for msg in gap_msgs)
+            if gap_tokens > gap_budget:
+                content += f'\n({len(gap_msgs)} messages after this summary are left out)'
+                gap_msgs = []
+        return {'role': 'user', 'content': content}, gap_msgs
+
+    def select_within_budget(self, budget, incl_roles, model_name=DEFAULT_TOKENIZER_MODEL, msg_limit=None, from_msg_id=0):
+        """
+        Returns the newest messages of `incl_roles` whose tokens add up to at most `budget`, oldest first.
+        The latest message is always kept, even if it doesn't fit on its own.
+        Older pages are loaded while all the loaded messages fit.
+        """
+        while True:
+            prefix_sums = self.get_token_prefix_sums(incl_roles, model_name)
+            msg_indexes, msg_ids, sums = prefix_sums['indexes'], prefix_sums['ids'], prefix_sums['sums']
+            num_msgs = len(msg_ids)
+
+            # The first message where the total from there to the end fits
+            start = bisect_left(sums, sums[num_msgs] - budget)
+            over_budget = start >= num_msgs > 0
+            if over_budget:
+                logging.warning(f'The latest message is over the token budget of {budget}, it is sent on its own')
+                start = num_msgs - 1
+            start = max(start, bisect_left(msg_ids, from_msg_id))
+            if msg_limit is not None:
+                start = max(start, num_msgs - msg_limit)
+
+            needs_older = start == 0 and not over_budget and self.has_older and (msg_limit is None or num_msgs < msg_limit) \
+                and self.messages[0].id > from_msg_id
+            if not needs_older or not self.load_older():
+                return [self.messages[i] for i in msg_indexes[start:]]
+
+    def get_token_prefix_sums(self, incl_roles, model_name=DEFAULT_TOKENIZER_MODEL):
+        """
+        Returns the running token totals of the messages of `incl_roles`, where `sums[i]` is the total of the first i.
+        Cached per tokenizer and extended as messages are added, it's rebuilt if earlier messages have changed.
+        """
+        key = (get_encoding(model_name).name, tuple(incl_roles))
+        prefix_sums = self.token_prefix_sums.get(key)
+        num_scanned = prefix_sums['num_scanned'] if prefix_sums else 0
+        if prefix_sums is None or num_scanned > len(self.messages) or \
+                (num_scanned > 0 and self.messages[num_scanned - 1].id != prefix_sums['last_id']):
+            prefix_sums = {'num_scanned': 0, 'last_id': None, 'indexes': [], 'ids': [], 'sums': [0]}
+            self.token_prefix_sums[key] = prefix_sums
+
+        sums = prefix_sums['sums']
+        messages = self.messages[prefix_sums['num_scanned']:]
+        for i, msg in enumerate(messages, start=prefix_sums['num_scanned']):
+            if msg.role not in incl_roles:
+                continue
+            prefix_sums['indexes'].append(i)
+            prefix_sums['ids'].append(msg.id)
+            sums.append(sums[-1] + msg.get_token_count(model_name) + MESSAGE_TOKEN_OVERHEAD)
+        if messages:
+            prefix_sums['num_scanned'] += len(messages)
+            prefix_sums['last_id'] = messages[-1].id
+        return prefix_sums
 
     def count(self, incl_roles=('user', 'assistant')):
         return len([msg for msg in self.messages if msg.role in incl_roles])
@@ -0,0 +1,43 @@
+import hashlib
+import json
+
+from src.utils import sql
+
+
+def get_inputs_hash(turn_key, input_outputs):
+    """
+    Returns the hash of what a member responds to: `turn_key` is (id of the message before the turn, role and
+    content of the message that started it), `input_outputs` is {input member id: what it wrote in this turn}.
+    """
+    inputs = [list(turn_key), sorted([str(m_id), output] for m_id, output in input_outputs.items())]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def get_run_messages(member_id, inputs_hash):
+    """Returns [(role, content, log)] the member saved the last time it ran with `inputs_hash`, or None"""
+    msg_ids_json = sql.get_scalar("""
+        SELECT msg_ids
+        FROM contexts_members_runs
+        WHERE member_id = ?
+            AND inputs_hash = ?
+        ORDER BY id DESC
+        LIMIT 1""", (member_id, inputs_hash))
+    if msg_ids_json is None:
+        return None
+
+    msg_ids = json.loads(msg_ids_json)
+    if not msg_ids:
+        return []
+    placeholders = ', '.join('?' for _ in msg_ids)
+    rows = sql.get_results(f"""
+        SELECT role, msg, log
+        FROM contexts_messages
+        WHERE id IN ({placeholders})
+        ORDER BY id""", msg_ids)
+    return rows if len(rows) == len(msg_ids) else None  # some were deleted
+
+
+def save_run(member_id, inputs_hash, msg_ids):
+    sql.execute_deferred("""
+        INSERT INTO contexts_members_runs (member_id, inputs_hash, msg_ids)
+        VALUES (?, ?, ?)""", (member_id, inputs_hash, json.dumps(msg_ids)))
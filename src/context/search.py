@@ -0,0 +1,153 @@
+import html
+
+from src.utils import sql
+
+# Only the most recent matches are ranked, ranking every match of a word in most messages takes over a second.
+# Prefix matches only fill up the results while typing, and a short prefix can match most of the history
+SEARCH_CANDIDATE_LIMIT = 10000
+PREFIX_CANDIDATE_LIMIT = 1000
+
+
+def to_match_query(text, prefix=False):
+    """
+    Converts user input to an FTS5 query that matches messages containing every word.
+    With `prefix` the last word is matched as a prefix, for results while typing.
+    """
+    words = text.split()
+    if not words:
+        return None
+    terms = ['"' + word.replace('"', '""') + '"' for word in words]
+    if prefix:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_messages(text, limit=50, roles=('user', 'assistant')):
+    """
+    Returns the best matching messages for `text`, as a list of dicts with keys
+    `msg_id`, `context_id`, `root_id`, `summary`, `role` and `snippet`, best match first.
+    The snippet is HTML escaped, with the matched words wrapped in <b></b>.
+    """
+    match_query = to_match_query(text)
+    if match_query is None:
+        return []
+
+    snippets = _ranked_snippets(match_query, limit, roles, SEARCH_CANDIDATE_LIMIT)
+    if len(snippets) < limit and not text[-1].isspace():
+        # The last word may still be being typed, prefix queries are slower so only used to fill up
+        prefix_snippets = _ranked_snippets(to_match_query(text, prefix=True), limit, roles, PREFIX_CANDIDATE_LIMIT)
+        for msg_id, snippet in prefix_snippets.items():
+            if len(snippets) >= limit:
+                break
+            snippets.setdefault(msg_id, snippet)
+    if not snippets:
+        return []
+
+    msg_ids = list(snippets)
+    id_placeholders = ', '.join('?' for _ in msg_ids)
+    rows = sql.get_results(f"""
+        WITH RECURSIVE ancestors(msg_id, id, parent_id) AS (
+            SELECT m.id, c.id, c.parent_id
+            FROM contexts_messages m
+            JOIN contexts c ON c.id = m.context_id
+            WHERE m.id IN ({id_placeholders})
+            UNION ALL
+            SELECT a.msg_id, c.id, c.parent_id
+            FROM ancestors a
+            JOIN contexts c ON c.id = a.parent_id
+        )
+        SELECT
+            m.id,
+            m.context_id,
+            a.id AS root_id,
+            c.summary,
+            m.role
+        FROM ancestors a
+        JOIN contexts_messages m
+            ON m.id = a.msg_id
+        JOIN contexts c
+            ON c.id = a.id
+        WHERE a.parent_id IS NULL""", msg_ids)
+
+    results = {
+        msg_id: {
+            'msg_id': msg_id,
+            'context_id': context_id,
+            'root_id': root_id,
+            'summary': summary,
+            'role': role,
+            'snippet': html.escape(snippets[msg_id] or '').replace('\x02', '<b>').replace('\x03', '</b>'),
+        }
+        for msg_id, context_id, root_id, summary, role in rows
+    }
+    return [results[msg_id] for msg_id in msg_ids if msg_id in results]
+
+
+def _ranked_snippets(match_query, limit, roles, candidate_limit):
+    """
+    Returns {msg_id: snippet} of the best `limit` matches in rank order, matched words are wrapped in \\x02 \\x03.
+    Only the `candidate_limit` most recent matches are ranked.
+    """
+    role_placeholders = ', '.join('?' for _ in roles)
+    ranked = sql.get_results(f"""
+        SELECT msg_id
+        FROM (
+            SELECT
+                rowid AS msg_id,
+                rank
+            FROM contexts_messages_fts
+            WHERE contexts_messages_fts MATCH ?
+                AND role IN ({role_placeholders})
+            ORDER BY rowid DESC
+            LIMIT ?
+        )
+        ORDER BY rank
+        LIMIT ?""", (match_query, *roles, candidate_limit, limit), return_type='list')
+    if not ranked:
+        return {}
+
+    # A rowid range keeps this to one evaluation of the match, `rowid IN` would evaluate it per id
+    id_placeholders = ', '.join('?' for _ in ranked)
+    snippets = sql.get_results(f"""
+        SELECT
+            rowid,
+            CASE WHEN rowid IN ({id_placeholders}) THEN
+                snippet(contexts_messages_fts, 1, char(2), char(3), '...', 16)
+            END
+        FROM contexts_messages_fts
+        WHERE contexts_messages_fts MATCH ?
+            AND rowid BETWEEN ? AND ?""", (*ranked, match_query, min(ranked), max(ranked)), return_type='dict')
+    return {msg_id: snippets.get(msg_id) for msg_id in ranked}
+
+
+def reveal_message(msg_id):
+    """
+    Activates the branches leading to the context of `msg_id`, and deactivates any branch that would hide it,
+    so loading the root context shows the message. Returns the root context id.
+    """
+    path = sql.get_results("""
+        WITH RECURSIVE context_path(id, parent_id) AS (
+            SELECT c.id, c.parent_id
+            FROM contexts c
+            WHERE c.id = (SELECT context_id FROM contexts_messages WHERE id = ?)
+            UNION ALL
+            SELECT c.id, c.parent_id
+            FROM context_path cp
+            JOIN contexts c ON c.id = cp.parent_id
+        )
+        SELECT id, parent_id FROM context_path""", (msg_id,))
+    if not path:
+        return None
+
+    with sql.transaction() as tx:
+        # The leaf follows the newest active child, so newer siblings of the path are deactivated
+        for context_id, parent_id in path:
+            if parent_id is None:
+                continue
+            tx.execute("UPDATE contexts SET active = 1 WHERE id = ?", (context_id,))
+            tx.execute("UPDATE contexts SET active = 0 WHERE parent_id = ? AND id > ?", (parent_id, context_id))
+
+        # A branch from the message, or from an earlier message, would replace it
+        tx.execute("UPDATE contexts SET active = 0 WHERE parent_id = ? AND branch_msg_id <= ?", (path[0][0], msg_id))
+
+    return path[-1][0]
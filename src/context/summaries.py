@@ -0,0 +1,109 @@
+import logging
+import threading
+
+from src.utils import sql
+
+SUMMARY_CHUNK_SIZE = 20  # messages folded into the rolling summary at a time
+SUMMARY_MAX_TOKENS = 400  # tokens kept free for the summary when a token budget is used
+SUMMARY_PROMPT = """Update the summary of a conversation with the messages that follow it.
+Keep names, facts, decisions and open questions, in no more than 250 words. Reply with the summary only.
+
+SUMMARY SO FAR:
+{summary}
+
+MESSAGES:
+{messages}"""
+
+_summarizer_thread = None
+
+
+def get_summary(context_path, before_msg_id):
+    """
+    Returns (summary, up_to_msg_id) of the newest summary on `context_path` covering only messages before
+    `before_msg_id`, or (None, None). `context_path` is [(context_id, msg id its messages end before)] from
+    `BranchTree.get_path`.
+    """
+    path_conditions = ' OR '.join('(context_id = ? AND up_to_msg_id < ?)' for _ in context_path)
+    path_params = [param for context_id, end_msg_id in context_path
+                   for param in (context_id, min(msg_id for msg_id in (end_msg_id, before_msg_id) if msg_id is not None))]
+    row = sql.get_results(f"""
+        SELECT summary, up_to_msg_id
+        FROM context_summaries
+        WHERE {path_conditions}
+        ORDER BY up_to_msg_id DESC
+        LIMIT 1""", path_params)
+    return tuple(row[0]) if row else (None, None)
+
+
+def summarize_path(context_path, model_obj, keep_recent=SUMMARY_CHUNK_SIZE):
+    """
+    Folds the messages of `context_path` into rolling summaries, one per chunk of `SUMMARY_CHUNK_SIZE` messages,
+    skipping the newest `keep_recent` messages. Each summary is stored with the context and id of the last message it
+    covers, so branches sharing the messages reuse it.
+    """
+    from src.utils import llm
+
+    msg_path = _path_messages(context_path)
+    chunk_ends = list(range(SUMMARY_CHUNK_SIZE - 1, len(msg_path) - keep_recent, SUMMARY_CHUNK_SIZE))
+    if not chunk_ends:
+        return
+
+    end_msg_ids = [msg_path[i][0] for i in chunk_ends]
+    placeholders = ', '.join('?' for _ in end_msg_ids)
+    existing = sql.get_results(f"""
+        SELECT up_to_msg_id, summary
+        FROM context_summaries
+        WHERE up_to_msg_id IN ({placeholders})""", end_msg_ids, return_type='dict')
+
+    summary = ''
+    for chunk_end in chunk_ends:
+        msg_id, context_id = msg_path[chunk_end]
+        if msg_id in existing:
+            summary = existing[msg_id]
+            continue
+
+        chunk_ids = [path_msg_id for path_msg_id, _ in msg_path[chunk_end + 1 - SUMMARY_CHUNK_SIZE:chunk_end + 1]]
+        chunk_placeholders = ', '.join('?' for _ in chunk_ids)
+        chunk_msgs = sql.get_results(f"""
+            SELECT role, msg
+            FROM contexts_messages
+            WHERE id IN ({chunk_placeholders})
+                AND role IN ('user', 'assistant')
+            ORDER BY id""", chunk_ids)
+        messages_str = '\n'.join(f"{role}: {msg.strip()}" for role, msg in chunk_msgs)
+        prompt = SUMMARY_PROMPT.format(summary=summary or '(none)', messages=messages_str)
+        summary = llm.get_scalar(prompt, model_obj=model_obj).strip()
+
+        sql.execute("""
+            INSERT OR REPLACE INTO context_summaries (context_id, up_to_msg_id, msg_count, summary)
+            VALUES (?, ?, ?, ?)""", (context_id, msg_id, chunk_end + 1, summary))
+
+
+def start_summarizer(context_path, model_obj):
+    """Runs `summarize_path` in a background thread, unless one is already running"""
+    global _summarizer_thread
+    if _summarizer_thread is not None and _summarizer_thread.is_alive():
+        return
+
+    def run():
+        try:
+            summarize_path(context_path, model_obj)
+        except Exception as e:
+            logging.error(f'Summarizing failed: {e}')
+
+    _summarizer_thread = threading.Thread(target=run, name='summarizer', daemon=True)
+    _summarizer_thread.start()
+
+
+def _path_messages(context_path):
+    """Returns [(msg_id, context_id)] of every message on `context_path`, oldest first"""
+    msg_path = []
+    for context_id, end_msg_id in reversed(context_path):
+        msg_ids = sql.get_results("""
+            SELECT id
+            FROM contexts_messages
+            WHERE context_id = ?
+                AND id < COALESCE(?, 9223372036854775807)
+            ORDER BY id""", (context_id, end_msg_id), return_type='list')
+        msg_path.extend((msg_id, context_id) for msg_id in msg_ids)
+    return msg_path
@@ -263,6 +263,14 @@ class AgentSettings(ConfigPages):
                         'width': 90,
                         'row_key': 2,
                     },
+                    {
+                        'text': 'Cache responses',
+                        'type': bool,
+                        'default': False,
+                        'row_key': 2,
+                        'tooltip': 'Reuse the response when the same request is sent again. '
+                                   'Only when the model has a temperature of 0 or a seed',
+                    },
                     {
                         'text': 'User message',
                         'key': 'user_msg',
@@ -359,6 +367,17 @@ class AgentSettings(ConfigPages):
                         'type': bool,
                         'default': True,
                     },
+                    {
+                        'text': 'Stream input sentences',
+                        'type': int,
+                        'minimum': 0,
+                        'maximum': 99,
+                        'default': 0,
+                        'width': 60,
+                        'tooltip': 'With a Stream input, start responding once the input member has written this many '
+                                   'sentences. 0 waits for the full output.\nWarning: this member only gets what the '
+                                   'input has written when it starts, the rest of the input is left out.',
+                    },
                     {
                         'text': 'Member description',
                         'type': str,
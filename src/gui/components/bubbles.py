@@ -95,6 +95,12 @@ class MessageContainer(QWidget):
 
             self.layout.addWidget(self.bg_bubble)
 
+        if message.cached:
+            self.cached_label = QLabel('cached', self)
+            self.cached_label.setProperty("class", "bubble-name-label")
+            self.cached_label.setToolTip('This response is from the output cache, the model was not called')
+            self.layout.addWidget(self.cached_label, alignment=Qt.AlignBottom)
+
         # extra_buttons = self.bubble.extra_buttons  # list of widget class references
         # for button in extra_buttons:
         #     self.layout.addWidget(button(self))
@@ -178,6 +184,7 @@ class MessageContainer(QWidget):
 
     def check_and_toggle_rerun_button(self):
         self.btn_resend.check_and_toggle()
+        self.btn_rerun.check_and_toggle()
         # if self.underMouse():
         #     self.btn_resend.show()
         # else:
@@ -207,14 +214,10 @@ class MessageContainer(QWidget):
             self.msg_container.parent.delete_messages_since(editing_msg_id)
 
             # Create a new leaf context
-            sql.execute(
-                "INSERT INTO contexts (parent_id, branch_msg_id) SELECT context_id, id FROM contexts_messages WHERE id = ?",
-                (branch_msg_id,))
-            new_leaf_id = sql.get_scalar('SELECT MAX(id) FROM contexts')
-            self.msg_container.parent.workflow.leaf_id = new_leaf_id
+            self.msg_container.parent.workflow.new_branch(branch_msg_id)
 
-            # Finally send the message like normal
-            self.msg_container.parent.send_message(msg_to_send, clear_input=False)
+            # Finally send the message like normal, members whose inputs didn't change reuse their last response
+            self.msg_container.parent.send_message(msg_to_send, clear_input=False, rerun_member_ids=set())
 
         def check_and_toggle(self):
             if self.parent.bubble.toPlainText() != self.parent.bubble.original_text:
@@ -235,29 +238,35 @@ class MessageContainer(QWidget):
             self.setFixedSize(32, 24)
 
         def rerun_msg(self):
-            branch_msg_id = self.msg_container.branch_msg_id
-            editing_msg_id = self.msg_container.bubble.msg_id
+            page_chat = self.msg_container.parent
+            workflow = page_chat.workflow
+            if workflow.responding:
+                return
 
-            # Deactivate all other branches
-            self.msg_container.parent.workflow.deactivate_all_branches_with_msg(editing_msg_id)
+            # Branch at the first response of the turn, the members that responded before this one in the graph
+            # replay their responses, only this member and the members after it run again
+            index = page_chat.chat_bubbles.index(self.msg_container)
+            while index > 0 and page_chat.chat_bubbles[index - 1].bubble.role != 'user':
+                index -= 1
+            branch_container = page_chat.chat_bubbles[index]
+            branch_msg_id = branch_container.branch_msg_id
+            editing_msg_id = branch_container.bubble.msg_id
 
-            msg_to_send = self.msg_container.bubble.toPlainText()
+            # Deactivate all other branches
+            workflow.deactivate_all_branches_with_msg(editing_msg_id)
 
-            # Delete all messages from editing bubble onwards
-            self.msg_container.parent.delete_messages_since(editing_msg_id)
+            # Delete all messages from the first response onwards
+            page_chat.delete_messages_since(editing_msg_id)
 
             # Create a new leaf context
-            sql.execute(
-                "INSERT INTO contexts (parent_id, branch_msg_id) SELECT context_id, id FROM contexts_messages WHERE id = ?",
-                (branch_msg_id,))
-            new_leaf_id = sql.get_scalar('SELECT MAX(id) FROM contexts')
-            self.msg_container.parent.workflow.leaf_id = new_leaf_id
+            workflow.new_branch(branch_msg_id)
 
-            # Finally send the message like normal
-            self.msg_container.parent.send_message(msg_to_send, clear_input=False)
+            page_chat.rerun_members({self.msg_container.bubble.member_id})
 
         def check_and_toggle(self):
-            if self.parent.bubble.toPlainText() != self.parent.bubble.original_text:
+            workflow = self.msg_container.parent.workflow
+            is_member_msg = self.msg_container.bubble.member_id in workflow.members
+            if self.msg_container.underMouse() and is_member_msg and not workflow.responding:
                 self.show()
             else:
                 self.hide()
@@ -509,8 +518,8 @@ class MessageBubbleBase(QTextEdit):
 class MessageBubbleUser(MessageBubbleBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        branches = self.parent.parent.workflow.message_history.branches
-        self.branch_entry = {k: v for k, v in branches.items() if self.msg_id == k or self.msg_id in v}
+        branch_tree = self.parent.parent.workflow.message_history.branch_tree
+        self.branch_entry = branch_tree.get_branch_entry(self.msg_id)
         self.has_branches = len(self.branch_entry) > 0
 
         if self.has_branches:
@@ -630,7 +639,7 @@ class MessageBubbleUser(MessageBubbleBase):
 
         def reload_following_bubbles(self):
             self.page_chat.delete_messages_since(self.bubble_id)
-            self.page_chat.workflow.message_history.load()
+            self.page_chat.workflow.message_history.load(reload_tree=False)
             self.page_chat.refresh()
 
         def update_buttons(self):
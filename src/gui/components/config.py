@@ -769,23 +769,24 @@ class ConfigTree(ConfigWidget):
             folder_parent = item.parent() if item else None
             folder_parent_id = folder_parent.text(1) if folder_parent else None
 
-            # Unpack all items from folder to parent folder (or root)
-            sql.execute(f"""
-                UPDATE `{self.db_table}`
-                SET folder_id = {'NULL' if not folder_parent_id else folder_parent_id}
-                WHERE folder_id = ?
-            """, (folder_id,))
-            # Unpack all folders from folder to parent folder (or root)
-            sql.execute(f"""
-                UPDATE `folders`
-                SET parent_id = {'NULL' if not folder_parent_id else folder_parent_id}
-                WHERE parent_id = ?
-            """, (folder_id,))
-
-            sql.execute(f"""
-                DELETE FROM folders
-                WHERE id = ?
-            """, (folder_id,))
+            with sql.transaction() as tx:
+                # Unpack all items from folder to parent folder (or root)
+                tx.execute(f"""
+                    UPDATE `{self.db_table}`
+                    SET folder_id = {'NULL' if not folder_parent_id else folder_parent_id}
+                    WHERE folder_id = ?
+                """, (folder_id,))
+                # Unpack all folders from folder to parent folder (or root)
+                tx.execute(f"""
+                    UPDATE `folders`
+                    SET parent_id = {'NULL' if not folder_parent_id else folder_parent_id}
+                    WHERE parent_id = ?
+                """, (folder_id,))
+
+                tx.execute(f"""
+                    DELETE FROM folders
+                    WHERE id = ?
+                """, (folder_id,))
 
             self.load()
             return True
@@ -824,18 +825,30 @@ class ConfigTree(ConfigWidget):
 
             try:
                 if self.db_table == 'contexts':
+                    from src.context.base import clear_workflow_cache
                     context_id = id
-                    context_member_ids = sql.get_results("SELECT id FROM contexts_members WHERE context_id = ?",
-                                                         (context_id,),
-                                                         return_type='list')
-                    sql.execute("DELETE FROM contexts_members_inputs WHERE member_id IN ({}) OR input_member_id IN ({})".format(
-                        ','.join([str(i) for i in context_member_ids]),
-                        ','.join([str(i) for i in context_member_ids])
-                    ))
-                    sql.execute("DELETE FROM contexts_messages WHERE context_id = ?;",
-                                (context_id,))  # todo update delete to cascade branches & transaction
-                    sql.execute('DELETE FROM contexts_members WHERE context_id = ?', (context_id,))
-                    sql.execute("DELETE FROM contexts WHERE id = ?;", (context_id,))
+                    # The context and all of its branch contexts
+                    context_ids = sql.get_results("""
+                        WITH RECURSIVE context_tree(id) AS (
+                            SELECT ?
+                            UNION ALL
+                            SELECT c.id
+                            FROM contexts c
+                            JOIN context_tree ct ON c.parent_id = ct.id
+                        )
+                        SELECT id FROM context_tree""", (context_id,), return_type='list')
+                    context_id_params = [(c_id,) for c_id in context_ids]
+
+                    with sql.transaction() as tx:
+                        tx.execute("""
+                            DELETE FROM contexts_members_inputs
+                            WHERE member_id IN (SELECT id FROM contexts_members WHERE context_id = ?)
+                                OR input_member_id IN (SELECT id FROM contexts_members WHERE context_id = ?)""",
+                                   (context_id, context_id,))
+                        tx.executemany("DELETE FROM contexts_messages WHERE context_id = ?;", context_id_params)
+                        tx.execute('DELETE FROM contexts_members WHERE context_id = ?', (context_id,))
+                        tx.executemany("DELETE FROM contexts WHERE id = ?;", context_id_params)
+                    clear_workflow_cache(context_ids)
 
                 else:
                     sql.execute(f"DELETE FROM `{self.db_table}` WHERE `id` = ?", (id,))
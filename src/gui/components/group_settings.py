@@ -257,6 +257,11 @@ class GroupTopBar(QWidget):
         self.input_type_combo_box = QComboBox(self)
         self.input_type_combo_box.addItem("Message")
         self.input_type_combo_box.addItem("Context")
+        self.input_type_combo_box.addItem("Stream")
+        self.input_type_combo_box.setItemData(
+            2, "Start before the input has finished, after its first 'Stream input sentences' (in the member's "
+               "Group settings).\nWarning: the member only gets what the input has written when it starts.",
+            Qt.ToolTipRole)
         self.input_type_combo_box.setFixedWidth(115)
         self.layout.addWidget(self.input_type_label)
         self.layout.addWidget(self.input_type_combo_box)
@@ -319,7 +324,7 @@ class GroupTopBar(QWidget):
         line = sel_lines[0]
         line_member_id, line_inp_member_id = line.key
 
-        # 0 = message, 1 = context
+        # 0 = message, 1 = context, 2 = stream
         sql.execute("""
             UPDATE contexts_members_inputs
             SET type = ?
@@ -330,7 +335,7 @@ class GroupTopBar(QWidget):
         self.parent.load()
 
     def clear_chat(self):
-        from src.context.base import Workflow
+        from src.context.base import get_workflow, clear_workflow_cache
         retval = display_messagebox(
             icon=QMessageBox.Warning,
             text="Are you sure you want to permanently clear the chat messages? This should only be used when testing to preserve the context name. To keep your data start a new context.",
@@ -364,7 +369,8 @@ class GroupTopBar(QWidget):
                     (self.parent.parent.parent.workflow.id,))
 
         page_chat = self.parent.parent.parent
-        page_chat.workflow = Workflow(main=page_chat.main)
+        clear_workflow_cache([page_chat.workflow.id])
+        page_chat.workflow = get_workflow(page_chat.main)
         self.parent.parent.parent.load()
 
 
@@ -525,9 +531,11 @@ class ConnectionLine(QGraphicsPathItem):
         line_width = 4 if self.isSelected() else 2
         current_pen = self.pen()
         current_pen.setWidth(line_width)
-        # set to a dashed line if input type is 1
+        # set to a dashed line if input type is 1, dotted if it's 2
         if self.input_type == 1:
             current_pen.setStyle(Qt.DashLine)
+        elif self.input_type == 2:
+            current_pen.setStyle(Qt.DotLine)
         painter.setPen(current_pen)
         painter.drawPath(self.path())
 
@@ -7,7 +7,9 @@ from PySide6.QtCore import Signal, QSize, QTimer, QMimeData, QPoint, QTranslator
 from PySide6.QtGui import QPixmap, QIcon, QFont, QTextCursor, QTextDocument, QFontMetrics, QGuiApplication, Qt
 
 from src.utils.sql_upgrade import upgrade_script, versions
-from src.utils import sql, resources_rc
+from src.utils import sql, backup, resources_rc
+from src.context import archive
+from src.context.base import get_cached_workflow_ids
 from src.system.base import SystemManager
 
 import logging
@@ -341,6 +343,7 @@ class Main(QMainWindow):
     new_sentence_signal = Signal(str, int, str)
     finished_signal = Signal()
     error_occurred = Signal(str)
+    message_save_failed = Signal(str)
     title_update_signal = Signal(str)
 
     mouseEntered = Signal()
@@ -477,6 +480,7 @@ class Main(QMainWindow):
         self.new_sentence_signal.connect(self.page_chat.new_sentence, Qt.QueuedConnection)
         self.finished_signal.connect(self.page_chat.on_receive_finished, Qt.QueuedConnection)
         self.error_occurred.connect(self.page_chat.on_error_occurred, Qt.QueuedConnection)
+        self.message_save_failed.connect(self.page_chat.on_message_save_failed, Qt.QueuedConnection)
         self.title_update_signal.connect(self.page_chat.on_title_update, Qt.QueuedConnection)
         self.oldPosition = None
         self.expanded = False
@@ -489,6 +493,15 @@ class Main(QMainWindow):
         self.page_chat.load()
         self.page_settings.pages['System'].toggle_dev_mode()
 
+        archive.start_background_archive(
+            days=app_config.get('system.archive_chats_after_days', 0),
+            get_in_use_ids=lambda: {self.page_chat.workflow.id} | get_cached_workflow_ids(),
+        )
+        backup.start_backup_schedule(
+            interval_hours=app_config.get('system.backup_every_hours', backup.DEFAULT_BACKUP_EVERY_HOURS),
+            keep=app_config.get('system.backups_to_keep', backup.DEFAULT_BACKUPS_TO_KEEP),
+        )
+
         self.sidebar.btn_new_context.setFocus()
         self.apply_stylesheet()
         self.activateWindow()
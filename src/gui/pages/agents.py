@@ -100,9 +100,9 @@ class Page_Contacts(ContentPage):
                 # db_config_field='config',
                 query="""
                     SELECT
-                        COALESCE(json_extract(config, '$."info.name"'), name) AS name,
+                        COALESCE(info_name, name) AS name,
                         id,
-                        json_extract(config, '$."info.avatar_path"') AS avatar,
+                        info_avatar_path AS avatar,
                         config,
                         '' AS chat_button,
                         folder_id
@@ -7,21 +7,24 @@ from PySide6.QtGui import Qt, QIcon, QPixmap
 from src.utils.helpers import path_to_pixmap, display_messagebox, block_signals
 from src.utils import sql, llm
 
-from src.context.messages import Message
+from src.context import summaries
+from src.context.messages import Message, MAX_LOADED_MESSAGES
 
 from src.gui.components.group_settings import GroupSettings
 from src.gui.components.bubbles import MessageContainer
 from src.gui.widgets.base import IconButton
 from src.gui.components.config import CHBoxLayout, CVBoxLayout
 
+LOAD_OLDER_SCROLL_MARGIN = 200  # pixels from the top of the chat where older messages are loaded
+
 
 class Page_Chat(QWidget):
     def __init__(self, main):
         super().__init__(parent=main)
-        from src.context.base import Workflow
+        from src.context.base import get_workflow
 
         self.main = main
-        self.workflow = Workflow(main=self.main)
+        self.workflow = get_workflow(self.main)
 
         # self.temp_thread_lock = threading.Lock()
         self.threadpool = QThreadPool()
@@ -47,6 +50,8 @@ class Page_Chat(QWidget):
         self.scroll_area.setWidgetResizable(True)
 
         self.layout.addWidget(self.scroll_area)
+        self.loading_older = False
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self.on_scroll)
 
         self.attachment_bar = self.Attachment_Bar(self)
         self.layout.addWidget(self.attachment_bar)
@@ -61,9 +66,9 @@ class Page_Chat(QWidget):
         self.refresh()
 
     def load_context(self):
-        from src.context.base import Workflow
+        from src.context.base import get_workflow
         workflow_id = self.workflow.id if self.workflow else None
-        self.workflow = Workflow(main=self.main, context_id=workflow_id)
+        self.workflow = get_workflow(self.main, context_id=workflow_id)
 
     def refresh(self):
         with self.workflow.message_history.thread_lock:
@@ -441,7 +446,11 @@ class Page_Chat(QWidget):
         else:
             self.send_message(self.main.message_text.toPlainText(), clear_input=True)
 
-    def send_message(self, message, role='user', clear_input=False):
+    def send_message(self, message, role='user', clear_input=False, rerun_member_ids=None):
+        """
+        Saves the message and runs the workflow. `rerun_member_ids` is given for a rerun or resend, the other
+        members replay what they saved before when their inputs are the same.
+        """
         # check if threadpool is active
         if self.threadpool.activeThreadCount() > 0:
             return
@@ -452,6 +461,10 @@ class Page_Chat(QWidget):
         if not new_msg:
             return
 
+        if rerun_member_ids is not None:
+            self.workflow.reuse_runs = True
+            self.workflow.rerun_member_ids = set(rerun_member_ids)
+
         self.main.send_button.update_icon(is_generating=True)
 
         if clear_input:
@@ -463,7 +476,19 @@ class Page_Chat(QWidget):
         #     # msg = Message(msg_id=-1, role='user', content=new_msg.content)
         #     self.insert_bubble(new_msg)
 
-        self.workflow.message_history.load_branches()  # todo - figure out a nicer way to load this only when needed
+        self.refresh()
+        QTimer.singleShot(5, self.after_send_message)
+
+    def rerun_members(self, rerun_member_ids):
+        """Runs the workflow again for the last message, only `rerun_member_ids` and the members after them run"""
+        if self.threadpool.activeThreadCount() > 0:
+            return
+
+        self.last_member_msgs.clear()
+        self.workflow.reuse_runs = True
+        self.workflow.rerun_member_ids = set(rerun_member_ids)
+        self.main.send_button.update_icon(is_generating=True)
+
         self.refresh()
         QTimer.singleShot(5, self.after_send_message)
 
@@ -492,7 +517,7 @@ class Page_Chat(QWidget):
     def on_error_occurred(self, error):
         with self.workflow.message_history.thread_lock:
             self.last_member_msgs.clear()
-        self.workflow.responding = False
+        self.workflow.finish_response()
         self.main.send_button.update_icon(is_generating=False)
         self.decoupled_scroll = False
 
@@ -503,16 +528,34 @@ class Page_Chat(QWidget):
             buttons=QMessageBox.Ok
         )
 
+    def on_message_save_failed(self, error):
+        # The message is already out of the history, the chat is reloaded from the db to drop its bubble
+        if self.workflow.responding:
+            self.workflow.reload_pending = True
+        else:
+            self.load()
+
+        display_messagebox(
+            icon=QMessageBox.Critical,
+            text=f"A message could not be saved: {error}",
+            title="Save Error",
+            buttons=QMessageBox.Ok
+        )
+
     @Slot()
     def on_receive_finished(self):
         with self.workflow.message_history.thread_lock:
             self.last_member_msgs.clear()
-        self.workflow.responding = False
+        reloaded = self.workflow.reload_pending
+        self.workflow.finish_response()
         self.main.send_button.update_icon(is_generating=False)
         self.decoupled_scroll = False
 
+        if reloaded:
+            self.clear_bubbles()  # e.g. a message that failed to save is gone from the reloaded history
         self.refresh()
         self.try_generate_title()
+        self.start_summarizer()
 
     def try_generate_title(self):
         current_title = self.workflow.chat_title
@@ -524,12 +567,23 @@ class Page_Chat(QWidget):
 
         if not auto_title:
             return
-        if not self.workflow.message_history.count(incl_roles=('user',)) == 1:
+        message_history = self.workflow.message_history
+        if message_history.has_older or not message_history.count(incl_roles=('user',)) == 1:
             return
 
         title_runnable = self.AutoTitleRunnable(self)
         self.threadpool.start(title_runnable)
 
+    def start_summarizer(self):
+        system_config = self.main.system.config.dict
+        if not system_config.get('system.summarize_long_chats', False):
+            return
+
+        model_name = system_config.get('system.summary_model', 'gpt-3.5-turbo')
+        model_obj = (model_name, self.main.system.models.get_llm_parameters(model_name))
+        context_path = self.workflow.message_history.branch_tree.get_path(self.workflow.leaf_id)
+        summaries.start_summarizer(context_path, model_obj)
+
     class AutoTitleRunnable(QRunnable):
         def __init__(self, parent):
             super().__init__()
@@ -561,17 +615,18 @@ class Page_Chat(QWidget):
             self.topbar.title_label.setCursorPosition(0)
         self.topbar.title_edited(title)
 
-    def insert_bubble(self, message=None):
+    def insert_bubble(self, message=None, index=None):
 
         msg_container = MessageContainer(self, message=message)
 
-        # if message.role == 'assistant':
-        #     member_id = message.member_id
-        #     if member_id:
-        #         self.last_member_msgs[member_id] = msg_container
-        self.last_member_msgs[(message.role, message.member_id)] = msg_container
+        if index is None:
+            # if message.role == 'assistant':
+            #     member_id = message.member_id
+            #     if member_id:
+            #         self.last_member_msgs[member_id] = msg_container
+            self.last_member_msgs[(message.role, message.member_id)] = msg_container
+            index = len(self.chat_bubbles)
 
-        index = len(self.chat_bubbles)
         self.chat_bubbles.insert(index, msg_container)
         self.chat_scroll_layout.insertWidget(index, msg_container)
 
@@ -609,89 +664,147 @@ class Page_Chat(QWidget):
             if index <= len(self.workflow.message_history.messages) - 1:
                 self.workflow.message_history.messages[:] = self.workflow.message_history.messages[:index]
 
+    def on_scroll(self, value):
+        if self.loading_older:
+            return
+        scroll_bar = self.scroll_area.verticalScrollBar()
+        if value < LOAD_OLDER_SCROLL_MARGIN and scroll_bar.maximum() > 0:
+            QTimer.singleShot(0, self.load_older_bubbles)
+        elif value >= scroll_bar.maximum() - 10 and len(self.chat_bubbles) > MAX_LOADED_MESSAGES:
+            QTimer.singleShot(0, self.evict_older_bubbles)
+
+    def load_older_bubbles(self):
+        """Adds bubbles for the page of messages before the first bubble, keeping the scroll position"""
+        if self.loading_older or not self.chat_bubbles:
+            return False
+        message_history = self.workflow.message_history
+        first_msg_id = self.chat_bubbles[0].bubble.msg_id
+        # A token budget may have loaded older messages already
+        older_messages = [msg for msg in message_history.messages if msg.id < first_msg_id]
+        if not older_messages:
+            older_messages = message_history.load_older()
+        if not older_messages:
+            return False
+
+        self.loading_older = True
+        try:
+            scroll_bar = self.scroll_area.verticalScrollBar()
+            scroll_pos, scroll_max = scroll_bar.value(), scroll_bar.maximum()
+            with message_history.thread_lock:
+                for index, msg in enumerate(older_messages):
+                    self.insert_bubble(msg, index=index)
+            QApplication.processEvents()  # process GUI events to update content size
+            scroll_bar.setValue(scroll_pos + scroll_bar.maximum() - scroll_max)
+        finally:
+            self.loading_older = False
+        return True
+
+    def evict_older_bubbles(self):
+        """Removes the oldest bubbles and their messages once far more are loaded than can be seen"""
+        message_history = self.workflow.message_history
+        message_history.evict_older()
+        if not message_history.messages:
+            return
+        oldest_msg_id = message_history.messages[0].id
+        with message_history.thread_lock:
+            while self.chat_bubbles and 0 < self.chat_bubbles[0].bubble.msg_id < oldest_msg_id:
+                bubble_container = self.chat_bubbles.pop(0)
+                self.chat_scroll_layout.removeWidget(bubble_container)
+                bubble_container.hide()  # can't use deleteLater()
+
+    def scroll_to_message(self, msg_id):
+        msg_container = next((c for c in self.chat_bubbles if c.bubble.msg_id == msg_id), None)
+        while msg_container is None and self.chat_bubbles and msg_id < self.chat_bubbles[0].bubble.msg_id:
+            if not self.load_older_bubbles():
+                break
+            msg_container = next((c for c in self.chat_bubbles if c.bubble.msg_id == msg_id), None)
+        if msg_container is None:
+            return
+        QApplication.processEvents()  # process GUI events to update content size
+        self.scroll_area.ensureWidgetVisible(msg_container)
+
     def scroll_to_end(self):
         QApplication.processEvents()  # process GUI events to update content size todo?
         scrollbar = self.main.page_chat.scroll_area.verticalScrollBar()
         scrollbar.setValue(scrollbar.maximum())
 
     def new_context(self, copy_context_id=None, agent_id=None):
-        sql.execute("INSERT INTO contexts (id) VALUES (NULL)")
-        context_id = sql.get_scalar("SELECT MAX(id) FROM contexts")
-        if copy_context_id:
-            copied_cm_id_list = sql.get_results("""
-                SELECT
-                    cm.id
-                FROM contexts_members cm
-                WHERE cm.context_id = ?
-                    AND cm.del = 0
-                ORDER BY cm.id""", (copy_context_id,), return_type='list')
-
-            sql.execute(f"""
-                INSERT INTO contexts_members (
-                    context_id,
-                    agent_id,
-                    agent_config,
-                    ordr,
-                    loc_x,
-                    loc_y
-                ) 
-                SELECT
-                    ?,
-                    cm.agent_id,
-                    cm.agent_config,
-                    cm.ordr,
-                    cm.loc_x,
-                    cm.loc_y
-                FROM contexts_members cm
-                WHERE cm.context_id = ?
-                    AND cm.del = 0
-                ORDER BY cm.id""",
-                        (context_id, copy_context_id))
-
-            pasted_cm_id_list = sql.get_results("""
-                SELECT
-                    cm.id
-                FROM contexts_members cm
-                WHERE cm.context_id = ?
-                    AND cm.del = 0
-                ORDER BY cm.id""", (context_id,), return_type='list')
-
-            mapped_cm_id_dict = dict(zip(copied_cm_id_list, pasted_cm_id_list))
-            # mapped_cm_id_dict[0] = 0
-
-            # Insert into contexts_members_inputs where member_id and input_member_id are switched to the mapped ids
-            existing_context_members_inputs = sql.get_results("""
-                SELECT cmi.id, cmi.member_id, cmi.input_member_id, cmi.type
-                FROM contexts_members_inputs cmi
-                LEFT JOIN contexts_members cm
-                    ON cm.id=cmi.member_id
-                WHERE cm.context_id = ?""",
-                                                              (copy_context_id,))
-
-            for cmi in existing_context_members_inputs:
-                cmi = list(cmi)
-                # cmi[1] = 'NULL' if cmi[1] is None else mapped_cm_id_dict[cmi[1]]
-                cmi[1] = mapped_cm_id_dict[cmi[1]]
-                cmi[2] = None if cmi[2] is None else mapped_cm_id_dict[cmi[2]]
-
-                sql.execute("""
+        with sql.transaction() as tx:
+            context_id = tx.execute("INSERT INTO contexts (id) VALUES (NULL)")
+            if copy_context_id:
+                copied_cm_id_list = sql.get_results("""
+                    SELECT
+                        cm.id
+                    FROM contexts_members cm
+                    WHERE cm.context_id = ?
+                        AND cm.del = 0
+                    ORDER BY cm.id""", (copy_context_id,), return_type='list')
+
+                tx.execute(f"""
+                    INSERT INTO contexts_members (
+                        context_id,
+                        agent_id,
+                        agent_config,
+                        ordr,
+                        loc_x,
+                        loc_y
+                    ) 
+                    SELECT
+                        ?,
+                        cm.agent_id,
+                        cm.agent_config,
+                        cm.ordr,
+                        cm.loc_x,
+                        cm.loc_y
+                    FROM contexts_members cm
+                    WHERE cm.context_id = ?
+                        AND cm.del = 0
+                    ORDER BY cm.id""",
+                           (context_id, copy_context_id))
+
+                pasted_cm_id_list = sql.get_results("""
+                    SELECT
+                        cm.id
+                    FROM contexts_members cm
+                    WHERE cm.context_id = ?
+                        AND cm.del = 0
+                    ORDER BY cm.id""", (context_id,), return_type='list')
+
+                mapped_cm_id_dict = dict(zip(copied_cm_id_list, pasted_cm_id_list))
+                # mapped_cm_id_dict[0] = 0
+
+                # Insert into contexts_members_inputs where member_id and input_member_id are switched to the mapped ids
+                existing_context_members_inputs = sql.get_results("""
+                    SELECT cmi.id, cmi.member_id, cmi.input_member_id, cmi.type
+                    FROM contexts_members_inputs cmi
+                    LEFT JOIN contexts_members cm
+                        ON cm.id=cmi.member_id
+                    WHERE cm.context_id = ?""",
+                                                                  (copy_context_id,))
+
+                tx.executemany("""
                     INSERT INTO contexts_members_inputs
                         (member_id, input_member_id, type)
                     VALUES
-                        (?, ?, ?)""", (cmi[1], cmi[2], cmi[3]))
-
-        elif agent_id is not None:
-            sql.execute("""
-                INSERT INTO contexts_members
-                    (context_id, agent_id, agent_config)
-                SELECT
-                    ?, id, config
-                FROM agents
-                WHERE id = ?""", (context_id, agent_id))
+                        (?, ?, ?)""", [
+                    (mapped_cm_id_dict[member_id],
+                     None if input_member_id is None else mapped_cm_id_dict[input_member_id],
+                     input_type)
+                    for _, member_id, input_member_id, input_type in existing_context_members_inputs
+                ])
+
+            elif agent_id is not None:
+                tx.execute("""
+                    INSERT INTO contexts_members
+                        (context_id, agent_id, agent_config)
+                    SELECT
+                        ?, id, config
+                    FROM agents
+                    WHERE id = ?""", (context_id, agent_id))
 
         self.goto_context(context_id)
         self.main.page_chat.load()
 
     def goto_context(self, context_id=None):
-        from src.context.base import Workflow
-        self.main.page_chat.workflow = Workflow(main=self.main, context_id=context_id)
\ No newline at end of file
+        from src.context.base import get_workflow
+        self.main.page_chat.workflow = get_workflow(self.main, context_id=context_id)
\ No newline at end of file
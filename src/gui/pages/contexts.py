@@ -1,10 +1,31 @@
+import html
+import logging
+import threading
 
+from PySide6.QtCore import QTimer, Signal
+from PySide6.QtGui import Qt
 from PySide6.QtWidgets import *
+from src.context import archive
+from src.context.search import search_messages, reveal_message
 from src.gui.components.config import ConfigTree
-from src.gui.widgets.base import ContentPage
+from src.gui.widgets.base import ContentPage, ToggleButton
+
+ARCHIVED_CONTEXTS_QUERY = """
+    SELECT
+        summary,
+        context_id,
+        display_name AS name,
+        avatar_paths,
+        '' AS goto_button,
+        folder_id
+    FROM archive.archived_contexts
+    ORDER BY
+        last_message_unix DESC;"""
 
 
 class Page_Contexts(ContentPage):
+    search_finished = Signal(str, list)  # (searched text, results)
+
     def __init__(self, main):
         super().__init__(main=main, title='Chats')
         self.tree_config = ConfigTree(
@@ -14,31 +35,15 @@ class Page_Contexts(ContentPage):
                 SELECT
                     c.summary,
                     c.id,
-                    CASE WHEN COUNT(a.name) > 1 THEN
-                        CAST(COUNT(a.name) AS TEXT) || ' members'
-                    ELSE
-                        MAX(a.name)
-                    END as name,
-                    group_concat(json_extract(a.config, '$."info.avatar_path"'), ';') as avatar_paths,
+                    cs.display_name AS name,
+                    cs.avatar_paths,
                     '' AS goto_button,
                     c.folder_id
-                FROM contexts c
-                LEFT JOIN contexts_members cm
-                    ON c.id = cm.context_id
-                    AND cm.del != 1
-                LEFT JOIN agents a
-                    ON cm.agent_id = a.id
-                LEFT JOIN (
-                    SELECT
-                        context_id,
-                        MAX(id) as latest_message_id
-                    FROM contexts_messages
-                    GROUP BY context_id
-                ) cmsg ON c.id = cmsg.context_id
-                WHERE c.parent_id IS NULL
-                GROUP BY c.id
+                FROM context_summary cs
+                JOIN contexts c
+                    ON c.id = cs.context_id
                 ORDER BY
-                    COALESCE(cmsg.latest_message_id, 0) DESC;""",
+                    cs.last_message_id DESC;""",
             schema=[
                 {
                     'text': 'summary',
@@ -87,13 +92,100 @@ class Page_Contexts(ContentPage):
         self.tree_config.build_schema()
 
         self.tree_config.tree.itemDoubleClicked.connect(self.on_row_double_clicked)
+        self.tree_config.tree_buttons.btn_search.toggled.connect(self.toggle_search)
+        self.contexts_query = self.tree_config.query
+
+        self.btn_archived = ToggleButton(
+            parent=self.tree_config.tree_buttons,
+            icon_path=':/resources/icon-pull.png',
+            tooltip='Archived chats',
+            size=18,
+        )
+        self.btn_archived.toggled.connect(self.toggle_archived)
+        tree_buttons_layout = self.tree_config.tree_buttons.layout
+        tree_buttons_layout.insertWidget(tree_buttons_layout.count() - 1, self.btn_archived)
+
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText('Search messages...')
+        self.search_box.setFixedWidth(600)
+        self.search_box.textChanged.connect(lambda: self.search_timer.start())
+        self.search_box.hide()
+
+        # Wait for a pause in typing before searching
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(self.search)
+        self.search_finished.connect(self.show_search_results)
+
+        self.search_results = QListWidget()
+        self.search_results.setFixedSize(600, 560)
+        self.search_results.itemDoubleClicked.connect(self.on_search_result_double_clicked)
+        self.search_results.hide()
 
         self.layout.addWidget(self.tree_config)
+        self.layout.addWidget(self.search_box)
+        self.layout.addWidget(self.search_results)
         self.layout.addStretch(1)
 
     def load(self):
         self.tree_config.load()
 
+    def toggle_archived(self, checked):
+        if checked:
+            archive.attach()
+            self.tree_config.query = ARCHIVED_CONTEXTS_QUERY
+        else:
+            self.tree_config.query = self.contexts_query
+        self.tree_config.tree_buttons.btn_del.setVisible(not checked)
+        self.tree_config.load()
+
+    def toggle_search(self, checked):
+        self.tree_config.tree.setVisible(not checked)
+        self.search_box.setVisible(checked)
+        self.search_results.setVisible(checked)
+        if checked:
+            self.search_box.setFocus()
+            self.search()
+
+    def search(self):
+        """Searches in a background thread, every match is ranked so a common word can take a moment"""
+        text = self.search_box.text()
+
+        def run():
+            try:
+                results = search_messages(text)
+            except Exception as e:
+                logging.error(f'Search failed: {e}')
+                results = []
+            self.search_finished.emit(text, results)
+
+        threading.Thread(target=run, name='search', daemon=True).start()
+
+    def show_search_results(self, text, results):
+        if text != self.search_box.text():
+            return  # the text changed while searching, a newer search shows its results
+        self.search_results.clear()
+        for result in results:
+            label = QLabel(f"<b>{html.escape(result['summary'] or '')}</b><br>{result['role']}: {result['snippet']}")
+            label.setWordWrap(True)
+            label.setTextFormat(Qt.RichText)
+
+            item = QListWidgetItem(self.search_results)
+            item.setData(Qt.UserRole, result['msg_id'])
+            item.setSizeHint(label.sizeHint())
+            self.search_results.setItemWidget(item, label)
+
+    def on_search_result_double_clicked(self, item):
+        if self.main.page_chat.workflow.responding:
+            return
+        msg_id = item.data(Qt.UserRole)
+        root_id = reveal_message(msg_id)
+        if root_id is None:
+            return
+        self.chat_with_context(root_id)
+        QTimer.singleShot(0, lambda: self.main.page_chat.scroll_to_message(msg_id))
+
     def on_row_double_clicked(self):
         context_id = self.tree_config.get_selected_item_id()
         if not context_id:
@@ -109,6 +201,10 @@ class Page_Contexts(ContentPage):
     def chat_with_context(self, context_id):
         if self.main.page_chat.workflow.responding:
             return
+        if self.btn_archived.isChecked():
+            archive.restore_context(context_id)
+            self.btn_archived.setChecked(False)
+            self.btn_archived.on_click()
         self.main.page_chat.goto_context(context_id=context_id)
         self.main.content.setCurrentWidget(self.main.page_chat)
         self.main.sidebar.btn_new_context.setChecked(True)
@@ -2,13 +2,14 @@
 import json
 # import logging
 
-from PySide6.QtCore import QRegularExpression
+from PySide6.QtCore import QRegularExpression, Signal
 from PySide6.QtWidgets import *
 from PySide6.QtGui import QSyntaxHighlighter, QTextCharFormat, QColor
 
 from src.gui.components.config import ConfigPages, ConfigFields, ConfigTree, ConfigTabs, \
     ConfigJoined, ConfigJsonTree, ConfigWidget, CVBoxLayout  # , ConfigJoined
-from src.utils import sql, llm  # , config
+from src.context import archive
+from src.utils import sql, llm, backup  # , config
 from src.gui.widgets.base import ContentPage, ModelComboBox
 from src.utils.helpers import display_messagebox
 
@@ -127,11 +128,20 @@ class Page_Settings(ConfigPages):
         self.main.system.config.load()
         system_config = self.main.system.config.dict
         self.load_config(system_config)
+        backup.start_backup_schedule(
+            interval_hours=system_config.get('system.backup_every_hours', backup.DEFAULT_BACKUP_EVERY_HOURS),
+            keep=system_config.get('system.backups_to_keep', backup.DEFAULT_BACKUPS_TO_KEEP),
+        )
 
     class Page_System_Settings(ConfigFields):
+        reset_backup_finished = Signal(object)  # the path of the backup taken before a reset, None if it failed
+        restore_finished = Signal(object)  # the error of a restore, None if it succeeded
+
         def __init__(self, parent):
             super().__init__(parent=parent)
             self.parent = parent
+            self.reset_backup_finished.connect(self.finish_reset)
+            self.restore_finished.connect(self.finish_restore)
             self.label_width = 125
             self.margin_left = 20
             self.namespace = 'system'
@@ -172,11 +182,47 @@ class Page_Settings(ConfigPages):
                     'num_lines': 4,
                     'width': 360,
                 },
+                {
+                    'text': 'Summarize long chats',
+                    'type': bool,
+                    'width': 40,
+                    'default': False,
+                    'row_key': 1,
+                },
+                {
+                    'text': 'Summary model',
+                    'label_position': None,
+                    'type': 'ModelComboBox',
+                    'default': 'gpt-3.5-turbo',
+                    'row_key': 1,
+                },
                 {
                     'text': 'Voice input method',
                     'type': ('None',),
                     'default': 'None',
-                }
+                },
+                {
+                    'text': 'Archive chats after days',
+                    'type': int,
+                    'minimum': 0,
+                    'maximum': 3650,
+                    'default': 0,
+                },
+                {
+                    'text': 'Backup every hours',
+                    'type': int,
+                    'minimum': 0,
+                    'maximum': 720,
+                    'default': backup.DEFAULT_BACKUP_EVERY_HOURS,
+                    'tooltip': 'Copies the database to the backups folder on a schedule, 0 turns it off',
+                },
+                {
+                    'text': 'Backups to keep',
+                    'type': int,
+                    'minimum': 1,
+                    'maximum': 100,
+                    'default': backup.DEFAULT_BACKUPS_TO_KEEP,
+                },
             ]
 
         def after_init(self):
@@ -188,11 +234,31 @@ class Page_Settings(ConfigPages):
             self.reset_app_btn.clicked.connect(self.reset_application)
             self.layout.addWidget(self.reset_app_btn)
 
+            # add buttons to backup and restore the database
+            self.backup_btn = QPushButton('Backup Now')
+            self.backup_btn.clicked.connect(self.backup_now)
+            self.layout.addWidget(self.backup_btn)
+
+            self.restore_btn = QPushButton('Restore Backup')
+            self.restore_btn.clicked.connect(self.restore_backup)
+            self.layout.addWidget(self.restore_btn)
+
             # add button 'Fix empty titles'
             self.fix_empty_titles_btn = QPushButton('Fix Empty Titles')
             self.fix_empty_titles_btn.clicked.connect(self.fix_empty_titles)
             self.layout.addWidget(self.fix_empty_titles_btn)
 
+            # add buttons to profile sql queries
+            self.sql_profiler_btn = QPushButton('Start SQL Profiler')
+            self.sql_profiler_btn.setCheckable(True)
+            self.sql_profiler_btn.setChecked(sql.profiler.enabled)
+            self.sql_profiler_btn.toggled.connect(self.toggle_sql_profiler)
+            self.layout.addWidget(self.sql_profiler_btn)
+
+            self.sql_report_btn = QPushButton('Show SQL Report')
+            self.sql_report_btn.clicked.connect(self.show_sql_report)
+            self.layout.addWidget(self.sql_report_btn)
+
         def toggle_dev_mode(self, state=None):
             # pass
             if state is None and hasattr(self, 'dev_mode'):
@@ -203,10 +269,73 @@ class Page_Settings(ConfigPages):
             main.page_chat.topbar.group_settings.group_topbar.btn_clear.setVisible(state)
             main.page_settings.pages['System'].reset_app_btn.setVisible(state)
             main.page_settings.pages['System'].fix_empty_titles_btn.setVisible(state)
+            main.page_settings.pages['System'].sql_profiler_btn.setVisible(state)
+            main.page_settings.pages['System'].sql_report_btn.setVisible(state)
+
+        def toggle_sql_profiler(self, checked):
+            if checked:
+                sql.profiler.reset()
+                sql.profiler.enable(report_on_exit=True)
+                self.sql_profiler_btn.setText('Stop SQL Profiler')
+            else:
+                sql.profiler.disable()
+                self.sql_profiler_btn.setText('Start SQL Profiler')
+
+        def show_sql_report(self):
+            report = sql.profiler.report()
+            display_messagebox(
+                icon=QMessageBox.Information,
+                text=report if sql.profiler.stats else 'No queries recorded, start the SQL profiler first.',
+                title="SQL Report",
+            )
 
-        def reset_application(self):
-            from src.context.base import Workflow
+        def backup_now(self):
+            backup.start_backup()
+
+        def restore_backup(self):
+            path, _ = QFileDialog.getOpenFileName(self, "Choose Backup", backup.get_backup_dir(), "Database (*.db)")
+            if not path:
+                return
 
+            retval = display_messagebox(
+                icon=QMessageBox.Warning,
+                text="Are you sure you want to restore this backup? The current database will be backed up first.",
+                title="Restore Backup",
+                buttons=QMessageBox.Ok | QMessageBox.Cancel,
+            )
+            if retval != QMessageBox.Ok:
+                return
+
+            # The current db is backed up and replaced in the background, the app reloads when it has finished
+            self.restore_btn.setEnabled(False)
+            backup.start_restore(path, on_finished=self.restore_finished.emit)
+
+        def finish_restore(self, error):
+            from src.context.base import get_workflow, clear_workflow_cache
+
+            self.restore_btn.setEnabled(True)
+            if error is not None:
+                messages = {
+                    'NO_DB': "The file is not an Agent Pilot database.",
+                    'OUTDATED_APP': "The backup originates from a newer version of Agent Pilot.",
+                    'CORRUPT_BACKUP': "The backup is corrupt.",
+                }
+                display_messagebox(
+                    icon=QMessageBox.Critical,
+                    text=messages.get(error, f"Could not restore the backup: {error}"),
+                    title="Restore Backup",
+                )
+                return
+
+            main = self.parent.main
+            main.system.load()
+            clear_workflow_cache()
+            main.page_chat.workflow = get_workflow(main)
+            main.page_chat.load()
+            self.parent.load_config(main.system.config.dict)
+            self.load()
+
+        def reset_application(self):
             retval = display_messagebox(
                 icon=QMessageBox.Warning,
                 text="Are you sure you want to permanently reset the database and config? This will permanently delete all contexts, messages, and logs.",
@@ -217,15 +346,38 @@ class Page_Settings(ConfigPages):
             if retval != QMessageBox.Ok:
                 return
 
-            sql.execute('DELETE FROM contexts_messages')
-            sql.execute('DELETE FROM contexts_members')
-            sql.execute('DELETE FROM contexts')
-            sql.execute('DELETE FROM embeddings WHERE id > 1984')
-            sql.execute('DELETE FROM logs')
+            # The backup runs in the background, the reset is done when it has finished
+            self.reset_app_btn.setEnabled(False)
+            backup.start_backup(label='before_reset', on_finished=self.reset_backup_finished.emit)
+
+        def finish_reset(self, backup_path):
+            from src.context.base import get_workflow, clear_workflow_cache
+
+            self.reset_app_btn.setEnabled(True)
+            if backup_path is None:
+                display_messagebox(
+                    icon=QMessageBox.Critical,
+                    text="Could not back up the database, so it was not reset.",
+                    title="Reset Database",
+                    buttons=QMessageBox.Ok,
+                )
+                return
+
+            archive.attach()
+            with sql.transaction() as tx:
+                tx.execute('DELETE FROM contexts_messages')
+                tx.execute('DELETE FROM contexts_members')
+                tx.execute('DELETE FROM contexts')
+                tx.execute('DELETE FROM embeddings WHERE id > 1984')
+                tx.execute('DELETE FROM logs')
+                tx.execute('DELETE FROM llm_output_cache')
+                archive.clear_archive(tx)
             sql.execute('VACUUM')
+            sql.execute('VACUUM archive')
             # self.parent.update_config('system.dev_mode', False)
             # self.toggle_dev_mode(False)
-            self.parent.main.page_chat.workflow = Workflow(main=self.parent.main)
+            clear_workflow_cache()
+            self.parent.main.page_chat.workflow = get_workflow(self.parent.main)
             self.load()
 
         def fix_empty_titles(self):
@@ -341,27 +493,28 @@ class Page_Settings(ConfigPages):
                         },
                     },
                 }
-                sql.execute("""
-                    UPDATE `settings` SET `value` = json_set(value, '$."display.primary_color"', ?) WHERE `field` = 'app_config'
-                """, (themes[theme_name]['display']['primary_color'],))
-                sql.execute("""
-                    UPDATE `settings` SET `value` = json_set(value, '$."display.secondary_color"', ?) WHERE `field` = 'app_config'
-                """, (themes[theme_name]['display']['secondary_color'],))
-                sql.execute("""
-                    UPDATE `settings` SET `value` = json_set(value, '$."display.text_color"', ?) WHERE `field` = 'app_config'
-                """, (themes[theme_name]['display']['text_color'],))
-                sql.execute("""
-                    UPDATE `roles` SET `config` = json_set(config, '$."bubble_bg_color"', ?) WHERE `name` = 'user'
-                """, (themes[theme_name]['user']['bubble_bg_color'],))
-                sql.execute("""
-                    UPDATE `roles` SET `config` = json_set(config, '$."bubble_text_color"', ?) WHERE `name` = 'user'
-                """, (themes[theme_name]['user']['bubble_text_color'],))
-                sql.execute("""
-                    UPDATE `roles` SET `config` = json_set(config, '$."bubble_bg_color"', ?) WHERE `name` = 'assistant'
-                """, (themes[theme_name]['assistant']['bubble_bg_color'],))
-                sql.execute("""
-                    UPDATE `roles` SET `config` = json_set(config, '$."bubble_text_color"', ?) WHERE `name` = 'assistant'
-                """, (themes[theme_name]['assistant']['bubble_text_color'],))
+                with sql.transaction() as tx:
+                    tx.execute("""
+                        UPDATE `settings` SET `value` = json_set(value, '$."display.primary_color"', ?) WHERE `field` = 'app_config'
+                    """, (themes[theme_name]['display']['primary_color'],))
+                    tx.execute("""
+                        UPDATE `settings` SET `value` = json_set(value, '$."display.secondary_color"', ?) WHERE `field` = 'app_config'
+                    """, (themes[theme_name]['display']['secondary_color'],))
+                    tx.execute("""
+                        UPDATE `settings` SET `value` = json_set(value, '$."display.text_color"', ?) WHERE `field` = 'app_config'
+                    """, (themes[theme_name]['display']['text_color'],))
+                    tx.execute("""
+                        UPDATE `roles` SET `config` = json_set(config, '$."bubble_bg_color"', ?) WHERE `name` = 'user'
+                    """, (themes[theme_name]['user']['bubble_bg_color'],))
+                    tx.execute("""
+                        UPDATE `roles` SET `config` = json_set(config, '$."bubble_text_color"', ?) WHERE `name` = 'user'
+                    """, (themes[theme_name]['user']['bubble_text_color'],))
+                    tx.execute("""
+                        UPDATE `roles` SET `config` = json_set(config, '$."bubble_bg_color"', ?) WHERE `name` = 'assistant'
+                    """, (themes[theme_name]['assistant']['bubble_bg_color'],))
+                    tx.execute("""
+                        UPDATE `roles` SET `config` = json_set(config, '$."bubble_text_color"', ?) WHERE `name` = 'assistant'
+                    """, (themes[theme_name]['assistant']['bubble_text_color'],))
                 system = self.parent.parent.main.system
                 system.config.load()
                 system.roles.load()
@@ -692,6 +845,17 @@ class Page_Settings(ConfigPages):
                                     'step': 1,
                                     'default': 100,
                                 },
+                                {
+                                    'text': 'Seed',
+                                    'type': int,
+                                    'has_toggle': True,
+                                    'label_width': 125,
+                                    'minimum': 0,
+                                    'maximum': 999999,
+                                    'step': 1,
+                                    'tooltip': 'Sampling seed, for APIs that support it. Makes responses repeatable, so they can be cached',
+                                    'default': 0,
+                                },
                             ]
 
                 class Tab_Chat_Config(ConfigFields):
@@ -988,6 +1152,17 @@ class Page_Settings(ConfigPages):
                                     'step': 1,
                                     'default': 100,
                                 },
+                                {
+                                    'text': 'Seed',
+                                    'type': int,
+                                    'has_toggle': True,
+                                    'label_width': 125,
+                                    'minimum': 0,
+                                    'maximum': 999999,
+                                    'step': 1,
+                                    'tooltip': 'Sampling seed, for APIs that support it. Makes responses repeatable, so they can be cached',
+                                    'default': 0,
+                                },
                             ]
 
                 class Tab_TTS_Config(ConfigFields):
@@ -445,10 +445,10 @@ class ModelComboBox(BaseComboBox):
                 SELECT
                     m.name,
                     CASE
-                    WHEN json_extract(a.config, '$.litellm_prefix') != '' THEN
-                        json_extract(a.config, '$.litellm_prefix') || '/' || json_extract(m.config, '$.model_name')
+                    WHEN a.litellm_prefix != '' THEN
+                        a.litellm_prefix || '/' || m.model_name
                         ELSE
-                            json_extract(m.config, '$.model_name')
+                            m.model_name
                     END AS model_name,
                     a.name AS api_name
                 FROM models m
@@ -688,9 +688,9 @@ class ListDialog(QDialog):
                     SELECT 'Empty agent' AS name, 0 AS id, NULL AS avatar
                     UNION
                     SELECT
-                        json_extract(config, '$."info.name"') AS name,
+                        info_name AS name,
                         id,
-                        COALESCE(json_extract(config, '$."info.avatar_path"'), '') AS avatar
+                        COALESCE(info_avatar_path, '') AS avatar
                     FROM agents
                 )
                 ORDER BY
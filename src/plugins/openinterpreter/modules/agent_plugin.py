@@ -56,6 +56,12 @@ class Open_Interpreter(Agent):
         self.agent_object = OpenInterpreter(**param_dict)  # None  # todo
         # self.agent_object.system_message = self.config.get('context.sys_mgs', '')
 
+    def unload(self):
+        super().unload()
+        if self.agent_object is not None:
+            self.agent_object.reset()  # terminates the language subprocesses it started
+            self.agent_object = None
+
     def stream(self, *args, **kwargs):
         messages = self.workflow.message_history.get(llm_format=True, calling_member_id=self.member_id)
         last_user_msg = messages[-1]
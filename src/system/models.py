@@ -1,7 +1,11 @@
 import json
 import os
+
+import litellm
 from src.utils import sql
 
+DEFAULT_CONTEXT_WINDOW = 4096  # for models litellm doesn't know
+
 
 class ModelManager:
     def __init__(self):
@@ -12,10 +16,10 @@ class ModelManager:
         model_res = sql.get_results("""
             SELECT
                 CASE
-                    WHEN json_extract(a.config, '$.litellm_prefix') != '' THEN
-                        json_extract(a.config, '$.litellm_prefix') || '/' || json_extract(m.config, '$.model_name')
+                    WHEN a.litellm_prefix != '' THEN
+                        a.litellm_prefix || '/' || m.model_name
                     ELSE
-                        json_extract(m.config, '$.model_name')
+                        m.model_name
                 END AS model_name,
                 m.config AS model_config,
                 a.config AS api_config,
@@ -48,9 +52,19 @@ class ModelManager:
             'presence_penalty',
             'frequency_penalty',
             'max_tokens',
+            'seed',
         ]
         model_config = self.models.get(model_name, {})
         llm_config = {k: v for k, v in model_config.items() if k in accepted_keys}
         # if 'temperature' in llm_config:
         #     llm_config['temperature'] = float(model_config['llm_config'])
         return llm_config
+
+    def get_context_window(self, model_name):
+        """Returns the max input tokens of `model_name`, a `context_window` in the model config overrides litellm's"""
+        model_config = self.models.get(model_name, {})
+        if model_config.get('context_window'):
+            return int(model_config['context_window'])
+
+        model_info = litellm.model_cost.get(model_name) or litellm.model_cost.get(model_name.split('/')[-1]) or {}
+        return model_info.get('max_input_tokens') or model_info.get('max_tokens') or DEFAULT_CONTEXT_WINDOW
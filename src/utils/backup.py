@@ -0,0 +1,188 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from src.utils import sql
+
+BACKUP_PAGES_PER_STEP = 256  # pages copied per step, 1 MB with the default 4 KB page size
+BACKUP_STEP_PAUSE = 0.005  # seconds between steps, so a backup doesn't hog the disk
+BACKUP_CHECK_INTERVAL = 60  # seconds between checks whether a scheduled backup is due
+DEFAULT_BACKUP_EVERY_HOURS = 0  # scheduled backups are opt-in
+DEFAULT_BACKUPS_TO_KEEP = 7
+
+_backup_lock = threading.Lock()  # one backup at a time
+_schedule_stop = None  # the stop event of the running schedule
+
+
+def get_backup_dir():
+    return os.path.join(os.path.dirname(sql.get_db_path()), 'backups')
+
+
+def list_backups():
+    """Returns the paths of all backups, newest first"""
+    backup_dir = get_backup_dir()
+    if not os.path.isdir(backup_dir):
+        return []
+    paths = [os.path.join(backup_dir, filename) for filename in os.listdir(backup_dir)
+             if filename.startswith('data_') and filename.endswith('.db')]
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+
+def create_backup(label='', dest_path=None):
+    """
+    Copies the db to `dest_path`, or a timestamped file in the backups folder, and returns its path.
+    Pages are copied in small steps from a snapshot of the db, so writers aren't blocked while it runs.
+    """
+    if dest_path is None:
+        filename = 'data_' + datetime.now().strftime('%Y%m%d_%H%M%S') + (f'_{label}' if label else '') + '.db'
+        dest_path = os.path.join(get_backup_dir(), filename)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    temp_path = dest_path + '.tmp'
+
+    with _backup_lock:
+        sql.flush()  # include writes that are still queued
+        src_conn = sqlite3.connect(sql.get_db_path(), isolation_level=None)
+        dest_conn = sqlite3.connect(temp_path, isolation_level=None)
+        try:
+            # A read transaction pins the snapshot, otherwise a commit by another connection restarts the copy
+            src_conn.execute('BEGIN')
+            src_conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            src_conn.backup(dest_conn, pages=BACKUP_PAGES_PER_STEP,
+                            progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_PAUSE))
+            src_conn.execute('COMMIT')
+            # A single self-contained file, without a -wal
+            dest_conn.execute('PRAGMA journal_mode = DELETE')
+        except BaseException:
+            dest_conn.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            src_conn.close()
+        dest_conn.close()
+        os.replace(temp_path, dest_path)
+
+    logging.debug(f'Backed up database to {dest_path}')
+    return dest_path
+
+
+def start_backup(label='', on_finished=None):
+    """Runs `create_backup` in a background thread, `on_finished(path)` is called from that thread"""
+    def run():
+        try:
+            path = create_backup(label=label)
+        except Exception as e:
+            logging.error(f'Backup failed: {e}')
+            path = None
+        if on_finished:
+            on_finished(path)
+
+    thread = threading.Thread(target=run, name='backup', daemon=True)
+    thread.start()
+    return thread
+
+
+def prune_backups(keep):
+    """Deletes all but the newest `keep` scheduled backups, labeled backups are kept"""
+    scheduled = [path for path in list_backups() if _backup_label(path) == '']
+    for path in scheduled[keep:]:
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error(f'Could not delete old backup {path}: {e}')
+
+
+def restore_backup(backup_path):
+    """
+    Replaces the db with `backup_path`, after checking it's a valid db that this version of the app can open.
+    The current db is backed up first, and the restored db is upgraded if it's from an older version.
+    """
+    from src.utils.sql_upgrade import upgrade_script, versions
+
+    db_version = sql.check_database_upgrade(backup_path)  # raises if it's not a db, or from a newer app
+    conn = sqlite3.connect(backup_path)
+    try:
+        integrity = conn.execute('PRAGMA quick_check').fetchone()[0]
+    finally:
+        conn.close()
+    if integrity != 'ok':
+        raise Exception('CORRUPT_BACKUP')
+
+    create_backup(label='before_restore')
+
+    # Copied into the db in place rather than replacing the file, other threads may still have it open
+    with _backup_lock:
+        sql.flush()
+        src_conn = sqlite3.connect(backup_path, isolation_level=None)
+        dest_conn = sqlite3.connect(sql.get_db_path(), isolation_level=None)
+        try:
+            src_conn.backup(dest_conn)
+        finally:
+            src_conn.close()
+            dest_conn.close()
+        sql.close_connections()  # the reserved ids were of the old db
+
+    while db_version is not None and str(db_version) != versions[-1]:
+        db_version = upgrade_script.upgrade(db_version)
+
+
+def start_restore(backup_path, on_finished=None):
+    """Runs `restore_backup` in a background thread, `on_finished(error)` is called from that thread, error is None if it succeeded"""
+    def run():
+        try:
+            restore_backup(backup_path)
+            error = None
+        except Exception as e:
+            logging.error(f'Restore failed: {e}')
+            error = str(e)
+        if on_finished:
+            on_finished(error)
+
+    thread = threading.Thread(target=run, name='restore', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_backup_schedule(interval_hours, keep):
+    """Backs up the db every `interval_hours` in a background thread, keeping the newest `keep` backups"""
+    global _schedule_stop
+    stop_backup_schedule()
+    if not interval_hours or interval_hours <= 0:
+        return
+
+    _schedule_stop = threading.Event()
+    thread = threading.Thread(target=_schedule_loop, args=(interval_hours, keep, _schedule_stop),
+                              name='backup-schedule', daemon=True)
+    thread.start()
+
+
+def stop_backup_schedule():
+    """Signals the schedule to stop without waiting, a backup in progress finishes in the background"""
+    global _schedule_stop
+    if _schedule_stop is None:
+        return
+    _schedule_stop.set()
+    _schedule_stop = None
+
+
+def _schedule_loop(interval_hours, keep, stop):
+    interval = interval_hours * 3600
+    while not stop.is_set():
+        scheduled = [path for path in list_backups() if _backup_label(path) == '']
+        last_backup_unix = os.path.getmtime(scheduled[0]) if scheduled else 0
+        if time.time() - last_backup_unix >= interval:
+            try:
+                create_backup()
+                prune_backups(keep)
+            except Exception as e:
+                logging.error(f'Scheduled backup failed: {e}')
+        stop.wait(BACKUP_CHECK_INTERVAL)
+
+
+def _backup_label(path):
+    # data_YYYYmmdd_HHMMSS[_label].db
+    parts = os.path.basename(path)[:-len('.db')].split('_', 3)
+    return parts[3] if len(parts) > 3 else ''
@@ -1,28 +1,35 @@
+import asyncio
 import time
 import litellm
 
 
-def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None, tools=None):
+def get_chat_kwargs(messages, sys_msg=None, stream=True, model_obj=None, tools=None):
     model, model_config = model_obj or ('gpt-3.5-turbo', {})
 
-    # try with backoff
     push_messages = [{'role': msg['role'], 'content': msg['content']} for msg in messages]
+    if sys_msg is not None:
+        push_messages.insert(0, {"role": "system", "content": sys_msg})
+
+    kwargs = dict(
+        model=model,
+        messages=push_messages,
+        stream=stream,
+        request_timeout=100,
+        **(model_config or {}),
+    )
+    if tools:
+        kwargs['tools'] = tools
+        kwargs['tool_choice'] = "auto"
+    return kwargs
+
+
+def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None, tools=None):
+    kwargs = get_chat_kwargs(messages, sys_msg, stream, model_obj, tools)
+
+    # try with backoff
     ex = None
     for i in range(5):
         try:
-            if sys_msg is not None: push_messages.insert(0, {"role": "system", "content": sys_msg})
-
-            kwargs = dict(
-                model=model,
-                messages=push_messages,
-                stream=stream,
-                request_timeout=100,
-                **(model_config or {}),
-            )
-            if tools:
-                kwargs['tools'] = tools
-                kwargs['tool_choice'] = "auto"
-
             return litellm.completion(**kwargs)
         except Exception as e:
             ex = e
@@ -30,6 +37,21 @@ def get_chat_response(messages, sys_msg=None, stream=True, model_obj=None, tools
     raise ex
 
 
+async def get_chat_response_async(messages, sys_msg=None, stream=True, model_obj=None, tools=None):
+    """`get_chat_response` without blocking the event loop, a stream is iterated with `async for`"""
+    kwargs = get_chat_kwargs(messages, sys_msg, stream, model_obj, tools)
+
+    # try with backoff
+    ex = None
+    for i in range(5):
+        try:
+            return await litellm.acompletion(**kwargs)
+        except Exception as e:
+            ex = e
+            await asyncio.sleep(0.3 * i)
+    raise ex
+
+
 def get_scalar(prompt, single_line=False, num_lines=0, model_obj=None):
     if single_line:
         num_lines = 1
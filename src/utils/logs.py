@@ -28,7 +28,7 @@ def insert_log(type, message, print_=True):
         # if print_ and config.get_value('system.debug'):
         #     print("\r", end="")
         #     cprint(f'{type}: {message}', 'light_grey')  # print(f'{type}: {message}')
-        sql.execute(f"INSERT INTO logs (log_type, message) VALUES (?, ?);", (type, message))
+        sql.execute_deferred(f"INSERT INTO logs (log_type, message) VALUES (?, ?);", (type, message))
 
     except Exception as e:
         print('ERROR INSERTING LOG')
@@ -0,0 +1,47 @@
+import hashlib
+import json
+import time
+
+from src.utils import sql
+
+OUTPUT_CACHE_SIZE = 2000  # cached responses kept, the least recently used are evicted past this
+IGNORED_KWARGS = ('stream', 'request_timeout', 'api_key')  # don't change the response
+
+
+def is_deterministic(model_params):
+    """Returns whether a model with `model_params` gives the same response to the same request"""
+    if model_params.get('seed') not in (None, ''):
+        return True
+    try:
+        return float(model_params.get('temperature')) == 0
+    except (TypeError, ValueError):
+        return False
+
+
+def get_key(request_kwargs):
+    """Returns the hash of an llm request, `request_kwargs` as sent to litellm by `llm.get_chat_kwargs`"""
+    request = {k: v for k, v in request_kwargs.items() if k not in IGNORED_KWARGS}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get(key):
+    """Returns the responses cached for `key` as {role: response, 'tools': {name: args}}, or None"""
+    responses = sql.get_scalar("SELECT responses FROM llm_output_cache WHERE key = ?", (key,))
+    if responses is None:
+        return None
+    sql.execute_deferred("UPDATE llm_output_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+    return json.loads(responses)
+
+
+def put(key, responses):
+    sql.execute_deferred("""
+        INSERT OR REPLACE INTO llm_output_cache (key, responses, last_used)
+        VALUES (?, ?, ?)""", (key, json.dumps(responses), time.time()))
+    sql.execute_deferred("""
+        DELETE FROM llm_output_cache
+        WHERE key IN (
+            SELECT key
+            FROM llm_output_cache
+            ORDER BY last_used DESC
+            LIMIT -1 OFFSET ?
+        )""", (OUTPUT_CACHE_SIZE,))
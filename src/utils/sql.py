@@ -1,14 +1,52 @@
+import atexit
+import logging
 import os.path
+import queue
+import re
 import sqlite3
 import sys
 import threading
+import time
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
 
 from packaging import version
 
-sql_thread_lock = threading.Lock()
+sql_thread_lock = threading.RLock()  # re-entrant so sql.execute can be called inside a transaction
 
 DB_FILEPATH = None  # None will use default
 
+# Applied to every pooled connection when it is opened
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA cache_size = -16000',  # 16 MB
+    'PRAGMA mmap_size = 268435456',  # 256 MB
+    'PRAGMA temp_store = MEMORY',
+)
+
+# One long-lived connection per thread, tracked so they can all be closed.
+# A thread's connection is closed when the thread exits, see `_ConnectionOwner`
+_thread_local = threading.local()
+_connections = set()
+_connections_lock = threading.Lock()
+_connection_generation = 0
+
+# Deferred writes are group-committed in batches by a single writer thread
+WRITE_QUEUE_MAXSIZE = 10000  # execute_deferred blocks when this many writes are queued
+WRITE_FLUSH_INTERVAL = 0.05  # seconds a batch is held open for more writes
+
+_write_queue = queue.Queue(maxsize=WRITE_QUEUE_MAXSIZE)
+_writer_thread = None
+_writer_lock = threading.Lock()
+_pending_writes = 0
+_pending_thread_writes = {}  # {thread ident: writes it queued that aren't committed yet}
+_pending_cond = threading.Condition()
+_flush_requested = threading.Event()
+_reserved_rowids = {}  # {table: last reserved rowid}
+_reserve_lock = threading.Lock()
+
 
 # def build_tables():
 #     # get data.db included in the binary
@@ -27,7 +65,9 @@ DB_FILEPATH = None  # None will use default
 
 def set_db_filepath(path: str):
     global DB_FILEPATH
+    flush()  # queued writes belong to the previous db
     DB_FILEPATH = path
+    close_connections()
 
     # # count tables in db
     # num_tables = get_scalar("SELECT count(*) FROM sqlite_master WHERE type='table'")
@@ -49,36 +89,191 @@ def get_db_path():
     return ret
 
 
+def get_connection():
+    """
+    Returns the long-lived connection of the calling thread, opening it on first use.
+    A connection is reopened if the db path has changed or `close_connections` was called.
+    """
+    db_path = get_db_path()
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is not None:
+        if _thread_local.db_path == db_path and _thread_local.generation == _connection_generation:
+            return conn
+        _discard_connection(conn)
+
+    conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+
+    with _connections_lock:
+        _connections.add(conn)
+    _thread_local.conn = conn
+    _thread_local.owner = _ConnectionOwner(conn)
+    _thread_local.db_path = db_path
+    _thread_local.generation = _connection_generation
+    return conn
+
+
+class _ConnectionOwner:
+    """
+    Kept in the thread-local data next to the connection. The data of a thread is freed when it exits,
+    which closes the connection, so threads of executors and thread pools don't leave theirs open.
+    """
+    def __init__(self, conn):
+        weakref.finalize(self, _release_connection, conn)
+
+
+def _release_connection(conn):
+    with _connections_lock:
+        _connections.discard(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def _discard_connection(conn):
+    _release_connection(conn)
+    _thread_local.conn = None
+    _thread_local.owner = None
+
+
+def close_connections():
+    """
+    Closes the calling thread's connection and marks the others stale, each thread closes and reopens its own
+    on next use. Other threads may be using theirs right now, so they aren't closed from here.
+    """
+    global _connection_generation
+    if threading.current_thread() is not _writer_thread:
+        flush()
+    with _reserve_lock:
+        _reserved_rowids.clear()
+    with _connections_lock:
+        _connection_generation += 1
+
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is not None:
+        _discard_connection(conn)
+
+
+class QueryProfiler:
+    """
+    Opt-in instrumentation of every statement run through this module.
+    Records call counts and latency histograms keyed by normalized SQL,
+    and logs statements slower than `slow_query_ms` with their query plan.
+    """
+    BUCKET_BOUNDS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)  # the last bucket counts anything slower
+
+    def __init__(self):
+        self.enabled = False
+        self.slow_query_ms = 50
+        self.report_on_exit = False
+        self.stats = {}  # {normalized_sql: {'count', 'total_ms', 'max_ms', 'histogram'}}
+        self.lock = threading.Lock()
+
+    def enable(self, slow_query_ms=None, report_on_exit=None):
+        if slow_query_ms is not None:
+            self.slow_query_ms = slow_query_ms
+        if report_on_exit is not None:
+            self.report_on_exit = report_on_exit
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    @staticmethod
+    @lru_cache(maxsize=1024)  # bounded, queries with inlined values are all different
+    def normalize(query):
+        normalized = re.sub(r"'(?:[^']|'')*'", '?', query)
+        normalized = re.sub(r'\b\d+(?:\.\d+)?\b', '?', normalized)
+        return ' '.join(normalized.split())
+
+    def record(self, query, params, start):
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        normalized = self.normalize(query)
+        bucket = len(self.BUCKET_BOUNDS_MS)
+        for i, bound in enumerate(self.BUCKET_BOUNDS_MS):
+            if elapsed_ms <= bound:
+                bucket = i
+                break
+
+        with self.lock:
+            stat = self.stats.get(normalized)
+            if stat is None:
+                stat = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'histogram': [0] * (len(self.BUCKET_BOUNDS_MS) + 1)}
+                self.stats[normalized] = stat
+            stat['count'] += 1
+            stat['total_ms'] += elapsed_ms
+            stat['max_ms'] = max(stat['max_ms'], elapsed_ms)
+            stat['histogram'][bucket] += 1
+
+        if elapsed_ms >= self.slow_query_ms:
+            logging.warning(f'Slow query ({elapsed_ms:.1f} ms): {normalized}\n{self.query_plan(query, params)}')
+
+    def query_plan(self, query, params=None):
+        try:
+            cursor = get_connection().cursor()
+            try:
+                cursor.execute(f'EXPLAIN QUERY PLAN {query}', params or ())
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        except sqlite3.Error as e:
+            return f'  (no query plan: {e})'
+        return '\n'.join(f'  {detail}' for _, _, _, detail in rows)
+
+    def report(self, top=30):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1]['total_ms'], reverse=True)
+
+        bounds = ' '.join(f'<={b:g}' for b in self.BUCKET_BOUNDS_MS) + ' >'
+        lines = [f'SQL profile, top {min(top, len(stats))} of {len(stats)} statements by total time',
+                 f'{"calls":>8}{"total ms":>11}{"mean ms":>10}{"max ms":>10}  histogram (ms: {bounds})']
+        for normalized, stat in stats[:top]:
+            mean_ms = stat['total_ms'] / stat['count']
+            histogram = ' '.join(str(n) for n in stat['histogram'])
+            lines.append(f'{stat["count"]:>8}{stat["total_ms"]:>11.1f}{mean_ms:>10.2f}{stat["max_ms"]:>10.2f}  [{histogram}]')
+            lines.append(f'    {normalized[:200]}')
+        return '\n'.join(lines)
+
+    def report_at_exit(self):
+        if self.report_on_exit and self.stats:
+            print(self.report())
+
+
+profiler = QueryProfiler()
+atexit.register(profiler.report_at_exit)
+
+
 def execute(query, params=None):
+    _wait_for_pending_writes()
     with sql_thread_lock:
-        # Connect to the database
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
-            # Create a cursor object
-            cursor = conn.cursor()
-
-            # Execute the query
+        cursor = get_connection().cursor()
+        start = time.perf_counter() if profiler.enabled else None
+        try:
+            # Execute the query, the connection is in autocommit mode
             if params:
                 cursor.execute(query, params)
             else:
                 cursor.execute(query)
 
-            # Commit the changes
-            # conn.commit()
-
-            # Close the cursor and connection
-            cursor.close()
-            # conn.close()
+            if start is not None:
+                profiler.record(query, params, start)
             return cursor.lastrowid
+        finally:
+            cursor.close()
 
 
 def get_results(query, params=None, return_type='rows', incl_column_names=False):
-    # Connect to the database
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
-        # Create a cursor object
-        cursor = conn.cursor()
-
+    _wait_for_pending_writes(own_thread=True)
+    cursor = get_connection().cursor()
+    start = time.perf_counter() if profiler.enabled else None
+    param_list = None
+    try:
         # Execute the query
         if params:
             param_list = []
@@ -93,12 +288,11 @@ def get_results(query, params=None, return_type='rows', incl_column_names=False)
 
         # Fetch all the rows as a list of tuples
         rows = cursor.fetchall()
-
-        # Close the cursor and connection
+        col_names = [description[0] for description in cursor.description]
+        if start is not None:
+            profiler.record(query, param_list, start)
+    finally:
         cursor.close()
-        # conn.close()
-
-    col_names = [description[0] for description in cursor.description]
 
     # Return the rows
     if return_type == 'list':
@@ -124,12 +318,10 @@ def get_results(query, params=None, return_type='rows', incl_column_names=False)
 
 
 def get_scalar(query, params=None):
-    # Connect to the database
-    db_path = get_db_path()
-    with sqlite3.connect(db_path) as conn:
-        # Create a cursor object
-        cursor = conn.cursor()
-
+    _wait_for_pending_writes(own_thread=True)
+    cursor = get_connection().cursor()
+    start = time.perf_counter() if profiler.enabled else None
+    try:
         # Execute the query
         if params:
             cursor.execute(query, params)
@@ -138,25 +330,43 @@ def get_scalar(query, params=None):
 
         # Fetch the first row
         row = cursor.fetchone()
-
-        # Close the cursor and connection
+        if start is not None:
+            profiler.record(query, params, start)
+    finally:
         cursor.close()
-        # conn.close()
 
-        if row is None:
-            return None
-        return row[0]
+    if row is None:
+        return None
+    return row[0]
 
 
-def check_database_upgrade():
-    db_path = get_db_path()
-    file_exists = os.path.isfile(db_path)
+def check_database_upgrade(db_path=None):
+    """
+    Returns the version of the db if it needs upgrading, or None if it's current.
+    `db_path` checks another db file than the one in use, e.g. a backup before it's restored.
+    """
+    file_path = db_path or get_db_path()
+    file_exists = os.path.isfile(file_path)
     if not file_exists:
         raise Exception('NO_DB')
 
-    db_version_str = get_scalar("SELECT value as app_version FROM settings WHERE field = 'app_version'")
+    from src.utils.sql_upgrade import versions
+    version_query = "SELECT value as app_version FROM settings WHERE field = 'app_version'"
+    if db_path is None:
+        db_version_str = get_scalar(version_query)
+    else:
+        conn = sqlite3.connect(db_path)
+        try:
+            row = conn.execute(version_query).fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            conn.close()
+        if row is None:
+            raise Exception('NO_DB')
+        db_version_str = row[0]
     db_version = version.parse(db_version_str)
-    app_version = version.parse('0.2.0')
+    app_version = version.parse(versions[-1])
     if db_version > app_version:
         raise Exception('OUTDATED_APP')
     elif db_version < app_version:
@@ -165,21 +375,235 @@ def check_database_upgrade():
         return None
 
 
-def execute_multiple(queries, params_list):
-    with sql_thread_lock:
-        # Connect to the database
-        db_path = get_db_path()
-        with sqlite3.connect(db_path) as conn:
-            # try:
-                # Create a cursor object
-            cursor = conn.cursor()
+class Transaction:
+    """Statements executed through this are committed together when the `transaction` block exits"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.lastrowid = None
 
+    def execute(self, query, params=None):
+        start = time.perf_counter() if profiler.enabled else None
+        if params:
+            self.cursor.execute(query, params)
+        else:
+            self.cursor.execute(query)
+        if start is not None:
+            profiler.record(query, params, start)
+        self.lastrowid = self.cursor.lastrowid
+        return self.lastrowid
+
+    def executemany(self, query, params_list):
+        if not profiler.enabled:
+            self.cursor.executemany(query, params_list)
+            return self.cursor.rowcount
+
+        params_list = list(params_list)
+        start = time.perf_counter()
+        self.cursor.executemany(query, params_list)
+        profiler.record(query, params_list[0] if params_list else None, start)
+        return self.cursor.rowcount
+
+
+@contextmanager
+def transaction():
+    """
+    Groups multiple writes into a single commit, rolled back if the block raises.
+    Reads on the same thread inside the block see the uncommitted writes.
+    A nested transaction joins the outer one.
+
+    with sql.transaction() as tx:
+        context_id = tx.execute("INSERT INTO contexts (id) VALUES (NULL)")
+        tx.executemany("INSERT INTO contexts_members (context_id, agent_id) VALUES (?, ?)", rows)
+    """
+    _wait_for_pending_writes()
+    with sql_thread_lock:
+        conn = get_connection()
+        cursor = conn.cursor()
+        if conn.in_transaction:
             try:
-                for query, params in zip(queries, params_list):
-                    cursor.execute(query, params)
-                conn.commit()
-            except Exception as e:
-                conn.rollback()
-                raise
+                yield Transaction(cursor)
             finally:
                 cursor.close()
+            return
+
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            yield Transaction(cursor)
+            cursor.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.close()
+
+
+def execute_multiple(queries, params_list):
+    with transaction() as tx:
+        for query, params in zip(queries, params_list):
+            tx.execute(query, params)
+
+
+def execute_deferred(query, params=None, on_error=None):
+    """
+    Queues a write to be committed by the writer thread and returns immediately.
+    Reads on the same thread, and writes on any thread, wait for queued writes first, so they're always visible to them.
+    Inside a transaction the write is executed immediately as part of it.
+    If the write fails, `on_error(exception)` is called from the writer thread.
+    """
+    if threading.current_thread() is _writer_thread or _in_own_transaction():
+        execute(query, params)
+        return
+
+    _queue_write(query, params, False, on_error)
+
+
+def execute_many_deferred(query, params_list, on_error=None):
+    """Like `execute_deferred`, but queues `query` once to be executed with each of `params_list`"""
+    params_list = list(params_list)
+    if not params_list:
+        return
+    if threading.current_thread() is _writer_thread or _in_own_transaction():
+        with transaction() as tx:
+            tx.executemany(query, params_list)
+        return
+
+    _queue_write(query, params_list, True, on_error)
+
+
+def _queue_write(query, params, many, on_error):
+    global _pending_writes
+    _start_writer()
+    thread_id = threading.get_ident()
+    with _pending_cond:
+        _pending_writes += 1
+        _pending_thread_writes[thread_id] = _pending_thread_writes.get(thread_id, 0) + 1
+    _write_queue.put((query, params, many, thread_id, on_error))  # blocks while the queue is full
+
+
+def reserve_rowid(table):
+    """
+    Returns the next unused id of `table`, for an insert with an explicit id queued with `execute_deferred`.
+    Ids reserved but not yet written are never handed out twice.
+    """
+    with _reserve_lock:
+        last_rowid = get_connection().execute(f"""
+            SELECT MAX(
+                COALESCE((SELECT MAX(rowid) FROM `{table}`), 0),
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0)
+            )""", (table,)).fetchone()[0]
+        rowid = max(last_rowid, _reserved_rowids.get(table, 0)) + 1
+        _reserved_rowids[table] = rowid
+        return rowid
+
+
+def flush(timeout=None, own_thread=False):
+    """
+    Blocks until every queued write is committed, or with `own_thread` the writes queued by the calling thread.
+    Returns False if `timeout` seconds passed first.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    thread_id = threading.get_ident()
+    with _pending_cond:
+        while (_pending_thread_writes.get(thread_id, 0) if own_thread else _pending_writes) > 0:
+            if _writer_thread is None or not _writer_thread.is_alive():
+                return False
+            _flush_requested.set()
+            wait_time = WRITE_FLUSH_INTERVAL
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.monotonic())
+                if wait_time <= 0:
+                    return False
+            _pending_cond.wait(wait_time)
+    return True
+
+
+def set_write_flush_interval(seconds):
+    global WRITE_FLUSH_INTERVAL
+    WRITE_FLUSH_INTERVAL = seconds
+
+
+def _in_own_transaction():
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is None:
+        return False
+    try:
+        return conn.in_transaction
+    except sqlite3.ProgrammingError:  # closed by close_connections
+        return False
+
+
+def _wait_for_pending_writes(own_thread=False):
+    """
+    Reads only wait for the writes of their own thread. Writes wait for all, so they're committed in order,
+    and a synchronous insert can't take an id reserved for a queued one.
+    """
+    # The writer can't commit while this thread holds a transaction, so it doesn't wait
+    if _pending_writes == 0 or threading.current_thread() is _writer_thread or _in_own_transaction():
+        return
+    flush(own_thread=own_thread)
+
+
+def _start_writer():
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _writer_lock:
+        if _writer_thread is not None and _writer_thread.is_alive():
+            return
+        _writer_thread = threading.Thread(target=_writer_loop, name='sql-writer', daemon=True)
+        _writer_thread.start()
+
+
+def _writer_loop():
+    while True:
+        batch = [_write_queue.get()]
+        # Hold the batch open so concurrent writes share one commit
+        _flush_requested.wait(WRITE_FLUSH_INTERVAL)
+        _flush_requested.clear()
+        while True:
+            try:
+                batch.append(_write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        _commit_batch(batch)
+
+
+def _commit_batch(batch):
+    global _pending_writes
+    try:
+        with transaction() as tx:
+            for query, params, many, _, _ in batch:
+                if many:
+                    tx.executemany(query, params)
+                else:
+                    tx.execute(query, params)
+    except Exception as e:
+        # Retry one by one so a single bad statement doesn't lose the whole batch
+        logging.error(f'Deferred write batch failed, retrying individually: {e}')
+        for query, params, many, _, on_error in batch:
+            try:
+                with transaction() as tx:
+                    if many:
+                        tx.executemany(query, params)
+                    else:
+                        tx.execute(query, params)
+            except Exception as e:
+                logging.error(f'Deferred write failed: {e}\n{query}')
+                if on_error is not None:
+                    try:
+                        on_error(e)
+                    except Exception as callback_error:
+                        logging.error(f'Deferred write error callback failed: {callback_error}')
+    finally:
+        with _pending_cond:
+            _pending_writes -= len(batch)
+            for _, _, _, thread_id, _ in batch:
+                _pending_thread_writes[thread_id] -= 1
+                if _pending_thread_writes[thread_id] == 0:
+                    del _pending_thread_writes[thread_id]
+            _pending_cond.notify_all()
+
+
+atexit.register(flush)
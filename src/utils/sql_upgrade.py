@@ -4,11 +4,429 @@ import shutil
 from src.utils import sql
 from packaging import version
 
+# The avatar path of agent `a`, read from its config json
+JSON_AVATAR_PATH = """json_extract(a.config, '$."info.avatar_path"')"""
+# Recomputes the member columns of the summary rows matched by `{where}`, with the avatar path of agent `a` from `{avatar_path}`
+CONTEXT_SUMMARY_REFRESH_MEMBERS = """
+    UPDATE context_summary SET (member_count, display_name, avatar_paths) = (
+        SELECT
+            COUNT(a.name),
+            CASE WHEN COUNT(a.name) > 1 THEN
+                CAST(COUNT(a.name) AS TEXT) || ' members'
+            ELSE
+                MAX(a.name)
+            END,
+            group_concat({avatar_path}, ';')
+        FROM contexts_members cm
+        LEFT JOIN agents a
+            ON cm.agent_id = a.id
+        WHERE cm.context_id = context_summary.context_id
+            AND cm.del != 1
+    )
+    WHERE {where};"""
+# Recomputes the last message columns of the summary row of `{context_id}`
+CONTEXT_SUMMARY_REFRESH_LAST_MESSAGE = """
+    UPDATE context_summary SET
+        last_message_id = COALESCE((
+            SELECT MAX(id) FROM contexts_messages WHERE context_id = {context_id}
+        ), 0),
+        last_message_unix = (
+            SELECT unix FROM contexts_messages WHERE context_id = {context_id} ORDER BY id DESC LIMIT 1
+        )
+    WHERE context_id = {context_id};"""
+# The triggers that refresh the member columns of context_summary
+CONTEXT_SUMMARY_MEMBER_TRIGGERS = (
+    'context_summary_context_update',
+    'context_summary_member_insert',
+    'context_summary_member_update',
+    'context_summary_member_delete',
+    'context_summary_agent_update',
+    'context_summary_agent_delete',
+)
+
 
 class SQLUpgrade:
     def __init__(self):
         pass
 
+    def create_context_summary_member_triggers(self, tx, avatar_path):
+        """Creates `CONTEXT_SUMMARY_MEMBER_TRIGGERS`, reading the avatar path of agent `a` from `avatar_path`"""
+        def refresh_members(where):
+            return CONTEXT_SUMMARY_REFRESH_MEMBERS.format(avatar_path=avatar_path, where=where)
+
+        # contexts
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_context_update"
+            AFTER UPDATE OF parent_id ON contexts
+            BEGIN
+                DELETE FROM context_summary WHERE context_id = NEW.id AND NEW.parent_id IS NOT NULL;
+                INSERT OR IGNORE INTO context_summary (context_id)
+                    SELECT NEW.id WHERE NEW.parent_id IS NULL;
+                {refresh_members(where='context_id = NEW.id')}
+                {CONTEXT_SUMMARY_REFRESH_LAST_MESSAGE.format(context_id='NEW.id')}
+            END""")
+
+        # contexts_members
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_member_insert"
+            AFTER INSERT ON contexts_members
+            BEGIN
+                {refresh_members(where='context_id = NEW.context_id')}
+            END""")
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_member_update"
+            AFTER UPDATE OF context_id, agent_id, del ON contexts_members
+            BEGIN
+                {refresh_members(where='context_id IN (OLD.context_id, NEW.context_id)')}
+            END""")
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_member_delete"
+            AFTER DELETE ON contexts_members
+            BEGIN
+                {refresh_members(where='context_id = OLD.context_id')}
+            END""")
+
+        # agents, for the name and avatar
+        agent_contexts = 'context_id IN (SELECT context_id FROM contexts_members WHERE agent_id = {agent_id})'
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_agent_update"
+            AFTER UPDATE OF name, config ON agents
+            BEGIN
+                {refresh_members(where=agent_contexts.format(agent_id='NEW.id'))}
+            END""")
+        tx.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "context_summary_agent_delete"
+            AFTER DELETE ON agents
+            BEGIN
+                {refresh_members(where=agent_contexts.format(agent_id='OLD.id'))}
+            END""")
+
+    def v0_2_8(self):
+        with sql.transaction() as tx:
+            # Responses of deterministic llm requests, by the hash of the request
+            tx.execute("""
+                CREATE TABLE IF NOT EXISTS "llm_output_cache" (
+                    "key"	TEXT NOT NULL,
+                    "responses"	TEXT NOT NULL,
+                    "last_used"	REAL NOT NULL,
+                    PRIMARY KEY("key")
+                ) WITHOUT ROWID""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "llm_output_cache_last_used_indx" ON "llm_output_cache" ("last_used")""")
+            # Set on the messages of a response from the cache, their bubbles show it
+            existing_columns = [row[1] for row in sql.get_results('PRAGMA table_info("contexts_messages")')]
+            if 'cached' not in existing_columns:
+                tx.execute('ALTER TABLE "contexts_messages" ADD COLUMN "cached" INTEGER NOT NULL DEFAULT 0')
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.8' WHERE field = 'app_version'""")
+
+        return "0.2.8"
+
+    def v0_2_7(self):
+        with sql.transaction() as tx:
+            # The messages each member saved for a set of inputs, reused when a rerun gives it the same inputs
+            tx.execute("""
+                CREATE TABLE IF NOT EXISTS "contexts_members_runs" (
+                    "id"	INTEGER,
+                    "member_id"	INTEGER NOT NULL,
+                    "inputs_hash"	TEXT NOT NULL,
+                    "msg_ids"	TEXT NOT NULL DEFAULT '[]',
+                    "unix"	INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    PRIMARY KEY("id" AUTOINCREMENT)
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_members_runs_hash_indx" ON "contexts_members_runs" (
+                    "member_id",
+                    "inputs_hash"
+                )""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "contexts_members_runs_member_delete"
+                AFTER DELETE ON contexts_members
+                BEGIN
+                    DELETE FROM contexts_members_runs WHERE member_id = old.id;
+                END""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.7' WHERE field = 'app_version'""")
+
+        return "0.2.7"
+
+    def v0_2_6(self):
+        with sql.transaction() as tx:
+            # Rolling summaries of a conversation, each covers the path up to and including `up_to_msg_id`
+            tx.execute("""
+                CREATE TABLE IF NOT EXISTS "context_summaries" (
+                    "context_id"	INTEGER NOT NULL,
+                    "up_to_msg_id"	INTEGER NOT NULL,
+                    "msg_count"	INTEGER NOT NULL,
+                    "summary"	TEXT NOT NULL,
+                    "unix"	INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    PRIMARY KEY("context_id", "up_to_msg_id")
+                ) WITHOUT ROWID""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "context_summaries_msg_indx" ON "context_summaries" ("up_to_msg_id")""")
+
+            # A summary is stale once a message it covers changes. Only the context's own summaries are dropped,
+            # branches of it keep theirs, as messages before a branch point are rarely changed
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summaries_msg_delete"
+                AFTER DELETE ON contexts_messages
+                BEGIN
+                    DELETE FROM context_summaries WHERE context_id = old.context_id AND up_to_msg_id >= old.id;
+                END""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summaries_msg_update"
+                AFTER UPDATE OF msg ON contexts_messages
+                BEGIN
+                    DELETE FROM context_summaries WHERE context_id = old.context_id AND up_to_msg_id >= old.id;
+                END""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summaries_context_delete"
+                AFTER DELETE ON contexts
+                BEGIN
+                    DELETE FROM context_summaries WHERE context_id = old.id;
+                END""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.6' WHERE field = 'app_version'""")
+
+        return "0.2.6"
+
+    def v0_2_5(self):
+        with sql.transaction() as tx:
+            # Token counts are computed on first use and cached, `tokenizer` is the encoding they were counted with
+            existing_columns = [row[1] for row in sql.get_results('PRAGMA table_xinfo("contexts_messages")')]
+            if 'token_count' not in existing_columns:
+                tx.execute('ALTER TABLE "contexts_messages" ADD COLUMN "token_count" INTEGER')
+            if 'tokenizer' not in existing_columns:
+                tx.execute('ALTER TABLE "contexts_messages" ADD COLUMN "tokenizer" TEXT')
+
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "contexts_messages_token_count_reset"
+                AFTER UPDATE OF msg ON contexts_messages
+                BEGIN
+                    UPDATE contexts_messages SET token_count = NULL, tokenizer = NULL WHERE id = new.id;
+                END""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.5' WHERE field = 'app_version'""")
+
+        return "0.2.5"
+
+    def v0_2_4(self):
+        # Virtual generated columns for the config keys read by list and load queries,
+        # they're computed on write into their index so reads don't parse the json
+        generated_columns = [
+            ('agents', 'config', 'info_name', '$."info.name"'),
+            ('agents', 'config', 'info_avatar_path', '$."info.avatar_path"'),
+            ('agents', 'config', 'info_use_plugin', '$."info.use_plugin"'),
+            ('contexts_members', 'agent_config', 'info_name', '$."info.name"'),
+            ('contexts_members', 'agent_config', 'info_avatar_path', '$."info.avatar_path"'),
+            ('contexts_members', 'agent_config', 'info_use_plugin', '$."info.use_plugin"'),
+            ('models', 'config', 'model_name', '$.model_name'),
+            ('apis', 'config', 'litellm_prefix', '$.litellm_prefix'),
+        ]
+        with sql.transaction() as tx:
+            for table, json_column, column, json_path in generated_columns:
+                existing_columns = [row[1] for row in sql.get_results(f'PRAGMA table_xinfo("{table}")')]
+                if column not in existing_columns:
+                    tx.execute(f"""
+                        ALTER TABLE "{table}" ADD COLUMN "{column}" TEXT GENERATED ALWAYS AS (
+                            CASE WHEN json_valid("{json_column}") THEN json_extract("{json_column}", '{json_path}') END
+                        ) VIRTUAL""")
+
+            # Covering indexes for the agent and model lists
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "agents_info_indx" ON "agents" (
+                    "info_name",
+                    "info_avatar_path"
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_members_info_indx" ON "contexts_members" (
+                    "context_id",
+                    "del",
+                    "info_name",
+                    "info_avatar_path",
+                    "info_use_plugin"
+                )""")
+
+            # The context_summary triggers read the avatar path from the new column
+            for trigger in CONTEXT_SUMMARY_MEMBER_TRIGGERS:
+                tx.execute(f'DROP TRIGGER IF EXISTS "{trigger}"')
+            self.create_context_summary_member_triggers(tx, 'a.info_avatar_path')
+
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "models_model_name_indx" ON "models" (
+                    "api_id",
+                    "name",
+                    "model_name"
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "apis_litellm_prefix_indx" ON "apis" (
+                    "name",
+                    "priv_key",
+                    "litellm_prefix"
+                )""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.4' WHERE field = 'app_version'""")
+
+        return "0.2.4"
+
+    def v0_2_3(self):
+        with sql.transaction() as tx:
+            # Full-text index over the messages, contexts_messages holds the content
+            tx.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS "contexts_messages_fts" USING fts5(
+                    role UNINDEXED,
+                    msg,
+                    context_id UNINDEXED,
+                    content = 'contexts_messages',
+                    content_rowid = 'id',
+                    tokenize = 'porter unicode61 remove_diacritics 2'
+                )""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "contexts_messages_fts_insert"
+                AFTER INSERT ON contexts_messages
+                BEGIN
+                    INSERT INTO contexts_messages_fts (rowid, role, msg, context_id)
+                    VALUES (NEW.id, NEW.role, NEW.msg, NEW.context_id);
+                END""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "contexts_messages_fts_delete"
+                AFTER DELETE ON contexts_messages
+                BEGIN
+                    INSERT INTO contexts_messages_fts (contexts_messages_fts, rowid, role, msg, context_id)
+                    VALUES ('delete', OLD.id, OLD.role, OLD.msg, OLD.context_id);
+                END""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "contexts_messages_fts_update"
+                AFTER UPDATE OF role, msg, context_id ON contexts_messages
+                BEGIN
+                    INSERT INTO contexts_messages_fts (contexts_messages_fts, rowid, role, msg, context_id)
+                    VALUES ('delete', OLD.id, OLD.role, OLD.msg, OLD.context_id);
+                    INSERT INTO contexts_messages_fts (rowid, role, msg, context_id)
+                    VALUES (NEW.id, NEW.role, NEW.msg, NEW.context_id);
+                END""")
+            tx.execute("""
+                INSERT INTO contexts_messages_fts (contexts_messages_fts) VALUES ('rebuild')""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.3' WHERE field = 'app_version'""")
+
+        return "0.2.3"
+
+    def v0_2_2(self):
+        with sql.transaction() as tx:
+            # One row per root context, read by the Chats page
+            tx.execute("""
+                CREATE TABLE IF NOT EXISTS "context_summary" (
+                    "context_id"	INTEGER NOT NULL,
+                    "last_message_id"	INTEGER NOT NULL DEFAULT 0,
+                    "last_message_unix"	INTEGER,
+                    "member_count"	INTEGER NOT NULL DEFAULT 0,
+                    "display_name"	TEXT,
+                    "avatar_paths"	TEXT,
+                    PRIMARY KEY("context_id")
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "context_summary_last_msg_indx" ON "context_summary" (
+                    "last_message_id" DESC
+                )""")
+
+            # contexts
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summary_context_insert"
+                AFTER INSERT ON contexts
+                WHEN NEW.parent_id IS NULL
+                BEGIN
+                    INSERT OR IGNORE INTO context_summary (context_id) VALUES (NEW.id);
+                END""")
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summary_context_delete"
+                AFTER DELETE ON contexts
+                BEGIN
+                    DELETE FROM context_summary WHERE context_id = OLD.id;
+                END""")
+
+            # contexts_messages
+            tx.execute("""
+                CREATE TRIGGER IF NOT EXISTS "context_summary_message_insert"
+                AFTER INSERT ON contexts_messages
+                BEGIN
+                    UPDATE context_summary SET
+                        last_message_id = NEW.id,
+                        last_message_unix = NEW.unix
+                    WHERE context_id = NEW.context_id
+                        AND last_message_id < NEW.id;
+                END""")
+            tx.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS "context_summary_message_update"
+                AFTER UPDATE OF id, context_id ON contexts_messages
+                BEGIN
+                    {CONTEXT_SUMMARY_REFRESH_LAST_MESSAGE.format(context_id='OLD.context_id')}
+                    {CONTEXT_SUMMARY_REFRESH_LAST_MESSAGE.format(context_id='NEW.context_id')}
+                END""")
+            tx.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS "context_summary_message_delete"
+                AFTER DELETE ON contexts_messages
+                BEGIN
+                    {CONTEXT_SUMMARY_REFRESH_LAST_MESSAGE.format(context_id='OLD.context_id')}
+                END""")
+
+            # contexts_members and agents, and contexts for a moved context
+            self.create_context_summary_member_triggers(tx, JSON_AVATAR_PATH)
+
+            # Backfill
+            tx.execute("""
+                INSERT OR REPLACE INTO context_summary (context_id)
+                SELECT id FROM contexts WHERE parent_id IS NULL""")
+            tx.execute(CONTEXT_SUMMARY_REFRESH_MEMBERS.format(avatar_path=JSON_AVATAR_PATH, where='1 = 1'))
+            tx.execute("""
+                UPDATE context_summary SET (last_message_id, last_message_unix) = (
+                    SELECT COALESCE(MAX(cm.id), 0), MAX(cm.unix)
+                    FROM contexts_messages cm
+                    WHERE cm.context_id = context_summary.context_id
+                )""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.2' WHERE field = 'app_version'""")
+
+        return "0.2.2"
+
+    def v0_2_1(self):
+        with sql.transaction() as tx:
+            # Indexes for the conversation tree queries
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_messages_context_indx" ON "contexts_messages" (
+                    "context_id",
+                    "id"
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_parent_indx" ON "contexts" (
+                    "parent_id",
+                    "active"
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_branch_msg_indx" ON "contexts" (
+                    "branch_msg_id"
+                )""")
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_members_context_indx" ON "contexts_members" (
+                    "context_id"
+                )""")
+            # contexts_members_inputs(member_id) is covered by the unique index `inp_indxz`
+            tx.execute("""
+                CREATE INDEX IF NOT EXISTS "contexts_members_inputs_input_indx" ON "contexts_members_inputs" (
+                    "input_member_id"
+                )""")
+
+            tx.execute("""
+                UPDATE settings SET value = '0.2.1' WHERE field = 'app_version'""")
+
+        return "0.2.1"
+
     def v0_2_0(self):
         sql.execute("""
             CREATE TABLE "apis_new" (
@@ -811,6 +1229,8 @@ class SQLUpgrade:
         while os.path.isfile(backup_path):
             backup_path = db_path + f'({str(num)}).backup_v0.1.0'
             num += 1
+        # flush the write-ahead log into the db file so the copy is complete
+        sql.execute('PRAGMA wal_checkpoint(TRUNCATE)')
         shutil.copyfile(db_path, backup_path)
 
         if isinstance(current_version, str):
@@ -820,15 +1240,34 @@ class SQLUpgrade:
                 return self.v0_1_0()
             elif current_version < version.parse("0.2.0"):
                 return self.v0_2_0()
+            elif current_version < version.parse("0.2.1"):
+                return self.v0_2_1()
+            elif current_version < version.parse("0.2.2"):
+                return self.v0_2_2()
+            elif current_version < version.parse("0.2.3"):
+                return self.v0_2_3()
+            elif current_version < version.parse("0.2.4"):
+                return self.v0_2_4()
+            elif current_version < version.parse("0.2.5"):
+                return self.v0_2_5()
+            elif current_version < version.parse("0.2.6"):
+                return self.v0_2_6()
+            elif current_version < version.parse("0.2.7"):
+                return self.v0_2_7()
+            elif current_version < version.parse("0.2.8"):
+                return self.v0_2_8()
             else:
                 return str(current_version)
 
         except Exception as e:
             # restore the backup
-            os.remove(db_path)
+            sql.close_connections()
+            for path in (db_path, db_path + '-wal', db_path + '-shm'):
+                if os.path.isfile(path):
+                    os.remove(path)
             shutil.copyfile(backup_path, db_path)
             raise e
 
 
 upgrade_script = SQLUpgrade()
-versions = ['0.0.8', '0.1.0', '0.2.0']
+versions = ['0.0.8', '0.1.0', '0.2.0', '0.2.1', '0.2.2', '0.2.3', '0.2.4', '0.2.5', '0.2.6', '0.2.7', '0.2.8']
@@ -0,0 +1,43 @@
+"""
+Measures the cost of `MessageHistory.add` against the length of the loaded history,
+it should stay flat as the history grows. `reload` is the cost of the full reload `add` used to do.
+
+    python -m tests.benchmarks.bench_message_add [adds_per_size]
+"""
+import sys
+import time
+from types import SimpleNamespace
+
+from src.context.messages import MessageHistory
+from src.utils import sql
+from tests.benchmarks.common import make_benchmark_db, upgrade_benchmark_db, time_per_call
+
+HISTORY_SIZES = (10, 100, 1_000, 10_000)
+
+
+def main(adds_per_size=200):
+    print(f'{"history":>10}{"add (us)":>12}{"reload (us)":>14}')
+    for size in HISTORY_SIZES:
+        db_path = make_benchmark_db(size, msgs_per_context=size)
+        sql.set_db_filepath(db_path)
+        upgrade_benchmark_db()
+        context_id = sql.get_scalar("SELECT MAX(id) FROM contexts")
+
+        workflow = SimpleNamespace(id=context_id, leaf_id=context_id)
+        history = MessageHistory(workflow)
+        history.load()
+
+        start = time.perf_counter()
+        for i in range(adds_per_size):
+            history.add('assistant', f'message {i}')
+        add_us = (time.perf_counter() - start) / adds_per_size * 1e6
+        sql.flush()
+
+        reload_us = time_per_call(history.load_messages, 5)
+        print(f'{size:>10}{add_us:>12.1f}{reload_us:>14.1f}')
+
+        sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
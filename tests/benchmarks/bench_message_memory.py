@@ -0,0 +1,53 @@
+"""
+Measures the memory of a loaded chat history, per message and in total.
+`messages` are the `Message` objects, `dict view` the formatted dicts `MessageHistory.get` keeps per member view.
+Message contents are shared by both and counted separately.
+
+    python -m tests.benchmarks.bench_message_memory [num_messages]
+"""
+import gc
+import sys
+import tracemalloc
+from types import SimpleNamespace
+
+from src.context.messages import MessageHistory
+from src.utils import sql
+from tests.benchmarks.common import make_benchmark_db, upgrade_benchmark_db
+
+
+def measure(func):
+    """Returns (result of `func`, bytes it allocated that are still alive)"""
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def main(num_messages=100_000):
+    db_path = make_benchmark_db(num_messages, msgs_per_context=num_messages)
+    sql.set_db_filepath(db_path)
+    upgrade_benchmark_db()
+    context_id = sql.get_scalar("SELECT MAX(id) FROM contexts")
+
+    workflow = SimpleNamespace(id=context_id, leaf_id=context_id)
+    history = MessageHistory(workflow)
+    history.branch_tree.load(context_id)
+
+    (messages, _), messages_size = measure(lambda: history.fetch_older(None, num_messages))
+    content_size = sum(sys.getsizeof(msg.content) for msg in messages)
+    _, view_size = measure(lambda: [history.format_message(msg, [], False) for msg in messages])
+
+    print(f'{"":>12}{"total (MB)":>12}{"per msg (B)":>13}')
+    for name, size in (('content', content_size),
+                       ('messages', messages_size - content_size),
+                       ('dict view', view_size)):
+        print(f'{name:>12}{size / 1e6:>12.1f}{size / len(messages):>13.0f}')
+
+    sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,77 @@
+"""
+Measures full-text message search latency on a large history.
+Message text is drawn from a Zipf-distributed vocabulary so terms range from very common to rare.
+
+    python -m tests.benchmarks.bench_message_search [num_messages]
+"""
+import bisect
+import itertools
+import random
+import sys
+import time
+
+from src.context.search import search_messages
+from src.utils import sql
+from tests.benchmarks.common import WORDS, make_benchmark_db, upgrade_benchmark_db, time_per_call
+
+VOCAB_SIZE = 50_000
+TARGET_MS = 50
+ITERATIONS = 20
+
+
+
+def make_vocab(size, seed=0):
+    """The repo benchmark words, then made-up words of 2-4 syllables"""
+    rnd = random.Random(seed)
+    syllables = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiou']
+    vocab = list(WORDS)
+    seen = set(vocab)
+    while len(vocab) < size:
+        word = ''.join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+    return vocab
+
+
+VOCAB = make_vocab(VOCAB_SIZE)
+CUM_WEIGHTS = list(itertools.accumulate(1 / (rank + 1) for rank in range(VOCAB_SIZE)))
+
+
+def zipf_text(rnd, num_words=20):
+    total = CUM_WEIGHTS[-1]
+    return ' '.join(VOCAB[bisect.bisect(CUM_WEIGHTS, rnd.random() * total)] for _ in range(num_words))
+
+
+def main(num_messages=1_000_000):
+    print(f'Building {num_messages} message db..')
+    start = time.perf_counter()
+    db_path = make_benchmark_db(num_messages, text_func=zipf_text)
+    sql.set_db_filepath(db_path)
+    upgrade_benchmark_db()
+    print(f'Built and indexed in {time.perf_counter() - start:.1f} s')
+
+    queries = [
+        ('most common word', VOCAB[0]),
+        ('common word', VOCAB[10]),
+        ('mid frequency word', VOCAB[500]),
+        ('rare word', VOCAB[20_000]),
+        ('two words', f'{VOCAB[1]} {VOCAB[50]}'),
+        ('prefix while typing', next(w[:-1] for w in VOCAB[300:] if len(w) > 5 and w[:-1] not in VOCAB)),
+        ('no match', 'zzzzzz'),
+    ]
+
+    print(f'{"query":<22}{"results":>9}{"mean (ms)":>12}')
+    failed = False
+    for name, text in queries:
+        num_results = len(search_messages(text))
+        mean_ms = time_per_call(lambda: search_messages(text), ITERATIONS) / 1000
+        failed = failed or mean_ms > TARGET_MS
+        print(f'{name:<22}{num_results:>9}{mean_ms:>12.2f}')
+
+    print(f'{"FAIL" if failed else "OK"}: target {TARGET_MS} ms')
+    sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
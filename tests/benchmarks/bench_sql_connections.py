@@ -0,0 +1,74 @@
+"""
+Compares per-call latency of the sql module against the previous behaviour
+of opening a new connection for every call.
+
+    python -m tests.benchmarks.bench_sql_connections [num_messages]
+"""
+import sqlite3
+import sys
+
+from src.utils import sql
+from tests.benchmarks.common import make_benchmark_db, time_per_call
+
+ITERATIONS = 2000
+
+
+def per_call_get_scalar(db_path, query, params):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        row = cursor.fetchone()
+        cursor.close()
+    return row[0] if row else None
+
+
+def per_call_get_results(db_path, query, params):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+
+def per_call_execute(db_path, query, params):
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        cursor.close()
+        return cursor.lastrowid
+
+
+def main(num_messages=100_000):
+    db_path = make_benchmark_db(num_messages)
+    sql.set_db_filepath(db_path)
+    last_context_id = sql.get_scalar("SELECT MAX(id) FROM contexts")
+
+    scalar_query = "SELECT summary FROM contexts WHERE id = ?"
+    results_query = "SELECT id, role, msg FROM contexts_messages WHERE id > ? ORDER BY id LIMIT 20"
+    execute_query = "UPDATE contexts SET ordr = ordr + 1 WHERE id = ?"
+
+    cases = [
+        ('get_scalar',
+         lambda: per_call_get_scalar(db_path, scalar_query, (last_context_id,)),
+         lambda: sql.get_scalar(scalar_query, (last_context_id,))),
+        ('get_results',
+         lambda: per_call_get_results(db_path, results_query, (num_messages // 2,)),
+         lambda: sql.get_results(results_query, (num_messages // 2,))),
+        ('execute',
+         lambda: per_call_execute(db_path, execute_query, (last_context_id,)),
+         lambda: sql.execute(execute_query, (last_context_id,))),
+    ]
+
+    print(f'{num_messages} messages, {ITERATIONS} calls each, mean latency per call')
+    print(f'{"call":<14}{"per-call conn (us)":>20}{"pooled conn (us)":>20}{"speedup":>10}')
+    for name, before, after in cases:
+        before_us = time_per_call(before, ITERATIONS)
+        after_us = time_per_call(after, ITERATIONS)
+        print(f'{name:<14}{before_us:>20.1f}{after_us:>20.1f}{before_us / after_us:>9.1f}x')
+
+    sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,67 @@
+"""
+Compares the latency seen by the caller of a message insert, synchronous `sql.execute`
+against `sql.execute_deferred`, with several members streaming into the same db at once.
+
+    python -m tests.benchmarks.bench_sql_write_queue [num_messages] [num_threads]
+"""
+import sys
+import threading
+import time
+
+from src.utils import sql
+from tests.benchmarks.common import make_benchmark_db
+
+INSERTS_PER_THREAD = 500
+
+
+def run_threads(num_threads, insert):
+    latencies = []
+    latencies_lock = threading.Lock()
+
+    def member():
+        thread_latencies = []
+        for i in range(INSERTS_PER_THREAD):
+            start = time.perf_counter()
+            insert(i)
+            thread_latencies.append(time.perf_counter() - start)
+        with latencies_lock:
+            latencies.extend(thread_latencies)
+
+    threads = [threading.Thread(target=member) for _ in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sql.flush()
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    mean_us = sum(latencies) / len(latencies) * 1_000_000
+    p99_us = latencies[int(len(latencies) * 0.99)] * 1_000_000
+    return mean_us, p99_us, total
+
+
+def main(num_messages=100_000, num_threads=4):
+    db_path = make_benchmark_db(num_messages)
+    sql.set_db_filepath(db_path)
+    context_id = sql.get_scalar("SELECT MAX(id) FROM contexts")
+    query = "INSERT INTO contexts_messages (id, context_id, role, msg) VALUES (?, ?, 'assistant', ?)"
+
+    def sync_insert(i):
+        sql.execute(query, (sql.reserve_rowid('contexts_messages'), context_id, f'message {i}'))
+
+    def deferred_insert(i):
+        sql.execute_deferred(query, (sql.reserve_rowid('contexts_messages'), context_id, f'message {i}'))
+
+    print(f'{num_messages} messages, {num_threads} threads x {INSERTS_PER_THREAD} inserts')
+    print(f'{"insert":<10}{"mean (us)":>12}{"p99 (us)":>12}{"total (s)":>12}')
+    for name, insert in (('execute', sync_insert), ('deferred', deferred_insert)):
+        mean_us, p99_us, total = run_threads(num_threads, insert)
+        print(f'{name:<10}{mean_us:>12.1f}{p99_us:>12.1f}{total:>12.2f}')
+
+    sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,69 @@
+"""
+Measures the time and number of queries to open a workflow against its number of members.
+Each member has a voice, two tools and the previous member as input.
+
+    python -m tests.benchmarks.bench_workflow_load [iterations]
+"""
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+from src.context.base import Workflow
+from src.utils import sql
+from tests.benchmarks.common import make_benchmark_db, upgrade_benchmark_db
+
+MEMBER_COUNTS = (1, 5, 20, 50)
+
+
+def make_workflow(num_members):
+    """Adds a context with `num_members` members, returns its id"""
+    context_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Benchmark workflow')")
+    tool_ids = [sql.execute("INSERT INTO tools (uuid, name, config) VALUES (?, ?, '{}')",
+                            (f'bench-{context_id}-{i}', f'bench_tool_{context_id}_{i}')) for i in range(2)]
+    voice_id = sql.execute("INSERT INTO voices (api_id, display_name, uuid) VALUES (0, 'Bench', ?)",
+                           (f'bench-{context_id}',))
+    agent_config = json.dumps({
+        'voice.current_id': voice_id,
+        'tools.data': json.dumps([{'id': tool_id} for tool_id in tool_ids]),
+    })
+
+    member_id = None
+    for i in range(num_members):
+        input_id = member_id
+        member_id = sql.execute("""
+            INSERT INTO contexts_members (context_id, agent_id, agent_config, loc_x)
+            VALUES (?, 0, ?, ?)""", (context_id, agent_config, i))
+        if input_id is not None:
+            sql.execute("INSERT INTO contexts_members_inputs (member_id, input_member_id) VALUES (?, ?)",
+                        (member_id, input_id))
+    return context_id
+
+
+def main(iterations=20):
+    db_path = make_benchmark_db(100)
+    sql.set_db_filepath(db_path)
+    upgrade_benchmark_db()
+    main_window = SimpleNamespace(system=SimpleNamespace())
+
+    print(f'{"members":>10}{"queries":>10}{"open (ms)":>12}')
+    for num_members in MEMBER_COUNTS:
+        context_id = make_workflow(num_members)
+        Workflow(main_window, context_id=context_id)  # warm up
+
+        sql.profiler.reset()
+        sql.profiler.enable()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            Workflow(main_window, context_id=context_id)
+        open_ms = (time.perf_counter() - start) / iterations * 1000
+        sql.profiler.disable()
+
+        num_queries = sum(stat['count'] for stat in sql.profiler.stats.values()) / iterations
+        print(f'{num_members:>10}{num_queries:>10.0f}{open_ms:>12.2f}')
+
+    sql.close_connections()
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -0,0 +1,64 @@
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+REPO_DB_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir, 'data.db'))
+
+WORDS = ('agent', 'pilot', 'context', 'message', 'branch', 'python', 'sqlite', 'stream', 'model', 'token',
+         'summary', 'workflow', 'member', 'search', 'index', 'query', 'plan', 'cache', 'write', 'read')
+
+
+def random_text(rnd, num_words=20):
+    return ' '.join(rnd.choice(WORDS) for _ in range(num_words))
+
+
+def make_benchmark_db(num_messages, msgs_per_context=100, seed=0, dir_path=None, text_func=random_text):
+    """
+    Copies the repo data.db into a temp dir and fills it with `num_messages` messages,
+    spread across contexts of `msgs_per_context` messages each. Returns the db path.
+    `text_func(rnd)` returns the content of each message.
+    """
+    dir_path = dir_path or tempfile.mkdtemp(prefix='agentpilot_bench_')
+    db_path = os.path.join(dir_path, 'data.db')
+    shutil.copyfile(REPO_DB_PATH, db_path)
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    num_contexts = max(1, num_messages // msgs_per_context)
+    start_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM contexts").fetchone()[0] + 1
+    context_ids = list(range(start_id, start_id + num_contexts))
+    conn.executemany("INSERT INTO contexts (id, summary) VALUES (?, ?)",
+                     ((c_id, f'Chat {c_id}') for c_id in context_ids))
+    conn.executemany("INSERT INTO contexts_members (context_id, agent_id, agent_config) VALUES (?, 0, '{}')",
+                     ((c_id,) for c_id in context_ids))
+
+    now = int(time.time())
+    conn.executemany(
+        "INSERT INTO contexts_messages (unix, context_id, member_id, role, msg) VALUES (?, ?, ?, ?, ?)",
+        ((now - (num_messages - i), context_ids[i // msgs_per_context % num_contexts], None,
+          'user' if i % 2 == 0 else 'assistant', text_func(rnd))
+         for i in range(num_messages)))
+    conn.commit()
+    conn.close()
+    return db_path
+
+
+def upgrade_benchmark_db():
+    """Runs the migrations on the db set with `sql.set_db_filepath`"""
+    from src.utils import sql
+    from src.utils.sql_upgrade import upgrade_script, versions
+    db_version = sql.check_database_upgrade()
+    while db_version is not None and str(db_version) != versions[-1]:
+        db_version = upgrade_script.upgrade(db_version)
+
+
+def time_per_call(func, iterations):
+    """Returns the mean latency of `func` in microseconds"""
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
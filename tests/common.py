@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.utils import sql
+from src.utils.sql_upgrade import upgrade_script, versions
+
+REPO_DB_PATH = os.path.join(os.path.dirname(__file__), os.path.pardir, 'data.db')
+
+
+def make_test_db():
+    """Copies the repo data.db into a temp dir, sets it as the db and upgrades it to the latest version. Returns the dir"""
+    temp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(temp_dir, 'data.db')
+    shutil.copyfile(REPO_DB_PATH, db_path)
+    sql.set_db_filepath(db_path)
+
+    db_version = sql.check_database_upgrade()
+    while db_version is not None and str(db_version) != versions[-1]:
+        db_version = upgrade_script.upgrade(db_version)
+    return temp_dir
+
+
+def remove_test_db(temp_dir):
+    sql.close_connections()
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Each test runs on its own upgraded copy of the repo data.db"""
+    def setUp(self):
+        self.temp_dir = make_test_db()
+
+    def tearDown(self):
+        remove_test_db(self.temp_dir)
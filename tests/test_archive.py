@@ -0,0 +1,80 @@
+import time
+import unittest
+
+from src.context import archive
+from src.utils import sql
+from tests.common import DatabaseTestCase
+
+TREE_QUERIES = {
+    'contexts': "SELECT id, parent_id, branch_msg_id, summary, active FROM contexts WHERE id IN ({ids}) ORDER BY id",
+    'contexts_members': "SELECT id, context_id, agent_id, agent_config, info_name FROM contexts_members WHERE context_id IN ({ids}) ORDER BY id",
+    'contexts_messages': "SELECT id, unix, context_id, role, msg FROM contexts_messages WHERE context_id IN ({ids}) ORDER BY id",
+    'context_summary': "SELECT * FROM context_summary WHERE context_id IN ({ids})",
+}
+
+
+class TestArchive(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        old_unix = int(time.time()) - 40 * 86400
+        self.root_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Old chat')")
+        sql.execute("""
+            INSERT INTO contexts_members (context_id, agent_id, agent_config)
+            VALUES (?, 0, '{"info.name": "Old agent"}')""", (self.root_id,))
+        msg_id = sql.execute("INSERT INTO contexts_messages (unix, context_id, role, msg) VALUES (?, ?, 'user', 'old question')",
+                             (old_unix, self.root_id))
+        self.branch_id = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)", (self.root_id, msg_id))
+        sql.execute("INSERT INTO contexts_messages (unix, context_id, role, msg) VALUES (?, ?, 'user', 'old branch')",
+                    (old_unix, self.branch_id))
+        self.tree_ids = [self.root_id, self.branch_id]
+
+    def tree_rows(self):
+        ids = ', '.join(str(context_id) for context_id in self.tree_ids)
+        return {table: sql.get_results(query.format(ids=ids)) for table, query in TREE_QUERIES.items()}
+
+    def test_find_archivable(self):
+        cutoff_unix = int(time.time()) - 30 * 86400
+        self.assertIn(self.root_id, archive.find_archivable(cutoff_unix))
+        self.assertNotIn(self.root_id, archive.find_archivable(cutoff_unix, exclude_ids=[self.root_id]))
+
+        # a recent message in a branch keeps the whole tree
+        sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'new')", (self.branch_id,))
+        self.assertNotIn(self.root_id, archive.find_archivable(cutoff_unix))
+
+    def test_archive_and_restore(self):
+        before = self.tree_rows()
+
+        archive.archive_context(self.root_id)
+        self.assertEqual([rows for rows in self.tree_rows().values() if rows], [])
+        self.assertEqual(sql.get_results("SELECT context_id, summary FROM archive.archived_contexts"),
+                         [(self.root_id, 'Old chat')])
+
+        archive.restore_context(self.root_id)
+        self.assertEqual(self.tree_rows(), before)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM archive.archived_contexts"), 0)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM archive.contexts_messages"), 0)
+
+    def test_recent_or_in_use_context_is_not_archived(self):
+        before = self.tree_rows()
+        cutoff_unix = int(time.time()) - 30 * 86400
+        self.assertFalse(archive.archive_context(self.root_id, cutoff_unix, get_in_use_ids=lambda: {self.root_id}))
+        self.assertEqual(self.tree_rows(), before)
+
+        # written to after it was found
+        sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'new')", (self.branch_id,))
+        before = self.tree_rows()
+        self.assertFalse(archive.archive_context(self.root_id, cutoff_unix, get_in_use_ids=lambda: set()))
+        self.assertEqual(self.tree_rows(), before)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM archive.archived_contexts"), 0)
+
+    def test_clear_archive(self):
+        archive.archive_context(self.root_id)
+        with sql.transaction() as tx:
+            archive.clear_archive(tx)
+        for table in archive.ARCHIVED_TABLES + ('archived_contexts',):
+            self.assertEqual(sql.get_scalar(f'SELECT COUNT(*) FROM archive."{table}"'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
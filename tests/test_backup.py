@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+import time
+import unittest
+from unittest import mock
+
+from src.utils import backup, sql
+from tests.common import DatabaseTestCase
+
+
+class TestBackup(DatabaseTestCase):
+    def test_backup_while_writing(self):
+        sql.execute("INSERT INTO contexts (summary) VALUES ('Before backup')")
+        stop = threading.Event()
+
+        def write():
+            while not stop.is_set():
+                sql.execute("INSERT INTO contexts (summary) VALUES ('During backup')")
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        try:
+            backup_path = backup.create_backup()
+        finally:
+            stop.set()
+            writer.join()
+
+        conn = sqlite3.connect(backup_path)
+        try:
+            self.assertEqual(conn.execute('PRAGMA quick_check').fetchone()[0], 'ok')
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM contexts WHERE summary = 'Before backup'").fetchone()[0], 1)
+        finally:
+            conn.close()
+        self.assertIsNone(sql.check_database_upgrade(backup_path))
+
+    def test_restore(self):
+        context_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Kept')")
+        backup_path = backup.create_backup()
+        sql.execute("DELETE FROM contexts WHERE id = ?", (context_id,))
+
+        backup.restore_backup(backup_path)
+        self.assertEqual(sql.get_scalar("SELECT summary FROM contexts WHERE id = ?", (context_id,)), 'Kept')
+        # The replaced db is kept as a labeled backup
+        self.assertTrue(any(path.endswith('_before_restore.db') for path in backup.list_backups()))
+
+    def test_start_restore(self):
+        context_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Kept')")
+        backup_path = backup.create_backup()
+        sql.execute("DELETE FROM contexts WHERE id = ?", (context_id,))
+
+        errors = []
+        backup.start_restore(backup_path, on_finished=errors.append).join(timeout=30)
+        self.assertEqual(errors, [None])
+        self.assertEqual(sql.get_scalar("SELECT summary FROM contexts WHERE id = ?", (context_id,)), 'Kept')
+
+        backup.start_restore(os.path.join(self.temp_dir, 'missing.db'), on_finished=errors.append).join(timeout=30)
+        self.assertEqual(len(errors), 2)
+        self.assertIsNotNone(errors[1])
+
+    def test_restore_rejects_newer_db(self):
+        backup_path = backup.create_backup()
+        conn = sqlite3.connect(backup_path)
+        conn.execute("UPDATE settings SET value = '99.0.0' WHERE field = 'app_version'")
+        conn.commit()
+        conn.close()
+
+        with self.assertRaises(Exception) as cm:
+            backup.restore_backup(backup_path)
+        self.assertEqual(str(cm.exception), 'OUTDATED_APP')
+
+    def test_prune_keeps_labeled(self):
+        backup_dir = backup.get_backup_dir()
+        os.makedirs(backup_dir)
+        filenames = ['data_20240101_000000.db', 'data_20240102_000000.db', 'data_20240103_000000.db',
+                     'data_20240101_000000_before_reset.db']
+        for i, filename in enumerate(filenames):
+            path = os.path.join(backup_dir, filename)
+            open(path, 'w').close()
+            os.utime(path, (i, i))
+
+        backup.prune_backups(keep=1)
+        self.assertEqual(sorted(os.listdir(backup_dir)), ['data_20240101_000000_before_reset.db', 'data_20240103_000000.db'])
+
+    def test_stop_schedule_does_not_wait_for_backup(self):
+        backup_started = threading.Event()
+
+        def slow_backup(*args, **kwargs):
+            backup_started.set()
+            time.sleep(0.5)
+
+        with mock.patch.object(backup, 'create_backup', slow_backup):
+            backup.start_backup_schedule(interval_hours=1, keep=1)  # no backups yet, so one starts right away
+            self.assertTrue(backup_started.wait(1))
+            start = time.perf_counter()
+            backup.stop_backup_schedule()
+            self.assertLess(time.perf_counter() - start, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
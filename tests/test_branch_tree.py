@@ -0,0 +1,58 @@
+import unittest
+
+from src.context.branches import BranchTree
+from src.utils import sql
+from tests.common import DatabaseTestCase
+
+
+class TestBranchTree(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # root: m1 m2, with two edits of m2 in branches b1 (m3) and b2 (m4), b2 is active
+        self.root_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Branched chat')")
+        self.m1 = self.add_msg(self.root_id, 'first')
+        self.m2 = self.add_msg(self.root_id, 'second')
+        self.b1 = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id, active) VALUES (?, ?, 0)", (self.root_id, self.m2))
+        self.m3 = self.add_msg(self.b1, 'second, edited')
+        self.b2 = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)", (self.root_id, self.m2))
+        self.m4 = self.add_msg(self.b2, 'second, edited again')
+
+        self.tree = BranchTree()
+        self.tree.load(self.root_id)
+
+    def add_msg(self, context_id, msg):
+        return sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', ?)", (context_id, msg))
+
+    def test_leaf_and_path(self):
+        self.assertEqual(self.tree.get_leaf_id(), self.b2)
+        self.assertEqual(self.tree.get_path(self.b2), [(self.b2, None), (self.root_id, self.m2)])
+
+        self.tree.set_active(self.b2, False)
+        self.assertEqual(self.tree.get_leaf_id(), self.root_id)
+        self.tree.set_active(self.b1, True)
+        self.assertEqual(self.tree.get_leaf_id(), self.b1)
+
+    def test_branch_entries(self):
+        expected = {self.m2: [self.m3, self.m4]}
+        self.assertEqual(self.tree.get_branches(), expected)
+        for msg_id in (self.m2, self.m3, self.m4):
+            self.assertEqual(self.tree.get_branch_entry(msg_id), expected)
+        self.assertEqual(self.tree.get_branch_entry(self.m1), {})
+        self.assertEqual(self.tree.get_sibling_ids(self.b1), [self.b1, self.b2])
+
+    def test_incremental_matches_reload(self):
+        b3 = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)", (self.b2, self.m4))
+        self.tree.add_context(b3, self.b2, self.m4)
+        m5 = self.add_msg(b3, 'third branch')
+        self.tree.add_message(b3, m5)
+
+        reloaded = BranchTree()
+        reloaded.load(self.root_id)
+        self.assertEqual(self.tree.get_leaf_id(), reloaded.get_leaf_id())
+        self.assertEqual(self.tree.get_branches(), reloaded.get_branches())
+        self.assertEqual(self.tree.get_path(b3), reloaded.get_path(b3))
+
+
+if __name__ == '__main__':
+    unittest.main()
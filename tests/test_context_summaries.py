@@ -0,0 +1,51 @@
+import unittest
+
+from src.context import summaries
+from src.context.branches import BranchTree
+from src.utils import sql
+from tests.common import DatabaseTestCase
+
+
+class TestContextSummaries(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # root: 30 messages, with a branch from the 26th message
+        self.root_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Long chat')")
+        self.root_msgs = [self.add_msg(self.root_id, f'root {i}') for i in range(30)]
+        self.branch_id = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)",
+                                     (self.root_id, self.root_msgs[25]))
+        self.branch_msgs = [self.add_msg(self.branch_id, f'branch {i}') for i in range(10)]
+
+        self.tree = BranchTree()
+        self.tree.load(self.root_id)
+
+    def add_msg(self, context_id, msg):
+        return sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', ?)", (context_id, msg))
+
+    def add_summary(self, context_id, up_to_msg_id, summary):
+        sql.execute("INSERT INTO context_summaries (context_id, up_to_msg_id, msg_count, summary) VALUES (?, ?, 0, ?)",
+                    (context_id, up_to_msg_id, summary))
+
+    def test_path_messages(self):
+        msg_path = summaries._path_messages(self.tree.get_path(self.branch_id))
+        self.assertEqual([msg_id for msg_id, _ in msg_path], self.root_msgs[:25] + self.branch_msgs)
+
+    def test_summary_shared_by_branches(self):
+        self.add_summary(self.root_id, self.root_msgs[19], 'first twenty')
+        self.add_summary(self.root_id, self.root_msgs[27], 'not on the branch')
+
+        root_path = self.tree.get_path(self.root_id)
+        branch_path = self.tree.get_path(self.branch_id)
+        self.assertEqual(summaries.get_summary(root_path, self.root_msgs[29]), ('not on the branch', self.root_msgs[27]))
+        self.assertEqual(summaries.get_summary(branch_path, self.branch_msgs[5]), ('first twenty', self.root_msgs[19]))
+        self.assertEqual(summaries.get_summary(branch_path, self.root_msgs[10]), (None, None))
+
+    def test_changed_message_drops_summaries(self):
+        self.add_summary(self.root_id, self.root_msgs[19], 'first twenty')
+        sql.execute("UPDATE contexts_messages SET msg = 'edited' WHERE id = ?", (self.root_msgs[5],))
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM context_summaries"), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
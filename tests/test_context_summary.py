@@ -0,0 +1,95 @@
+import unittest
+
+from src.utils import sql
+from tests.common import DatabaseTestCase
+
+# The Chats page query before context_summary, the table must always give the same rows
+UNSUMMARIZED_QUERY = """
+    SELECT
+        c.id,
+        CASE WHEN COUNT(a.name) > 1 THEN
+            CAST(COUNT(a.name) AS TEXT) || ' members'
+        ELSE
+            MAX(a.name)
+        END as name,
+        group_concat(json_extract(a.config, '$."info.avatar_path"'), ';') as avatar_paths,
+        COALESCE(cmsg.latest_message_id, 0)
+    FROM contexts c
+    LEFT JOIN contexts_members cm
+        ON c.id = cm.context_id
+        AND cm.del != 1
+    LEFT JOIN agents a
+        ON cm.agent_id = a.id
+    LEFT JOIN (
+        SELECT
+            context_id,
+            MAX(id) as latest_message_id
+        FROM contexts_messages
+        GROUP BY context_id
+    ) cmsg ON c.id = cmsg.context_id
+    WHERE c.parent_id IS NULL
+    GROUP BY c.id
+    ORDER BY c.id"""
+
+SUMMARY_QUERY = """
+    SELECT context_id, display_name, avatar_paths, last_message_id
+    FROM context_summary
+    ORDER BY context_id"""
+
+
+class TestContextSummary(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        agent_ids = sql.get_results("SELECT id FROM agents ORDER BY id LIMIT 2", return_type='list')
+        for i in range(3):
+            context_id = sql.execute("INSERT INTO contexts (summary) VALUES (?)", (f'context {i}',))
+            for agent_id in agent_ids[:i]:
+                sql.execute("INSERT INTO contexts_members (context_id, agent_id, agent_config) VALUES (?, ?, '{}')",
+                            (context_id, agent_id))
+            sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'hi')", (context_id,))
+
+    def assertSummaryCurrent(self):
+        self.assertEqual(sql.get_results(UNSUMMARIZED_QUERY), sql.get_results(SUMMARY_QUERY))
+
+    def test_backfill_and_inserts(self):
+        self.assertSummaryCurrent()
+
+    def test_deletes(self):
+        context_id = sql.get_scalar("SELECT MAX(context_id) FROM context_summary")
+        sql.execute("DELETE FROM contexts_messages WHERE id = (SELECT MAX(id) FROM contexts_messages WHERE context_id = ?)",
+                    (context_id,))
+        sql.execute("UPDATE contexts_members SET del = 1 WHERE id = (SELECT MIN(id) FROM contexts_members WHERE context_id = ?)",
+                    (context_id,))
+        self.assertSummaryCurrent()
+
+        sql.execute("DELETE FROM contexts_members WHERE context_id = ?", (context_id,))
+        sql.execute("DELETE FROM contexts WHERE id = ?", (context_id,))
+        self.assertSummaryCurrent()
+
+    def test_agent_update(self):
+        sql.execute("UPDATE agents SET name = 'Renamed' WHERE id = (SELECT MIN(id) FROM agents)")
+        self.assertSummaryCurrent()
+
+        sql.execute("""
+            UPDATE agents SET config = json_set(config, '$."info.avatar_path"', 'avatar.png')
+            WHERE id = (SELECT MIN(id) FROM agents)""")
+        self.assertSummaryCurrent()
+
+    def test_triggers_read_generated_column(self):
+        trigger_sqls = sql.get_results(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND sql LIKE '%avatar_paths%'", return_type='list')
+        self.assertTrue(trigger_sqls)
+        for trigger_sql in trigger_sqls:
+            self.assertIn('a.info_avatar_path', trigger_sql)
+            self.assertNotIn('json_extract', trigger_sql)
+
+    def test_branch_messages_ignored(self):
+        context_id = sql.get_scalar("SELECT MAX(context_id) FROM context_summary")
+        branch_id = sql.execute("INSERT INTO contexts (parent_id) VALUES (?)", (context_id,))
+        sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'hi')", (branch_id,))
+        self.assertSummaryCurrent()
+
+
+if __name__ == '__main__':
+    unittest.main()
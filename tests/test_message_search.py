@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+from src.context import search
+from src.context.search import search_messages, reveal_message, to_match_query
+from src.utils import sql
+from tests.common import DatabaseTestCase
+
+
+class TestMessageSearch(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.root_id = sql.execute("INSERT INTO contexts (summary) VALUES ('Root')")
+        self.msg_ids = [
+            sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', ?)", (self.root_id, msg))
+            for msg in ('the quick brown fox', 'a lazy <dog>', 'jumps over')
+        ]
+
+    def test_to_match_query(self):
+        self.assertEqual(to_match_query('quick fo', prefix=True), '"quick" "fo"*')
+        self.assertEqual(to_match_query('say "hi"'), '"say" """hi"""')
+        self.assertIsNone(to_match_query('  '))
+
+    def test_index_follows_messages(self):
+        self.assertEqual([r['msg_id'] for r in search_messages('qui')], [self.msg_ids[0]])
+
+        sql.execute("UPDATE contexts_messages SET msg = 'slow fox' WHERE id = ?", (self.msg_ids[0],))
+        self.assertEqual(search_messages('quick'), [])
+        self.assertEqual([r['msg_id'] for r in search_messages('slow')], [self.msg_ids[0]])
+
+        sql.execute("DELETE FROM contexts_messages WHERE id = ?", (self.msg_ids[0],))
+        self.assertEqual(search_messages('fox'), [])
+
+    def test_older_best_match_is_ranked(self):
+        best_id = sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'otter otter')",
+                              (self.root_id,))
+        with sql.transaction() as tx:
+            for i in range(1500):
+                tx.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', ?)",
+                           (self.root_id, f'an otter in a long message about rivers and streams number {i}'))
+        self.assertEqual(search_messages('otter', limit=1)[0]['msg_id'], best_id)
+
+    def test_only_recent_matches_are_ranked(self):
+        old_id = sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'otter otter')",
+                             (self.root_id,))
+        with sql.transaction() as tx:
+            for i in range(20):
+                tx.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', ?)",
+                           (self.root_id, f'an otter in a long message about rivers and streams number {i}'))
+        with mock.patch.object(search, 'SEARCH_CANDIDATE_LIMIT', 10):
+            results = search_messages('otter', limit=10)
+        self.assertEqual(len(results), 10)
+        self.assertNotIn(old_id, [r['msg_id'] for r in results])
+
+    def test_snippet_escaped(self):
+        result = search_messages('dog')[0]
+        self.assertEqual(result['snippet'], 'a lazy &lt;<b>dog</b>&gt;')
+        self.assertEqual(result['root_id'], self.root_id)
+
+    def test_reveal_message_in_branch(self):
+        # branch from the second message, then a newer branch from the first message
+        branch_id = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)",
+                                (self.root_id, self.msg_ids[1]))
+        branch_msg_id = sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'user', 'edited')",
+                                    (branch_id,))
+        newer_branch_id = sql.execute("INSERT INTO contexts (parent_id, branch_msg_id) VALUES (?, ?)",
+                                      (self.root_id, self.msg_ids[0]))
+
+        self.assertEqual(reveal_message(branch_msg_id), self.root_id)
+        active = sql.get_results("SELECT id, active FROM contexts WHERE parent_id = ?", (self.root_id,), return_type='dict')
+        self.assertEqual(active, {branch_id: 1, newer_branch_id: 0})
+
+        # the root message is hidden by the branch from it
+        reveal_message(self.msg_ids[2])
+        self.assertEqual(sql.get_scalar("SELECT active FROM contexts WHERE id = ?", (branch_id,)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
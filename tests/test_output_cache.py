@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+from src.utils import sql, output_cache
+from tests.common import DatabaseTestCase
+
+
+def make_request(content, **model_params):
+    return {'model': 'gpt-4', 'messages': [{'role': 'user', 'content': content}], 'stream': True, **model_params}
+
+
+class TestOutputCache(DatabaseTestCase):
+    def test_is_deterministic(self):
+        self.assertTrue(output_cache.is_deterministic({'temperature': 0.0}))
+        self.assertTrue(output_cache.is_deterministic({'temperature': 0.7, 'seed': 42}))
+        self.assertFalse(output_cache.is_deterministic({'temperature': 0.7}))
+        self.assertFalse(output_cache.is_deterministic({}))
+
+    def test_key(self):
+        key = output_cache.get_key(make_request('Hi', temperature=0, api_key='a'))
+        self.assertEqual(key, output_cache.get_key(make_request('Hi', api_key='b', temperature=0, stream=False)))
+        self.assertNotEqual(key, output_cache.get_key(make_request('Hello', temperature=0)))
+        self.assertNotEqual(key, output_cache.get_key(make_request('Hi', temperature=0, seed=1)))
+
+    def test_get_and_put(self):
+        key = output_cache.get_key(make_request('Hi'))
+        self.assertIsNone(output_cache.get(key))
+
+        responses = {'assistant': 'Hello!', 'tools': {'get_time': '{}'}}
+        output_cache.put(key, responses)
+        self.assertEqual(output_cache.get(key), responses)
+
+    def test_least_recently_used_are_evicted(self):
+        keys = [output_cache.get_key(make_request(f'msg {i}')) for i in range(4)]
+        with mock.patch.object(output_cache, 'OUTPUT_CACHE_SIZE', 3):
+            for key in keys[:3]:
+                output_cache.put(key, {'assistant': key})
+            output_cache.get(keys[0])  # now used after keys[1]
+            output_cache.put(keys[3], {'assistant': keys[3]})
+
+        self.assertIsNone(output_cache.get(keys[1]))
+        for key in (keys[0], keys[2], keys[3]):
+            self.assertEqual(output_cache.get(key), {'assistant': key})
+
+    def test_messages_are_not_cached_by_default(self):
+        context_id = sql.execute("INSERT INTO contexts (summary) VALUES ('')")
+        msg_id = sql.execute("INSERT INTO contexts_messages (context_id, role, msg) VALUES (?, 'assistant', 'Hi')",
+                             (context_id,))
+        self.assertEqual(sql.get_scalar("SELECT cached FROM contexts_messages WHERE id = ?", (msg_id,)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import gc
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from src.utils import sql
+
+
+class TestSqlConnections(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        sql.set_db_filepath(os.path.join(self.temp_dir, 'data.db'))
+
+    def tearDown(self):
+        sql.close_connections()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def test_connection_is_closed_when_its_thread_exits(self):
+        thread_conns = []
+        threads = [threading.Thread(target=lambda: thread_conns.append(sql.get_connection())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        gc.collect()
+        self.assertFalse(sql._connections & set(thread_conns))
+
+        conn = sql.get_connection()
+        self.assertIn(conn, sql._connections)  # the connection of this thread is kept
+
+    def test_close_leaves_other_threads_connections_open(self):
+        opened, closed, done = threading.Event(), threading.Event(), threading.Event()
+        results = []
+
+        def use_connection():
+            conn = sql.get_connection()
+            opened.set()
+            closed.wait(5)
+            results.append(conn.execute("SELECT 1").fetchone()[0])  # still open, it may be in use
+            results.append(sql.get_connection() is not conn)  # reopened on next use
+            done.set()
+
+        threading.Thread(target=use_connection).start()
+        opened.wait(5)
+        sql.close_connections()
+        closed.set()
+        done.wait(5)
+        self.assertEqual(results, [1, True])
+
+    def test_execute_many_deferred(self):
+        sql.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value INTEGER)")
+        sql.execute_many_deferred("INSERT INTO items (id, value) VALUES (?, ?)", [(i, i * 2) for i in range(100)])
+        sql.execute_many_deferred("INSERT INTO items (id, value) VALUES (?, ?)", [])
+        self.assertTrue(sql.flush(timeout=5))
+        self.assertEqual(sql.get_scalar("SELECT SUM(value) FROM items"), sum(i * 2 for i in range(100)))
+
+    def test_failed_deferred_write_calls_on_error(self):
+        sql.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value INTEGER)")
+        sql.execute("INSERT INTO items (id, value) VALUES (1, 1)")
+        errors = []
+        sql.execute_deferred("INSERT INTO items (id, value) VALUES (1, 2)", on_error=errors.append)
+        sql.execute_deferred("INSERT INTO items (id, value) VALUES (2, 2)", on_error=errors.append)
+        self.assertTrue(sql.flush(timeout=5))
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], sqlite3.IntegrityError)
+        self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM items"), 2)
+
+    def test_reads_only_wait_for_own_thread(self):
+        sql.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value INTEGER)")
+        queued = threading.Event()
+        counts = []
+
+        def write():
+            sql.execute_deferred("INSERT INTO items (id, value) VALUES (1, 1)")
+            queued.set()
+            counts.append(sql.get_scalar("SELECT COUNT(*) FROM items"))  # waits for its own write
+
+        # The writer can't commit while this thread holds the lock, a read waiting for its write would block
+        with sql.sql_thread_lock:
+            thread = threading.Thread(target=write)
+            thread.start()
+            queued.wait(5)
+            self.assertEqual(sql.get_scalar("SELECT COUNT(*) FROM items"), 0)
+        thread.join(5)
+        self.assertEqual(counts, [1])
+
+    def test_profiler_normalize_cache_is_bounded(self):
+        for i in range(5000):
+            self.assertEqual(sql.profiler.normalize(f"SELECT * FROM items WHERE id = {i} AND name = 'n{i}'"),
+                             "SELECT * FROM items WHERE id = ? AND name = ?")
+        cache_info = sql.QueryProfiler.normalize.cache_info()
+        self.assertLessEqual(cache_info.currsize, cache_info.maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
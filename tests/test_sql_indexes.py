@@ -0,0 +1,92 @@
+import re
+import unittest
+
+from src.utils import sql
+from tests.common import make_test_db, remove_test_db
+
+# The hot queries of the conversation tree, with the CTE and subquery names that are allowed to be scanned
+HOT_QUERIES = {
+    'BranchTree.load': ({'context_tree', 'ct'}, """
+        WITH RECURSIVE context_tree(id, parent_id, branch_msg_id, active) AS (
+            SELECT id, parent_id, branch_msg_id, active
+            FROM contexts
+            WHERE id = ?
+            UNION ALL
+            SELECT c.id, c.parent_id, c.branch_msg_id, c.active
+            FROM contexts c
+            JOIN context_tree ct ON c.parent_id = ct.id
+        )
+        SELECT
+            ct.id,
+            ct.parent_id,
+            ct.branch_msg_id,
+            ct.active,
+            (SELECT MIN(cm.id) FROM contexts_messages cm WHERE cm.context_id = ct.id) AS first_msg_id
+        FROM context_tree ct
+        ORDER BY ct.id""", (1,)),
+    'MessageHistory.fetch_older': (set(), """
+        SELECT id, role, msg, member_id, embedding_id, token_count, tokenizer, cached
+        FROM contexts_messages
+        WHERE context_id = ?
+            AND id < ?
+        ORDER BY id DESC
+        LIMIT ?""", (1, 100, 101)),
+    'MessageHistory.fetch_newer': (set(), """
+        SELECT m.id, m.role, m.msg, m.member_id, m.embedding_id, m.token_count, m.tokenizer, m.cached
+        FROM contexts_messages m
+        WHERE m.id > ?
+            AND ((m.context_id = ?) OR (m.context_id = ? AND m.id < ?))
+        ORDER BY m.id;""", (0, 2, 1, 5)),
+    'Workflow.load_members': (set(), """
+        SELECT
+            cm.id AS member_id,
+            cm.agent_id,
+            cm.agent_config,
+            cm.del
+        FROM contexts_members cm
+        WHERE cm.context_id = ?
+        ORDER BY
+            cm.loc_x, cm.loc_y""", (1,)),
+    'Workflow.load_members inputs': (set(), """
+        SELECT
+            input_member_id
+        FROM contexts_members_inputs
+        WHERE member_id = ?""", (1,)),
+    'Page_Contexts': (set(), """
+        SELECT
+            c.summary,
+            c.id,
+            cs.display_name AS name,
+            cs.avatar_paths,
+            '' AS goto_button,
+            c.folder_id
+        FROM context_summary cs
+        JOIN contexts c
+            ON c.id = cs.context_id
+        ORDER BY
+            cs.last_message_id DESC;""", ()),
+}
+
+
+class TestSQLIndexes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = make_test_db()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_test_db(cls.temp_dir)
+
+    def test_no_full_table_scans(self):
+        for name, (allowed_scans, query, params) in HOT_QUERIES.items():
+            with self.subTest(query=name):
+                plan = sql.get_results(f'EXPLAIN QUERY PLAN {query}', params)
+                for _, _, _, detail in plan:
+                    # e.g. `SCAN contexts_messages`, an index scan reads `SCAN cm USING COVERING INDEX ...`
+                    match = re.match(r'^SCAN (\w+)$', detail)
+                    if match and match.group(1) not in allowed_scans:
+                        self.fail(f'{name} does a full table scan: {detail}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from src.context import base
+from src.context.base import WorkflowBehaviour, get_run_order
+from src.context.member import Member, INPUT_TYPE_STREAM
+
+
+class SleepMember(Member):
+    """Responds after `duration` seconds, like an agent streaming from an llm"""
+    def __init__(self, workflow, m_id, inputs=None, duration=0.0):
+        super().__init__(main=None, workflow=workflow, m_id=m_id, inputs=inputs)
+        self.name = f'Member {m_id}'
+        self.duration = duration
+
+    async def run_member(self):
+        self.workflow.started[self.m_id] = time.perf_counter()
+        end = time.perf_counter() + self.duration
+        while time.perf_counter() < end:
+            if self.workflow.stop_requested:
+                return
+            await asyncio.sleep(0.01)
+            self.add_partial_output('A sentence. ')
+        self.workflow.finished.append(self.m_id)
+        self.workflow.save_message('assistant', f'{self.name} {self.workflow.version}', self.m_id)
+
+
+def make_workflow(member_specs):
+    """`member_specs` is {member_id: (inputs, duration)}"""
+    workflow = SimpleNamespace(loop=asyncio.new_event_loop(), stop_requested=False, responding=False,
+                               member_configs={}, finished=[], started={}, saved=[], version=1,
+                               reuse_runs=False, rerun_member_ids=set(),
+                               message_history=SimpleNamespace(messages=[SimpleNamespace(role='user', content='Hi')]))
+    workflow.members = {m_id: SleepMember(workflow, m_id, inputs, duration)
+                        for m_id, (inputs, duration) in member_specs.items()}
+
+    def save_message(role, content, member_id=None, log_obj=None):
+        msg = SimpleNamespace(id=len(workflow.saved) + 1, role=role, content=content, log=log_obj)
+        workflow.saved.append(msg)
+        workflow.members[member_id].run_messages.append(msg)
+        return msg
+    workflow.save_message = save_message
+    return workflow
+
+
+class FakeRuns:
+    """Keeps recorded runs in memory instead of `contexts_members_runs`"""
+    get_inputs_hash = staticmethod(base.runs.get_inputs_hash)
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.runs = {}
+
+    def get_run_messages(self, member_id, inputs_hash):
+        msg_ids = self.runs.get((member_id, inputs_hash))
+        if msg_ids is None:
+            return None
+        msgs = {msg.id: msg for msg in self.workflow.saved}
+        return [(msgs[msg_id].role, msgs[msg_id].content, msgs[msg_id].log) for msg_id in msg_ids]
+
+    def save_run(self, member_id, inputs_hash, msg_ids):
+        self.runs[(member_id, inputs_hash)] = msg_ids
+
+
+class TestWorkflowBehaviour(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(base.runs, 'save_run')  # keep recorded runs out of the database
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_run_order(self):
+        workflow = make_workflow({1: ([3], 0), 2: ([], 0), 3: ([2], 0), 4: ([], 0)})
+        self.assertEqual([m.m_id for m in get_run_order(workflow.members)], [2, 4, 3, 1])
+
+    def test_cycle_is_rejected(self):
+        workflow = make_workflow({1: ([2], 0), 2: ([1], 0), 3: ([], 0)})
+        with self.assertRaises(Exception) as cm:
+            WorkflowBehaviour(workflow).start()
+        self.assertIn('Circular member inputs', str(cm.exception))
+        self.assertEqual(workflow.finished, [])
+
+    def test_fan_out_runs_in_parallel(self):
+        workflow = make_workflow({1: ([], 0.3), 2: ([], 0.3), 3: ([], 0.3), 4: ([1, 2, 3], 0.1)})
+        start = time.perf_counter()
+        WorkflowBehaviour(workflow).start()
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(workflow.finished[-1], 4)
+        self.assertLess(elapsed, 0.7)  # the slowest branch and member 4 take 0.4, in sequence it's 1.0
+
+    def test_stream_input_starts_early(self):
+        workflow = make_workflow({1: ([], 0.5), 2: ([1], 0.1)})
+        workflow.members[2].input_types = {1: INPUT_TYPE_STREAM}
+        workflow.member_configs[2] = {'group.stream_input_sentences': 3}
+        WorkflowBehaviour(workflow).start()
+
+        self.assertEqual(sorted(workflow.finished), [1, 2])
+        self.assertLess(workflow.started[2] - workflow.started[1], 0.25)
+
+    def test_stream_input_waits_for_full_output_by_default(self):
+        workflow = make_workflow({1: ([], 0.2), 2: ([1], 0)})
+        workflow.members[2].input_types = {1: INPUT_TYPE_STREAM}
+        WorkflowBehaviour(workflow).start()
+
+        self.assertEqual(workflow.finished, [1, 2])
+
+    def test_stop(self):
+        workflow = make_workflow({1: ([], 5), 2: ([1], 0)})
+        behaviour = WorkflowBehaviour(workflow)
+        threading.Timer(0.1, behaviour.stop).start()
+        start = time.perf_counter()
+        with mock.patch.object(base, 'runs', FakeRuns(workflow)) as fake_runs:
+            behaviour.start()
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertEqual(workflow.finished, [])
+        self.assertEqual(fake_runs.runs, {})  # a stopped run isn't reused
+
+    def test_rerun_only_runs_downstream(self):
+        # 1 -> 2 -> 3 where 3 starts while 2 is streaming, and 4 on its own
+        workflow = make_workflow({1: ([], 0), 2: ([1], 0.1), 3: ([2], 0), 4: ([], 0)})
+        workflow.members[3].input_types = {2: INPUT_TYPE_STREAM}
+        workflow.member_configs[3] = {'group.stream_input_sentences': 1}
+
+        def rerun(version, rerun_member_ids):
+            workflow.finished.clear()
+            workflow.version = version
+            workflow.reuse_runs = True
+            workflow.rerun_member_ids = rerun_member_ids
+            WorkflowBehaviour(workflow).start()
+
+        with mock.patch.object(base, 'runs', FakeRuns(workflow)):
+            WorkflowBehaviour(workflow).start()
+            self.assertEqual(sorted(workflow.finished), [1, 2, 3, 4])
+            self.assertLess(workflow.finished.index(3), workflow.finished.index(2))
+
+            # 3 is replayed, though it started before 2 had finished
+            rerun(2, {4})
+            self.assertEqual(workflow.finished, [4])
+
+            rerun(3, {2})
+            self.assertEqual(sorted(workflow.finished), [2, 3])
+
+        self.assertEqual(sorted(msg.content for msg in workflow.saved[-4:]),
+                         ['Member 1 1', 'Member 2 3', 'Member 3 3', 'Member 4 2'])
+        self.assertFalse(workflow.reuse_runs)
+
+
+if __name__ == '__main__':
+    unittest.main()
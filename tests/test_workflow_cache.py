@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+from src.context import base
+from src.context.base import Workflow, get_workflow, get_cached_workflow_ids
+
+
+def make_cached_workflow(main, context_id, responding=False):
+    workflow = mock.Mock(main=main, id=context_id, responding=responding, reload_pending=False)
+    base._workflow_cache[context_id] = workflow
+    return workflow
+
+
+class TestWorkflowCache(unittest.TestCase):
+    def setUp(self):
+        self.main = object()
+        base._workflow_cache.clear()
+        self.addCleanup(base._workflow_cache.clear)
+
+    def test_cached_workflow_is_reloaded(self):
+        workflow = make_cached_workflow(self.main, 1)
+        self.assertIs(get_workflow(self.main, 1), workflow)
+        workflow.load.assert_called_once()
+
+    def test_responding_workflow_is_reloaded_when_finished(self):
+        workflow = make_cached_workflow(self.main, 1, responding=True)
+        self.assertIs(get_workflow(self.main, 1), workflow)
+        workflow.load.assert_not_called()  # its members are still responding
+        self.assertTrue(workflow.reload_pending)
+
+        Workflow.finish_response(workflow)
+        workflow.load.assert_called_once()
+        self.assertFalse(workflow.responding)
+        self.assertFalse(workflow.reload_pending)
+
+    def test_responding_workflow_is_not_evicted(self):
+        responding = make_cached_workflow(self.main, 0, responding=True)
+        for context_id in range(1, base.WORKFLOW_CACHE_SIZE + 1):
+            get_workflow(self.main, make_cached_workflow(self.main, context_id).id)
+
+        self.assertIn(0, get_cached_workflow_ids())
+        self.assertNotIn(1, get_cached_workflow_ids())
+        responding.unload.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()